@@ -0,0 +1,55 @@
+# Move encodings between .encoding JSON files and an encoding store
+import argparse
+import time
+from Utils.Face.encoding_store import EncodingStore
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    start = time.time()
+    if args.toJson:
+        store = EncodingStore( args.storePath, readOnly = True )
+        numWritten = store.exportJson( args.outputPath )
+        print( "Wrote {} .encoding files from {} in {:.2f} seconds".format(numWritten, args.storePath, time.time() - start) )
+    else:
+        store = EncodingStore( args.storePath )
+        numAdded = store.importJson( args.inputPath, recursive = args.recursive )
+        print( "Added {} .encoding files from {} to {} in {:.2f} seconds".format(numAdded, args.inputPath, args.storePath, time.time() - start) )
+        if args.compact:
+            start = time.time()
+            numDropped = store.compact()
+            print( "Dropped {} replaced rows from {} in {:.2f} seconds".format(numDropped, args.storePath, time.time() - start) )
+        store.close()
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Import .encoding files into an encoding store, or export them from one" )
+    parser.add_argument('--storePath', help="Encoding store directory. Keys are image paths relative to it", required=True)
+    parser.add_argument('--inputPath', help="Directory of .encoding files to import. Defaults to the store directory", default=None)
+    parser.add_argument("--recursive", action='store_true', default=False, help="Import from subdirectories of the input path")
+    parser.add_argument("--compact", action='store_true', default=False, help="After importing, drop rows replaced by newer ones for the same image")
+    parser.add_argument("--toJson", action='store_true', default=False, help="Export the store as .encoding files instead")
+    parser.add_argument('--outputPath', help="Export: directory to write .encoding files to. Defaults to beside the images", default=None)
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    args = parser.parse_args()
+    if args.inputPath is None:
+        args.inputPath = args.storePath
+    return args
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
@@ -1,6 +1,9 @@
 # Generate training data from existing faces
 from Utils.Training.config import Config
+from Utils.Face.encoding_store import EncodingStore
+from Utils.Process.worker_pool import WorkerPool
 import multiprocessing
+import functools
 import queue
 import argparse
 import glob
@@ -22,19 +25,18 @@ def main( args ):
     outputName = args.outputName
     numThreads = args.numThreads
     overwrite = args.overwrite
-    config = Config.createFromFile( args.configFile )
+    # Forked workers share the parent's config instead of each unpickling one
+    loader = functools.partial( Config.createFromFile, args.configFile )
+    pool = WorkerPool( numThreads, loader, args.startMethod ) if numThreads > 1 else None
+    context = pool.getContext() if pool else multiprocessing
 
 
-    poolWorkQueue = multiprocessing.Queue(maxsize=2*numThreads)
-    doneEvent = multiprocessing.Event()
-    if numThreads > 1:
-        pool = []
-        for idx in range(numThreads):
-            proc = multiprocessing.Process(target=worker_process_func, args=(idx, poolWorkQueue, doneEvent, config, args) )
-            proc.start()
-            pool.append( proc )
+    poolWorkQueue = context.Queue(maxsize=2*numThreads)
+    doneEvent = context.Event()
+    if pool:
+        pool.start( worker_process_func, ( poolWorkQueue, doneEvent, args ) )
     else:
-        pool = None
+        config = loader()
         doneEvent.set()
 
 
@@ -45,7 +47,7 @@ def main( args ):
         if overwrite or not os.path.exists( outCsvFile ):
             poolWorkQueue.put( (root, outCsvFile) )
             if pool is None:
-                worker_process_func(0, poolWorkQueue, doneEvent, config, args)
+                worker_process_func(0, config, poolWorkQueue, doneEvent, args)
 
         if not args.recursive:
             break
@@ -53,16 +55,16 @@ def main( args ):
     print("Generator done!")
     doneEvent.set()
     if pool:
-        for proc in pool:
-            proc.join()
+        pool.join()
 
 
 
 ###############################
 # Worker function for helper processes
 ###############################
-def worker_process_func(procId, workQueue, doneEvent, config, args):
+def worker_process_func(procId, config, workQueue, doneEvent, args):
     print("Worker {} started".format(procId))
+    encodingStore = EncodingStore( args.encodingStore, readOnly = True ) if args.encodingStore else None
     while not ( doneEvent.is_set() and workQueue.empty() ):
         try:
             work = workQueue.get(block=True, timeout=1)
@@ -81,7 +83,7 @@ def worker_process_func(procId, workQueue, doneEvent, config, args):
                         relatedFiles = glob.glob(relatedFilesGlob)
 
                         # Have all files? Convert them to CSV
-                        outRow = config.generateParams( relatedFiles )
+                        outRow = config.generateParams( relatedFiles, encodingStore = encodingStore )
                         if outFile is None:
                             print( "Worker {} creating {}".format(procId, outCsvFile))
                             outFile = open( outCsvFile, 'w' )
@@ -117,6 +119,8 @@ def parseArgs():
     parser.add_argument("--outputName", help="Name of CSV file to create in each directory")
     parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
     parser.add_argument("--numThreads", type=int, default=1, help="Number of processes to use")
+    parser.add_argument("--startMethod", choices=[ "fork", "spawn" ], help="How worker processes are started. Defaults to fork, sharing the loaded config, where the platform has it", default=None)
+    parser.add_argument("--encodingStore", help="Encoding store to read encodings from, as well as .encoding files", default=None)
     parser.add_argument("--overwrite", action='store_true', default=False, help="Overwrite existing CSV files")
 
 
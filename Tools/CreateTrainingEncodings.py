@@ -1,45 +1,112 @@
 # Generate training data from existing faces
 
 from Utils.Face.encoded import EncodedFace
+from Utils.Face.encoding_store import EncodingStore
+from Utils.Face.crop_store import CropStore
 from Utils.Face.normalize import FaceNormalizer
+from Utils.Face.detect import FaceDetector, DetectorStats
+from Utils.Face.pose import HeadPose
+from Utils.Face.quality import QualityGate, QualityRejected
+from Utils.Face.encoding_keys import EncodingKeys
+from Utils.Training.photo_budget import PhotoBudget
+from Utils.Cache.result_cache import ResultCache
+from Utils.Process.worker_pool import WorkerPool
+from Utils.Process.stage_timer import StageTimer
 from PIL import Image
-import multiprocessing
+import functools
+import concurrent.futures
+import collections
+import threading
 import argparse
 import glob
 import os
 import queue
 import fnmatch
+import time
+import numpy
 
 ###############################
 # Run the program
 #
-def main( args ):
+# When collectFaces is set the EncodedFaces are also returned, keyed by directory,
+# and then by image file if byFile is set. With inputFiles only those images are
+# encoded, again if they were before, and existing holds the faces already encoded
+# in their directories, keyed the same way, which count against photosPerAngle
+def main( args, collectFaces = False, byFile = False, inputFiles = None, existing = None ):
     if args.pydev:
         print("Enabling debugging with pydev")
         import pydevd
         pydevd.settrace(suspend=False)
-    inputPath = args.inputPath
-    #outputPath = args.outputPath
-    numThreads = args.numThreads
-    recursive = args.recursive
-    fileFilter = args.filter.split(',')
-    debugPose = args.debugPose
-
-    poolWorkQueue = multiprocessing.Queue(maxsize=2*numThreads)
-    doneEvent = multiprocessing.Event()
-    if numThreads > 1:
-        pool = []
-        for idx in range(numThreads):
-            proc = multiprocessing.Process(target=worker_process_func, args=(idx, poolWorkQueue, doneEvent, args) )
-            proc.start()
-            pool.append( proc )
+
+    # Only compute what the configs read, if any were given
+    if getattr(args, "configPath", None) and getattr(args, "requirements", None) is None:
+        args.requirements = loadRequirements( args.configPath )
+    requirements = getattr(args, "requirements", None)
+
+    # All processes record cache statistics under one run
+    if args.cachePath and not getattr(args, "cacheRun", None):
+        args.cacheRun = ResultCache.newRunId()
+
+    # Only this process appends to the encoding store, so workers send their results back
+    store = EncodingStore( args.encodingStore ) if getattr(args, "encodingStore", None) else None
+    # The same goes for the crop store. Workers read it, and send the crops they make back
+    crops = CropStore( args.cropStore, codec = getattr(args, "cropCodec", "zlib") ) if getattr(args, "cropStore", None) else None
+
+    # When collecting, faces are returned per directory instead of only living on disk.
+    # Selecting photos needs the faces already encoded too, to count them against the budget
+    photosPerAngle = getattr(args, "photosPerAngle", 0)
+    collected = { root: dict(faces) for root, faces in existing.items() } if existing else {}
+    workItems = findWorkItems( args, store, requirements, collected if collectFaces or photosPerAngle > 0 else None, inputFiles )
+    if QualityGate.createFromArgs( args ) is not None and not args.normalize:
+        raise Exception("The quality gate checks the faces found when normalizing, so it needs normalize")
+    if photosPerAngle > 0:
+        if requirements is None or not args.normalize:
+            raise Exception("Selecting photos with photosPerAngle needs configPath for its angles, and normalizing")
+        workItems = selectWorkItems( workItems, args, collected, crops )
+
+    if getattr(args, "batchSize", 0) > 0:
+        for inputFile, outputFile, encodedFace, mirrored in encodeBatches( workItems, args, crops ):
+            saveEncodingFiles( outputFile, encodedFace, args )
+            if encodedFace is not None:
+                print("Batch generated {} {}".format(outputFile, mirrored))
+            else:
+                print("Batch failed to generate {} : {}".format(outputFile, mirrored))
+            recordResult( inputFile, encodedFace, store, collected if collectFaces else None )
     else:
-        pool = None
-        doneEvent.set()
+        encodeWithProcesses( workItems, args, store, collected if collectFaces else None, crops )
+
+    if store is not None:
+        print( "Encoding store {} has {} images".format(store.getPath(), len(store)) )
+        store.close()
+
+    if crops is not None:
+        print( "Crop store {} has {} crops".format(crops.getPath(), len(crops)) )
+        crops.close()
 
+    if args.cachePath:
+        cache = openCache( args )
+        cache.printStats()
+        cache.close()
 
-    # Read in all of the files from inputpath
-    for root, subdirs, files in os.walk(inputPath):
+    if not collectFaces:
+        return None
+    return collected if byFile else { root: list( faces.values() ) for root, faces in collected.items() }
+
+
+# Yield ( inputFile, outputFile, imageHash, normalized ) for every image that needs encoding.
+# imageHash is None until something keyed on the image hashes it, and normalized is None
+# unless the image was normalized before it was encoded. Images already encoded with what
+# requirements need are skipped, and added to collected if given, which holds the faces
+# in each directory keyed by their image file. Given inputFiles, only those are yielded,
+# whether or not they were encoded before, a directory at a time
+def findWorkItems( args, store, requirements, collected = None, inputFiles = None ):
+    if inputFiles is not None:
+        for inputFile in sorted( inputFiles, key = lambda inputFile: ( os.path.dirname(inputFile), inputFile ) ):
+            yield ( inputFile, "{}.encoding".format( os.path.splitext(inputFile)[0] ), None, None )
+        return
+
+    fileFilter = args.filter.split(',')
+    for root, subdirs, files in os.walk(args.inputPath):
         print("Entering directory {}".format(root))
         for filter in fileFilter:
             for file in fnmatch.filter(files, filter):
@@ -49,68 +116,539 @@ def main( args ):
                 if os.path.exists( "{}.failed".format(outputFile ) ) or     \
                    os.path.splitext(inputFile)[0].endswith("normalized"):
                     continue
+                if store is not None and store.contains( inputFile ):
+                    encodedFace = store.getFace( inputFile )
+                    if encodedFace is None or hasRequired( encodedFace, requirements ):
+                        if collected is not None and encodedFace is not None:
+                            collected.setdefault( root, {} )[inputFile] = encodedFace
+                        continue
                 try:
                     # If this doesn't throw an exception, then we've already made this encoding
-                    EncodedFace.createFromFile(outputFile)
+                    encodedFace = EncodedFace.createFromFile(outputFile)
+                    if not hasRequired( encodedFace, requirements ):
+                        raise Exception("Encoding was made without the encoding needed")
+                    if collected is not None:
+                        collected.setdefault( root, {} )[inputFile] = encodedFace
                 except:
-                    poolWorkQueue.put( (inputFile, outputFile ))
-                    if pool is None:
-                        worker_process_func(0, poolWorkQueue, doneEvent, args)
+                    yield ( inputFile, outputFile, None, None )
 
-        if not recursive:
+        if not args.recursive:
             break
 
     print("Generator done!")
+
+###############################
+# Only pass on the best photosPerAngle photos of each person, a directory, at each of the
+# configs' angles. Every photo in a directory is scanned first in numThreads threads: its
+# face is found, posed and scored by the quality gate, with its thresholds if any are set.
+# Faces already encoded count against the budget, so reruns don't encode more. Scans are
+# kept in the result cache if there is one, so photos which were left out aren't scanned
+# again. Photos which are selected aren't normalized again: their crop is in the crop store
+# if there is one, or else passed on with the work item
+###############################
+def selectWorkItems( workItems, args, existing, crops = None ):
+    budget = PhotoBudget( args.requirements, args.photosPerAngle )
+    cache = openCache( args ) if args.cachePath else None
+    context = BatchContext( args, cache, crops )
+    # Scans have their own gate, so the encoder's only counts faces it encodes
+    gate = QualityGate.createFromArgs( args ) or QualityGate()
+    # findWorkItems has seen all of a directory by the time it yields from the next one
+    yield from budget.selectWorkItems( workItems, lambda workItem: scanImage( workItem, context, gate ), existing, args.numThreads )
+    if cache:
+        cache.close()
+    context.stages.printStats( "scan stage" )
+
+# Find, pose and score the face in a work item's image for selectWorkItems. Returns the scan,
+# ( angle, score, passed ) or None if there's no face or the quality gate rejects it, and the
+# work item to encode it with: with the image's hash if it was hashed, and its normalized
+# crop if it was normalized and there's no crop store to find it in
+def scanImage( workItem, context, gate ):
+    args = context.args
+    inputFile, outputFile, imageHash, normalized = workItem
+    if imageHash is None and ( context.cache or context.crops is not None ):
+        imageHash = EncodingKeys.hashImage( inputFile )
+    workItem = ( inputFile, outputFile, imageHash, normalized )
+    cacheKey = None
+    if context.cache:
+        cacheKey = EncodingKeys.getScanKey( imageHash, args )
+        with context.cacheLock:
+            cached = context.cache.get( ResultCache.SCAN, cacheKey )
+        if cached is not ResultCache.MISSING:
+            return ( tuple(cached) if cached is not None else None ), workItem
+
+    scan = None
+    try:
+        npImg, detection = loadNormalized( inputFile, context.getNormalizer(), args, context.crops, context.stages, imageHash = imageHash )
+        with context.stages.stage("quality"):
+            report = gate.check( npImg, detection )
+        if not report.rejected:
+            scan = ( report.angle, report.getScore(), report.passed )
+            if context.crops is None:
+                workItem = ( inputFile, outputFile, imageHash, ( npImg, detection ) )
+    except Exception:
+        pass
+    if context.cache:
+        with context.cacheLock:
+            context.cache.put( ResultCache.SCAN, cacheKey, list(scan) if scan is not None else None )
+    return scan, workItem
+
+# Add a result to the encoding store and collected faces, if there are any
+def recordResult( inputFile, encodedFace, store, collected = None ):
+    if store is not None:
+        if encodedFace is None:
+            store.addFailed( inputFile )
+        else:
+            store.addFace( inputFile, encodedFace )
+    if collected is not None and encodedFace is not None:
+        collected.setdefault( os.path.dirname(inputFile), {} )[inputFile] = encodedFace
+
+# Record a result a worker queued, adding the crop it made to the crop store if it made one.
+# Faces the quality gate rejected aren't recorded, so they're checked again next time
+def recordQueuedResult( result, store, collected, crops ):
+    inputFile, encodedFace, crop, rejected = result
+    if not rejected:
+        recordResult( inputFile, encodedFace, store, collected )
+    if crop is not None:
+        crops.add( *crop )
+
+# Write the .encoding file, or .failed if there's no face, unless an encoding store holds them
+def saveEncodingFiles( outputFile, encodedFace, args ):
+    if not args.saveEncodings or getattr(args, "encodingStore", None):
+        return
+    if encodedFace is not None:
+        encodedFace.saveEncodings(outputFile)
+    else:
+        with open("{}.failed".format(outputFile), 'w') as f:
+            pass
+
+###############################
+# Encode one image at a time in numThreads processes
+###############################
+def encodeWithProcesses( workItems, args, store, collected = None, crops = None ):
+    numThreads = args.numThreads
+    loader = functools.partial( loadEncodingModels, args )
+    pool = WorkerPool( numThreads, loader, getattr(args, "startMethod", None) ) if numThreads > 1 else None
+    # Without workers everything runs in this process. A multiprocessing queue can look
+    # empty there before its feeder thread has passed on what was put, so a plain one is used
+    context = pool.getContext() if pool else None
+    poolWorkQueue = context.Queue(maxsize=2*numThreads) if pool else queue.Queue()
+    resultQueue = ( context.Queue() if pool else queue.Queue() ) if collected is not None or store or crops else None
+    doneEvent = context.Event() if pool else threading.Event()
+    if pool:
+        pool.start( worker_process_func, ( poolWorkQueue, doneEvent, args, resultQueue ) )
+    else:
+        # The worker runs once per image here, so its stages are added up across them
+        models = loader()
+        timer = StageTimer()
+        doneEvent.set()
+
+    numSubmitted = 0
+    numReceived = 0
+    for workItem in workItems:
+        poolWorkQueue.put( workItem )
+        numSubmitted += 1
+        if pool is None:
+            worker_process_func(0, models, poolWorkQueue, doneEvent, args, resultQueue, timer, crops)
+        # Take results as they come, so crops don't pile up waiting in the queue
+        while resultQueue is not None and numReceived < numSubmitted:
+            try:
+                result = resultQueue.get_nowait()
+            except queue.Empty:
+                break
+            numReceived += 1
+            recordQueuedResult( result, store, collected, crops )
+
     doneEvent.set()
+
+    # Drain results before joining so workers aren't blocked flushing the queue
+    while resultQueue is not None and numReceived < numSubmitted:
+        try:
+            result = resultQueue.get(block=True, timeout=1)
+            numReceived += 1
+            recordQueuedResult( result, store, collected, crops )
+        except queue.Empty:
+            if pool is None or not pool.isAlive():
+                print("Workers exited with {} results outstanding".format(numSubmitted - numReceived))
+                break
+
     if pool:
-        for proc in pool:
-            proc.join()
+        pool.join()
+    else:
+        timer.printStats( "worker 0" )
+        getDetector( models, args ).getStats().printStats()
+        printQualityStats( args )
+
+# What the workers share: the normalizer, if normalizing, with face_recognition's models
+# and the face detectors loaded too. Forked workers are handed the parent's
+def loadEncodingModels( args ):
+    EncodedFace.loadModels()
+    if not args.normalize:
+        FaceDetector.getShared( EncodingKeys.getCascade( args ) ).load()
+        return None
+    return FaceNormalizer( args.normalizeSize, coarseWidth = EncodingKeys.getCoarseWidth( args ), detector = FaceDetector( EncodingKeys.getCascade( args ) ) )
 
+# The detector faces are found with, the normalizer's if there is one
+def getDetector( normalizer, args ):
+    return normalizer.getDetector() if normalizer else FaceDetector.getShared( EncodingKeys.getCascade( args ) )
 
+# What this process's quality gate let through, if there is one
+def printQualityStats( args ):
+    gate = QualityGate.getShared( args )
+    if gate is not None:
+        gate.getStats().printStats()
 
 ###############################
 # Worker function for helper processes
 ###############################
-def worker_process_func(procId, workQueue, doneEvent, args):
+# Stages are added to timer, or printed when the worker is done if it has its own. Workers
+# without the crop store to add to read it, and send the crops they make with their results
+def worker_process_func(procId, normalizer, workQueue, doneEvent, args, resultQueue = None, timer = None, crops = None):
     print("Worker {} started".format(procId))
-    if args.normalize:
-        normalizer = FaceNormalizer(args.normalizeSize)
-    else:
-        normalizer = None
+    cache = openCache( args ) if args.cachePath else None
+    ownTimer = timer is None
+    if ownTimer:
+        timer = StageTimer()
+    ownCrops = crops is None and getattr(args, "cropStore", None)
+    if ownCrops:
+        crops = CropStore( args.cropStore, readOnly = True )
 
     while not ( doneEvent.is_set() and workQueue.empty() ):
         try:
-            work = workQueue.get(block=True, timeout=1)
-            inputFile = work[0]
-            outputFile = work[1]
+            inputFile, outputFile, imageHash, normalized = workQueue.get(block=True, timeout=1)
             #print("Worker thread {} to generate {}->{}".format(procId, inputFile,outputFile))
+            encodedFace = None
+            rejected = False
+            newCrops = []
             try:
-                image = Image.open(inputFile)
-                if args.flipFirst:
-                    image = image.transpose(Image.FLIP_LEFT_RIGHT)
-                if normalizer:
-                    image = normalizer.normalize(image)
-                    fileName = "{}_normalized.png".format( os.path.splitext(inputFile)[0])
-                    image.save( fileName)
-
-                encodedFace = EncodedFace(image, debugPose = args.debugPose )
-                mirrored = ""
-                if encodedFace.getAngle() < 0:
-                    #print( "Mirroring image to face left")
-                    old_angle = encodedFace.getAngle()
-                    encodedFace = EncodedFace( image.transpose(Image.FLIP_LEFT_RIGHT), debugPose = args.debugPose )
-                    new_angle = encodedFace.getAngle()
-                    mirrored = "[mirrored] {} : {}".format(old_angle, new_angle)
-                encodedFace.saveEncodings(outputFile)
+                encodedFace, mirrored = encodeImage( inputFile, normalizer, args, cache, timer, crops, ( lambda *crop: newCrops.append( crop ) ) if ownCrops else None, imageHash, normalized )
                 print("Worker {} generated {} {}".format(procId, outputFile, mirrored ) )
+            except QualityRejected as e:
+                rejected = True
+                print("Worker {} rejected {} : {}".format(procId, outputFile, str(e)))
             except Exception as e:
+                encodedFace = None
                 print("Worker {} failed to generate {} : {}".format(procId, outputFile, str(e)))
-                with open("{}.failed".format(outputFile), 'w') as f:
-                    pass
+            if not rejected:
+                saveEncodingFiles( outputFile, encodedFace, args )
+            if resultQueue is not None:
+                resultQueue.put( ( inputFile, encodedFace, newCrops[0] if len(newCrops) > 0 else None, rejected ) )
         except queue.Empty:
             pass
+    if cache:
+        cache.close()
+    if ownCrops:
+        crops.close()
+    if ownTimer:
+        timer.printStats( "worker {}".format(procId) )
+        getDetector( normalizer, args ).getStats().printStats()
+        printQualityStats( args )
     print("Worker {} done!".format(procId))
 
+###############################
+# Encode images in batches through the batch API. A pool of numThreads threads reads,
+# normalizes and poses images ahead of the batch being encoded, with at most two
+# batches waiting so memory stays bounded. dlib releases the GIL while it detects
+# and aligns faces, so the threads run alongside each other and the encoder.
+# Yields ( inputFile, outputFile, encodedFace, message ), encodedFace None on failure
+###############################
+def encodeBatches( workItems, args, crops = None ):
+    cache = openCache( args ) if args.cachePath else None
+    context = BatchContext( args, cache, crops )
+    executor = concurrent.futures.ThreadPoolExecutor( max_workers = args.numThreads, thread_name_prefix = "prepare" )
+    workItems = iter( workItems )
+    pending = collections.deque()
+    batch = []
+    numImages = 0
+    start = time.time()
+
+    while True:
+        # Keep the threads busy with the images after this one
+        while len(pending) < 2 * args.batchSize:
+            workItem = next( workItems, None )
+            if workItem is None:
+                break
+            inputFile, _, imageHash, normalized = workItem
+            pending.append( ( workItem, executor.submit( prepareImage, inputFile, context, imageHash, normalized ) ) )
+        if len(pending) == 0:
+            break
+
+        ( inputFile, outputFile, _, _ ), future = pending.popleft()
+        numImages += 1
+        try:
+            prepared = future.result()
+        except QualityRejected as e:
+            # Not passed on, so it isn't marked as failed
+            print("Batch rejected {} : {}".format(outputFile, str(e)))
+            continue
+        except Exception as e:
+            yield inputFile, outputFile, None, str(e)
+            continue
+        if isinstance( prepared, EncodedFace ):
+            yield inputFile, outputFile, prepared, "[cached]"
+            continue
+        batch.append( ( inputFile, outputFile ) + prepared )
+        if len(batch) >= args.batchSize:
+            yield from encodeBatch( batch, context )
+            batch = []
+
+    if len(batch) > 0:
+        yield from encodeBatch( batch, context )
+    executor.shutdown( wait = True )
+    if cache:
+        cache.close()
+    context.workers.printStats( "worker", total = ( numImages, time.time() - start ), sort = True )
+    context.stages.printStats()
+    context.detectorStats.printStats()
+    printQualityStats( args )
+
+# What the prepare threads and encoder share
+class BatchContext:
+    def __init__(self, args, cache, crops = None):
+        self.args = args
+        self.requirements = getattr(args, "requirements", None)
+        self.cache = cache
+        # The cache is used by one thread at a time. The crop store has its own lock
+        self.cacheLock = threading.Lock()
+        self.crops = crops
+        self.normalizers = threading.local()
+        # Busy time of each prepare thread and the encoder, to compare batch sizes and
+        # thread counts with, and time spent in each stage
+        self.workers = StageTimer()
+        self.stages = StageTimer()
+        # Each thread has its own detector, but they add up their stats together
+        self.detectorStats = DetectorStats()
+        self.detector = None if args.normalize else FaceDetector( EncodingKeys.getCascade( args ), self.detectorStats )
+        self.qualityGate = QualityGate.getShared( args )
+
+    def getNormalizer(self):
+        if not self.args.normalize:
+            return None
+        if not hasattr(self.normalizers, "normalizer"):
+            self.normalizers.normalizer = FaceNormalizer( self.args.normalizeSize, coarseWidth = EncodingKeys.getCoarseWidth( self.args ), detector = FaceDetector( EncodingKeys.getCascade( self.args ), self.detectorStats ) )
+        return self.normalizers.normalizer
+
+# Read, normalize and pose one image in a prepare thread, unless it was normalized already.
+# Returns the EncodedFace if it was cached, else ( cacheKey, image, needsEncoding, mirroredFromAngle ) for encodeBatch.
+# Faces the normalizer finds looking right are flipped here, so the encoder needn't.
+# The batch API doesn't jitter, so faces the quality gate deprioritizes are encoded as usual
+def prepareImage( inputFile, context, imageHash = None, normalized = None ):
+    args = context.args
+    start = time.time()
+    try:
+        if imageHash is None and ( context.cache or context.crops is not None ):
+            imageHash = EncodingKeys.hashImage( inputFile )
+        cacheKey = None
+        if context.cache:
+            cacheKey = EncodingKeys.getEncodingKey( imageHash, args )
+            with context.cacheLock:
+                cached = context.cache.get( ResultCache.ENCODING, cacheKey )
+            if cached is None:
+                raise Exception("No face found in image (cached)")
+            if isinstance( cached, dict ) and "rejected" in cached:
+                raise QualityRejected( "{} (cached)".format( cached["rejected"] ) )
+            if cached is not ResultCache.MISSING:
+                encodedFace = EncodedFace.createFromJson( cached )
+                if hasRequired( encodedFace, context.requirements ):
+                    return encodedFace
+
+        try:
+            if normalized is not None:
+                npImg, detection = normalized
+            else:
+                npImg, detection = loadNormalized( inputFile, context.getNormalizer(), args, context.crops, context.stages, imageHash = imageHash )
+            mirroredFromAngle = None
+            needsEncoding = True
+            if detection is not None:
+                if context.qualityGate is not None:
+                    with context.stages.stage("quality"):
+                        report = context.qualityGate.check( npImg, detection )
+                    if report.rejected:
+                        raise QualityRejected( "Rejected by quality gate: {}".format( report.describe() ) )
+                    angle = report.angle
+                else:
+                    _, angles, _ = HeadPose.estimate( HeadPose.getImagePoints( detection.points[None] ), npImg.shape[:2] )
+                    angle = float(angles[0])
+                if angle < 0:
+                    mirroredFromAngle = angle
+                    npImg = numpy.ascontiguousarray( npImg[:, ::-1] )
+                if context.requirements is not None:
+                    needsEncoding = context.requirements.needsEncoding( abs(angle) )
+        except QualityRejected as e:
+            # Remembered apart from images without a face, for these thresholds only
+            if context.cache:
+                with context.cacheLock:
+                    context.cache.put( ResultCache.ENCODING, cacheKey, { "rejected": str(e) } )
+            raise
+        except Exception:
+            # Remember images without a usable face too
+            if context.cache:
+                with context.cacheLock:
+                    context.cache.put( ResultCache.ENCODING, cacheKey, None )
+            raise
+        return cacheKey, npImg, needsEncoding, mirroredFromAngle
+    finally:
+        context.workers.record( threading.current_thread().name, time.time() - start )
+
+# Encode a batch of prepared images with one call, yielding results as encodeBatches does
+def encodeBatch( batch, context ):
+    args = context.args
+    start = time.time()
+    encodedFaces = EncodedFace.batchEncode( [ npImg for _, _, _, npImg, _, _ in batch ], batch_size = len(batch), debugPose = args.debugPose,
+                                            needsEncoding = [ needsEncoding for _, _, _, _, needsEncoding, _ in batch ],
+                                            faceLeft = True, mirroredFromAngles = [ mirroredFromAngle for _, _, _, _, _, mirroredFromAngle in batch ], detector = context.detector )
+    context.workers.record( "encode", time.time() - start, len(batch) )
+    context.stages.record( "encode", time.time() - start, len(batch) )
+
+    for ( inputFile, outputFile, cacheKey, _, _, _ ), encodedFace in zip( batch, encodedFaces ):
+        if context.cache:
+            with context.cacheLock:
+                context.cache.put( ResultCache.ENCODING, cacheKey, encodedFace.getEncodingJson() if encodedFace is not None else None )
+        if encodedFace is None:
+            yield inputFile, outputFile, None, "No face found in normalized image"
+        else:
+            yield inputFile, outputFile, encodedFace, describeFace( encodedFace, None )
+
+# Requirements of every config matching configPath, which can include wildcards
+def loadRequirements( configPath ):
+    from Utils.Training.config import Config
+    from Utils.Training.param_generator import FaceRequirements
+
+    configFiles = glob.glob( configPath )
+    if len(configFiles) == 0:
+        raise Exception( "No configs found at {}".format(configPath) )
+    requirements = FaceRequirements.merge( [ Config.createFromFile( configFile ).getRequirements() for configFile in configFiles ] )
+    print( "Encoding faces at angles {} for {} configs".format(requirements.getAngles(), len(configFiles)) )
+    return requirements
+
+# True if the face has what requirements need. A face without an encoding
+# is only enough when nothing reads the encoding at its angle
+def hasRequired( encodedFace, requirements ):
+    return encodedFace.hasEncoding() or ( requirements is not None and not requirements.needsEncoding( encodedFace.getAngle() ) )
+
+def openCache( args ):
+    return ResultCache( args.cachePath, maxBytes = args.cacheSizeMb*1024*1024, runId = getattr(args, "cacheRun", None) )
+
+###############################
+# Encode a single image, mirroring it so the face is always looking left. With crops its
+# normalized crop is read from the crop store, or added to it with addCrop, crops.add by default.
+# The image is hashed for its keys unless imageHash is given, and only normalized if there's
+# no normalized ( npImg, FaceDetection ) for it already
+###############################
+def encodeImage( inputFile, normalizer, args, cache = None, timer = None, crops = None, addCrop = None, imageHash = None, normalized = None ):
+    if imageHash is None and ( cache or crops is not None ):
+        imageHash = EncodingKeys.hashImage( inputFile )
+    if cache:
+        cacheKey = EncodingKeys.getEncodingKey( imageHash, args )
+        cached = cache.get( ResultCache.ENCODING, cacheKey )
+        if cached is None:
+            raise Exception("No face found in image (cached)")
+        if isinstance( cached, dict ) and "rejected" in cached:
+            raise QualityRejected( "{} (cached)".format( cached["rejected"] ) )
+        if cached is not ResultCache.MISSING:
+            encodedFace = EncodedFace.createFromJson( cached )
+            if hasRequired( encodedFace, getattr(args, "requirements", None) ):
+                return encodedFace, "[cached]"
+
+    try:
+        npImg, detection = normalized if normalized is not None else loadNormalized( inputFile, normalizer, args, crops, timer, addCrop, imageHash )
+        encodedFace, mirrored = encodeNormalized( npImg, detection, args, timer )
+    except QualityRejected as e:
+        # Remembered apart from images without a face, for these thresholds only
+        if cache:
+            cache.put( ResultCache.ENCODING, cacheKey, { "rejected": str(e) } )
+        raise
+    except Exception:
+        # Remember images without a usable face too
+        if cache:
+            cache.put( ResultCache.ENCODING, cacheKey, None )
+        raise
+
+    if cache:
+        cache.put( ResultCache.ENCODING, cacheKey, encodedFace.getEncodingJson() )
+    return encodedFace, mirrored
+
+# Encode an already opened image. Stages are added to timer if given
+def encodePilImage( image, normalizer, args, timer = None ):
+    timer = timer if timer is not None else StageTimer()
+    npImg, detection = decodeAndNormalize( image, normalizer, args, timer )
+    return encodeNormalized( npImg, detection, args, timer )
+
+# Encode an RGB array, with the FaceDetection of its face if it was normalized. Normalized
+# faces go through the quality gate first, if the arguments set one: faces it rejects
+# raise QualityRejected, and ones it deprioritizes get a single jitter
+def encodeNormalized( npImg, detection, args, timer = None ):
+    requirements = getattr(args, "requirements", None)
+    numJitters = args.numJitters
+    jitterEpsilon = getattr(args, "jitterEpsilon", None)
+    timer = timer if timer is not None else StageTimer()
+
+    quality = ""
+    gate = QualityGate.getShared( args )
+    if gate is not None and detection is not None:
+        with timer.stage("quality"):
+            report = gate.check( npImg, detection )
+        if report.rejected:
+            raise QualityRejected( "Rejected by quality gate: {}".format( report.describe() ) )
+        if report.deprioritized:
+            numJitters = 1
+            jitterEpsilon = None
+            quality = " [deprioritized: {}]".format( report.describe() )
+
+    with timer.stage("encode"):
+        # The normalizer has already found the face, so the encoder doesn't look for it again
+        if detection is not None:
+            encodedFace = EncodedFace(npImg, region = detection.region, landmarkPoints = detection.points, num_jitters = numJitters, debugPose = args.debugPose,
+                                      faceLeft = True, requirements = requirements, jitterEpsilon = jitterEpsilon )
+        else:
+            encodedFace = EncodedFace(npImg, num_jitters = numJitters, debugPose = args.debugPose, faceLeft = True, requirements = requirements, jitterEpsilon = jitterEpsilon,
+                                      detector = FaceDetector.getShared( EncodingKeys.getCascade( args ) ) )
+
+    return encodedFace, describeFace( encodedFace, jitterEpsilon ) + quality
+
+# An image file as decodeAndNormalize returns it. With crops and a normalizer its crop is
+# read from the crop store, skipping decoding and alignment, or else made and added to it
+# with addCrop, crops.add by default. The image is hashed for its key unless imageHash is given
+def loadNormalized( inputFile, normalizer, args, crops = None, timer = None, addCrop = None, imageHash = None ):
+    timer = timer if timer is not None else StageTimer()
+    if crops is None or not normalizer:
+        return decodeAndNormalize( Image.open(inputFile), normalizer, args, timer )
+    key = EncodingKeys.getCropKey( imageHash if imageHash is not None else EncodingKeys.hashImage( inputFile ), args )
+    with timer.stage("crop read"):
+        crop = crops.get( key )
+    if crop is not None:
+        return crop
+    npImg, detection = decodeAndNormalize( Image.open(inputFile), normalizer, args, timer )
+    with timer.stage("crop write"):
+        ( addCrop or crops.add )( key, npImg, detection )
+    return npImg, detection
+
+# An opened image as an RGB array, normalized if there's a normalizer, and the FaceDetection
+# of its face if so. It stays an array from decoding to encoding. Large JPEGs are decoded at
+# a reduced size when they'll be normalized
+def decodeAndNormalize( image, normalizer, args, timer = None ):
+    timer = timer if timer is not None else StageTimer()
+    # The quality gate measures faces in the photo's own pixels
+    sourceWidth = None if isinstance( image, numpy.ndarray ) else image.width
+    with timer.stage("decode"):
+        npImg = FaceNormalizer.decodeImage( image, FaceNormalizer.WORK_WIDTH if normalizer else None )
+        if args.flipFirst:
+            npImg = numpy.ascontiguousarray( npImg[:, ::-1] )
+    if not normalizer:
+        return npImg, None
+
+    return normalizer.normalizeArray( npImg, timer, sourceWidth )
+
+# How the face was encoded, for the log
+def describeFace( encodedFace, jitterEpsilon ):
+    mirrored = ""
+    if encodedFace.getMirroredFromAngle() is not None:
+        mirrored = "[mirrored] {} : {}".format(encodedFace.getMirroredFromAngle(), encodedFace.getAngle())
+    if not encodedFace.hasEncoding():
+        mirrored += " [landmarks only]"
+    elif jitterEpsilon is not None:
+        mirrored += " [{} jitters]".format(encodedFace.getNumJitters())
+    return mirrored
+
 ###############################
 # parse arguments
 #
@@ -120,13 +658,27 @@ def parseArgs():
     parser.add_argument('--filter', help="File filter to process. Defaults to \"*.png,*.jpg\"", default="*.png,*.jpg")
     parser.add_argument('--normalizeSize', type=int, help="Size of normalized output. Defaults to 150", default=150)
     parser.add_argument('--numJitters', type=int, help="Number of times to jitter each image. Defaults to 3, which is 3x slower than 1", default=3)
+    parser.add_argument('--jitterEpsilon', type=float, help="Jitter adaptively: stop adding jitters once the average encoding moves less than this, with numJitters as the most. Disabled by default", default=None)
     #parser.add_argument('--outputPath', help="Directory to write output data to", default="output")
     parser.add_argument("--debugPose", action='store_true', default=False, help="Display landmarks and pose on each image")
     parser.add_argument("--recursive", action='store_true', default=False, help="Recursively enter directories")
     parser.add_argument("--normalize", action='store_true', default=True, help="Perform image normalization")
     parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
-    parser.add_argument("--numThreads", type=int, default=1, help="Number of processes to use")
+    parser.add_argument("--numThreads", type=int, default=1, help="Number of processes to use, or of threads preparing images with batchSize")
+    parser.add_argument("--coarseWidth", type=int, help="Width faces are first looked for at before aligning, or 0 to look in the whole image. Defaults to {}".format( FaceNormalizer.COARSE_WIDTH ), default=FaceNormalizer.COARSE_WIDTH)
+    parser.add_argument("--detectors", help="Face detectors tried in order until one finds a face, as model:upsample with models hog or cnn, such as hog:0,hog:1,cnn:0. Defaults to hog:1", default=FaceDetector.DEFAULT_CASCADE)
+    parser.add_argument("--startMethod", choices=[ "fork", "spawn" ], help="How worker processes are started. Defaults to fork, sharing loaded models, where the platform has it", default=None)
+    parser.add_argument("--batchSize", type=int, default=0, help="Encode this many images at a time through the batch API, with numThreads threads reading and normalizing them. Jitter settings aren't used. Disabled by default")
     parser.add_argument("--flipFirst", action='store_true', default=False, help="Mirror images by default")
+    parser.add_argument("--cachePath", help="Result cache file to reuse encodings of unchanged images. Disabled by default", default=None)
+    parser.add_argument("--cacheSizeMb", type=int, help="Size limit of the result cache. Defaults to 1024", default=1024)
+    parser.add_argument("--noSaveEncodings", dest="saveEncodings", action='store_false', default=True, help="Don't write .encoding or .failed files")
+    parser.add_argument("--encodingStore", help="Directory of an encoding store to read and add encodings to, instead of .encoding files. Keys are image paths relative to it", default=None)
+    parser.add_argument("--cropStore", help="Directory of a crop store to keep normalized faces in, so they're only decoded and aligned once. Disabled by default", default=None)
+    parser.add_argument("--cropCodec", choices=CropStore.CODECS, help="How crops are added to the crop store: raw, or zlib at its fastest level. Defaults to zlib", default="zlib")
+    parser.add_argument("--configPath", help="Config files, can include wildcard. Faces are only given the encodings these configs read, at the angles they read them. Defaults to full encodings", default=None)
+    parser.add_argument("--photosPerAngle", type=int, default=0, help="Only encode the best this many photos of each person, a directory, at each of the configs' angles, picked after finding, posing and scoring every face. Needs configPath. Scans are kept in the result cache if there is one. Disabled by default")
+    QualityGate.addArguments( parser )
 
 
     return parser.parse_args()
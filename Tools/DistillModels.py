@@ -0,0 +1,195 @@
+# Distill several models into one network with a shared trunk and one head per model
+import argparse
+import glob
+import os
+import random
+import time
+import numpy
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    from Utils.Training.config import Config
+    from Utils.Prediction.predictor import MultiModelPredictor, Person
+    from Utils.Prediction.numpy_model import NumpyModel
+    from Utils.Prediction.bundle import ModelBundle
+    from Utils.Face.encoding_store import EncodingStore
+
+    modelFiles = glob.glob( args.modelPath )
+    print( "Loading {} models".format(len(modelFiles)))
+    teachers = MultiModelPredictor( modelFiles, useKeras = args.useKeras )
+    teacherModels = teachers.getModels()
+    if len(teacherModels) == 0:
+        raise Exception( "No models found at {}".format(args.modelPath) )
+    inputConfig = Config.createSharedInputConfig( [ teacher.config for teacher in teacherModels ] )
+
+    print( "Reading encodings from {}".format(args.encodingPath))
+    encodingStore = EncodingStore( args.encodingStore, readOnly = True ) if args.encodingStore else None
+    persons = MultiModelPredictor.loadPersons( args.encodingPath, recursive = True, encodingStore = encodingStore )
+    if len(persons) == 0:
+        raise Exception( "No encodings found in {}".format(args.encodingPath) )
+
+    # Every person gives one sample with all of their faces, plus samples with
+    # random subsets of them, as foto2vam sees people with fewer photos
+    samples = []
+    for person in persons:
+        samples.append( person )
+        for idx in range(args.samplesPerPerson - 1):
+            faces = random.sample( person.faces, random.randint( 1, len(person.faces) ) )
+            samples.append( Person( person.name, person.relPath, faces ) )
+
+    print( "Generating teacher predictions for {} samples from {} people".format(len(samples), len(persons)))
+    X, Y, samples, heads = createDataSet( samples, inputConfig, teacherModels )
+    print( "Shared inputs: {}, outputs: {} from {} heads".format(X.shape[1], Y.shape[1], len(heads)))
+
+    # Hold out whole people, so the reported accuracy is for people never trained on
+    personNames = sorted( set( sample.name for sample in samples ) )
+    random.shuffle( personNames )
+    validationNames = set( personNames[:max( 1, int( len(personNames) * args.validationSplit ) )] )
+    isValidation = numpy.array( [ sample.name in validationNames for sample in samples ] )
+    vX, vY = X[isValidation], Y[isValidation]
+    tX, tY = X[~isValidation], Y[~isValidation]
+    print( "Training on {} samples, validating on {}".format(len(tX), len(vX)))
+
+    # Delay heavy imports
+    import tensorflow as tf
+    tfconfig = tf.ConfigProto()
+    tfconfig.gpu_options.allow_growth = True
+    session = tf.Session(config=tfconfig)
+
+    trunkSizes = [ int(size) for size in args.trunkSizes.split(',') ]
+    model = generateModel( X.shape[1], Y.shape[1], trunkSizes )
+    for epoch in range( 0, args.epochs, args.epochsPerReport ):
+        model.fit( tX, tY, epochs=args.epochsPerReport, batch_size=args.batchSize, verbose=0, shuffle=True )
+        print( "Epoch {}: training loss {:.5f}, validation loss {:.5f}".format( epoch + args.epochsPerReport,
+               float( model.evaluate( tX, tY, verbose=0 ) ), float( model.evaluate( vX, vY, verbose=0 ) ) ) )
+
+    numpyModel = NumpyModel.fromKeras( model )
+    bundle = ModelBundle.create( numpyModel, inputConfig, [ ( teacher.name, teacher.config, end - start ) for teacher, ( start, end ) in heads ] )
+    bundle.save( args.outputFile )
+    print( "Saved {}".format(args.outputFile))
+
+    reportAccuracy( numpyModel, vX, vY, heads )
+    reportSpeed( args, modelFiles, teachers, [ sample for sample in samples if sample.name in validationNames ] )
+    print( "Use it with --modelPath {} in place of {}".format(args.outputFile, args.modelPath))
+
+# Inputs and concatenated teacher outputs for every sample which all teachers can
+# predict, along with those samples
+def createDataSet( samples, inputConfig, teacherModels ):
+    from Utils.Prediction.predictor import PredictionModel
+
+    # Only used to generate rows from the shared inputs
+    student = PredictionModel( "distilled", None, inputConfig )
+    rows = []
+    teacherRows = [ [] for teacher in teacherModels ]
+    usedSamples = []
+    for sample in samples:
+        try:
+            row = student.generateRow( sample )
+            sampleRows = [ teacher.generateRow( sample ) for teacher in teacherModels ]
+        except Exception:
+            continue
+        rows.append( row )
+        for idx, teacherRow in enumerate(sampleRows):
+            teacherRows[idx].append( teacherRow )
+        usedSamples.append( sample )
+
+    if len(rows) == 0:
+        raise Exception( "No samples had encodings for every angle the models need" )
+
+    targets = []
+    heads = []
+    start = 0
+    for teacher, teacherRow in zip( teacherModels, teacherRows ):
+        predictions = numpy.asarray( teacher.predict( teacherRow ), dtype=numpy.float32 )
+        targets.append( predictions )
+        heads.append( ( teacher, ( start, start + predictions.shape[1] ) ) )
+        start += predictions.shape[1]
+
+    return numpy.array( rows, dtype=numpy.float32 ), numpy.concatenate( targets, axis=1 ), usedSamples, heads
+
+def generateModel( numInputs, numOutputs, trunkSizes ):
+    from keras.models import Model
+    from keras.optimizers import Adam
+    from keras.layers import Input, Dense, Dropout, LeakyReLU
+
+    print("Generating a model with {} inputs, trunk {} and {} outputs".format(numInputs, trunkSizes, numOutputs))
+    input_layer = Input(shape=(numInputs,))
+    x = input_layer
+    for size in trunkSizes:
+        x = Dense( size, activation='linear' )(x)
+        x = LeakyReLU()(x)
+        x = Dropout(.1)(x)
+
+    # The heads are each a slice of this layer, so the exported model stays a single chain
+    output_layer = Dense( numOutputs, activation='linear')(x)
+
+    model = Model(inputs=input_layer, outputs=output_layer)
+    adam = Adam(lr=0.0001)
+    model.compile( optimizer=adam,
+                   loss='logcosh' )
+
+    return model
+
+def reportAccuracy( numpyModel, vX, vY, heads ):
+    predictions = numpyModel.predict( vX )
+    print( "Accuracy against the original models on {} held out samples:".format(len(vX)))
+    print( "{:<40}{:>8}{:>12}{:>12}{:>12}".format( "head", "outputs", "mean abs", "p99 abs", "max abs" ) )
+    for teacher, ( start, end ) in heads:
+        errors = numpy.abs( predictions[:, start:end] - vY[:, start:end] )
+        print( "{:<40}{:>8}{:>12.5f}{:>12.5f}{:>12.5f}".format( teacher.name, end - start, float( numpy.mean(errors) ),
+               float( numpy.percentile(errors, 99) ), float( numpy.max(errors) ) ) )
+
+# Compare loading and predicting with the original models against the distilled one
+def reportSpeed( args, modelFiles, teachers, persons ):
+    from Utils.Prediction.predictor import MultiModelPredictor
+
+    start = time.time()
+    distilled = MultiModelPredictor( [ args.outputFile ] )
+    distilledLoadTime = time.time() - start
+    start = time.time()
+    MultiModelPredictor( modelFiles, useKeras = args.useKeras )
+    teacherLoadTime = time.time() - start
+
+    times = []
+    for predictor in ( teachers, distilled ):
+        start = time.time()
+        predictor.predict( persons )
+        times.append( time.time() - start )
+    print( "Load: {} models {:.3f}s, distilled {:.3f}s".format(len(modelFiles), teacherLoadTime, distilledLoadTime))
+    print( "Predict {} people: {} models {:.3f}s, distilled {:.3f}s".format(len(persons), len(modelFiles), times[0], times[1]))
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Distill models into one network with a head per model" )
+    parser.add_argument('--modelPath', help="Path to the models to distill, can include wildcard", default=os.path.join("models", "*.model") )
+    parser.add_argument('--encodingPath', help="Directory with one subdirectory of .encoding files per person", required=True)
+    parser.add_argument('--encodingStore', help="Encoding store to read the encodings of images under encodingPath from, instead of .encoding files", default=None)
+    parser.add_argument('--outputFile', help="Distilled bundle to write", default=os.path.join("models", "distilled.bundle") )
+    parser.add_argument('--trunkSizes', help="Comma separated sizes of the shared layers. Defaults to 1024,1024", default="1024,1024")
+    parser.add_argument('--samplesPerPerson', type=int, help="Samples to make from random subsets of each person's faces. Defaults to 20", default=20)
+    parser.add_argument('--validationSplit', type=float, help="Fraction of people held out to report accuracy. Defaults to 0.1", default=0.1)
+    parser.add_argument('--epochs', type=int, help="Training epochs. Defaults to 500", default=500)
+    parser.add_argument('--epochsPerReport', type=int, help="Epochs between loss reports. Defaults to 25", default=25)
+    parser.add_argument('--batchSize', type=int, help="Training batch size. Defaults to 256", default=256)
+    parser.add_argument("--useKeras", action='store_true', default=False, help="Predict with Keras even if models have been exported for NumPy")
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    return parser.parse_args()
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
@@ -0,0 +1,124 @@
+# Export Keras models to NumPy arrays so predictions don't need TensorFlow
+import argparse
+import glob
+import os
+import time
+import numpy
+from Utils.Prediction.numpy_model import NumpyModel
+from Utils.Prediction.bundle import ModelBundle
+from Utils.Training.config import Config
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    # Delay heavy imports, timing them since they're part of Keras' cold start
+    start = time.time()
+    from keras.models import load_model
+    import tensorflow as tf
+    kerasImportTime = time.time() - start
+
+    # Work around low-memory GPU issue
+    tfconfig = tf.ConfigProto()
+    tfconfig.gpu_options.allow_growth = True
+    session = tf.Session(config=tfconfig)
+
+    numFailed = 0
+    for modelFile in glob.glob( args.modelPath ):
+        exportFile = NumpyModel.getExportPath( modelFile )
+        start = time.time()
+        kerasModel = load_model( modelFile )
+        kerasLoadTime = time.time() - start
+
+        try:
+            NumpyModel.fromKeras( kerasModel ).save( exportFile )
+        except Exception as e:
+            print( "Failed to export {} - {}".format(modelFile, str(e)) )
+            numFailed += 1
+            continue
+
+        start = time.time()
+        numpyModel = NumpyModel.load( exportFile )
+        numpyLoadTime = time.time() - start
+
+        # Check the export against Keras on random inputs
+        rows = numpy.random.uniform( -1, 1, ( args.numRows, numpyModel.getInputSize() ) ).astype(numpy.float32)
+        expected = kerasModel.predict( rows )
+        actual = numpyModel.predict( rows )
+        maxDiff = float( numpy.max( numpy.abs( expected - actual ) ) )
+        allowed = args.tolerance * max( 1.0, float( numpy.max( numpy.abs(expected) ) ) )
+        matches = maxDiff <= allowed
+        print( "Exported {} to {}: max difference from Keras {:.3g} ({})".format(modelFile, exportFile, maxDiff, "ok" if matches else "MISMATCH") )
+        if not matches:
+            numFailed += 1
+            continue
+
+        # Bundle the weights with the config so predicting doesn't need any look JSON
+        configFile = os.path.splitext(modelFile)[0] + ".json"
+        if os.path.exists( configFile ):
+            bundleFile = ModelBundle.getBundlePath( modelFile )
+            ModelBundle.create( numpyModel, Config.createFromFile( configFile ) ).save( bundleFile )
+            bundle = ModelBundle.load( bundleFile )
+            bundle.createConfig()
+            if not numpy.array_equal( bundle.getNumpyModel().predict( rows ), actual ):
+                print( "  Bundle {} predictions don't match the export!".format(bundleFile) )
+                numFailed += 1
+                continue
+            print( "  Bundled with {} as {}".format(configFile, bundleFile) )
+        else:
+            print( "  No config {}, not creating a bundle".format(configFile) )
+
+        if args.benchmark:
+            print( "  Cold start: Keras {:.3f}s (+{:.3f}s importing TensorFlow/Keras), NumPy {:.3f}s".format(kerasLoadTime, kerasImportTime, numpyLoadTime) )
+            if os.path.exists( configFile ):
+                start = time.time()
+                Config.createFromFile( configFile )
+                configTime = time.time() - start
+                start = time.time()
+                bundle = ModelBundle.load( ModelBundle.getBundlePath( modelFile ) )
+                bundle.createConfig()
+                bundle.getNumpyModel()
+                print( "  Model + config load: separate files {:.3f}s, bundle {:.3f}s".format(numpyLoadTime + configTime, time.time() - start) )
+            for name, model in ( ( "Keras", kerasModel ), ( "NumPy", numpyModel ) ):
+                singleTime = timePredict( model, rows[:1], args.repeat )
+                batchTime = timePredict( model, rows, args.repeat )
+                print( "  {}: {:.3f}ms for 1 row, {:.4f}ms per row in batches of {}".format(name, 1000 * singleTime, 1000 * batchTime / len(rows), len(rows)) )
+
+    if numFailed > 0:
+        raise SystemExit( "{} models failed to export".format(numFailed) )
+
+def timePredict( model, rows, repeat ):
+    # Run once first so one-time setup isn't counted
+    model.predict( rows )
+    start = time.time()
+    for _ in range(repeat):
+        model.predict( rows )
+    return ( time.time() - start ) / repeat
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Export Keras models, and bundles with their configs, for NumPy-only prediction" )
+    parser.add_argument('--modelPath', help="Path to model, can include wildcard", required=True)
+    parser.add_argument('--tolerance', type=float, help="Largest allowed difference from Keras, relative to the largest output. Defaults to 1e-4", default=1e-4)
+    parser.add_argument('--numRows', type=int, help="Random rows to check the export with. Defaults to 1024", default=1024)
+    parser.add_argument("--benchmark", action='store_true', default=False, help="Compare load time and prediction latency against Keras")
+    parser.add_argument('--repeat', type=int, help="Benchmark repetitions. Defaults to 20", default=20)
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    return parser.parse_args()
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
@@ -1,9 +1,12 @@
 # Generate training data from existing faces
-from Utils.Training.config import Config
 import argparse
 import os
-import numpy
+import json
+import time
 import random
+import threading
+import multiprocessing
+import concurrent.futures
 
 ###############################
 # Run the program
@@ -15,86 +18,141 @@ def main( args ):
         pydevd.settrace(suspend=False)
 
     modelFile = args.modelFile
-    modelCfg = os.path.splitext(modelFile)[0] + ".json"
-    config = Config.createFromFile( modelCfg )
     inputDir = args.inputDir
-    recursive = args.recursive
     outputDir = args.outputDir
-    multiDir = args.multiDir
 
     # Delay heavy imports
-    from keras.models import load_model
-
-    # Work around low-memory GPU issue
-    import tensorflow as tf
-    tfconfig = tf.ConfigProto()
-    tfconfig.gpu_options.allow_growth = True
-    session = tf.Session(config=tfconfig)
-
-    model = load_model(modelFile)
-    modelName = os.path.splitext(os.path.basename(modelFile))[0]
-    baseName = ""
-
-    face = config.getBaseFace()
-    # Read in all of the files from inputDir
+    from Utils.Prediction.predictor import MultiModelPredictor
+
+    # Rows are generated in worker processes, in the order of the directory walk. The
+    # workers only need the input config, and are started before the models load so
+    # none of them inherits TensorFlow
+    inputConfig = MultiModelPredictor.loadInputConfig( modelFile, useKeras = args.useKeras )
+    start = time.time()
+    workItems = findWorkItems( inputDir, args.recursive, args.multiDir, args.skipChance )
+    if args.numProcesses > 0:
+        pool = multiprocessing.Pool( args.numProcesses, initializer=initRowWorker, initargs=( inputConfig, args.encodingStore ) )
+        rowResults = pool.imap( generateRow, workItems, chunksize = 4 )
+    else:
+        pool = None
+        initRowWorker( inputConfig, args.encodingStore )
+        rowResults = map( generateRow, workItems )
+
+    # A distilled bundle loads as one model per head, all predicted at once
+    predictionModels = MultiModelPredictor( [ modelFile ], useKeras = args.useKeras ).getModels()
+
+    writer = LookWriter( args.writeThreads, args.maxPendingWrites )
+    numPersons = 0
+
+    batch = []
+    for workItem, outRow, error in rowResults:
+        if error is not None:
+            print( "ERROR: Failed to generate model from {} - {}".format(workItem[0], error ) )
+            continue
+        batch.append( ( workItem, outRow ) )
+        if len(batch) >= args.batchSize:
+            numPersons += predictBatch( batch, predictionModels, outputDir, inputDir, writer )
+            batch = []
+    if len(batch) > 0:
+        numPersons += predictBatch( batch, predictionModels, outputDir, inputDir, writer )
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    writer.close()
+
+    elapsed = time.time() - start
+    print( "Predicted {} people with {} models in {:.2f} seconds, {:.2f} people/second".format(numPersons, len(predictionModels), elapsed, numPersons / elapsed if elapsed > 0 else 0) )
+
+# Yield ( root, folderName, relatedFiles ) for every prediction to make. Samples
+# are skipped and related files found as when predicting one directory at a time
+def findWorkItems( inputDir, recursive, multiDir, skipChance ):
     for root, subdirs, files in os.walk(inputDir):
         for file in files:
-            try:
-                skipSample = random.random() < args.skipChance
-                relatedFiles = []
-                if multiDir:
-                    if skipSample:
-                        continue
-                    if not file.endswith(".json"):
-                        continue
-                    baseName = os.path.splitext( file )[0]
-                    for rfile in filter( lambda x: x.startswith(baseName), files ):
-                        relatedFiles.append(  os.path.join(root,rfile ) )
-                else:
-                    if skipSample:
-                        break
-                    for rfile in files:
-                        relatedFiles.append( os.path.join(root, rfile ) )
-
-
-                outRow = config.generateParams( relatedFiles )
-                outShape = config.getShape()
-                dataSet = numpy.array([outRow[:outShape[0]]])
-                predictions = model.predict(dataSet)
-                rounded = [float(round(x,5)) for x in predictions[0]]
-                face.importFloatList(rounded)
+            skipSample = random.random() < skipChance
+            relatedFiles = []
+            if multiDir:
+                if skipSample:
+                    continue
+                if not file.endswith(".json"):
+                    continue
+                # In multiDir, the 'folder' is the baseName of the file
+                baseName = os.path.splitext( file )[0]
+                for rfile in filter( lambda x: x.startswith(baseName), files ):
+                    relatedFiles.append(  os.path.join(root,rfile ) )
+                yield ( root, baseName, relatedFiles )
+            else:
+                if skipSample:
+                    break
+                for rfile in files:
+                    relatedFiles.append( os.path.join(root, rfile ) )
+                yield ( root, os.path.split(root)[-1], relatedFiles )
+                # If not multiDir then we've already processed all of the files
+                break
 
+        if not recursive:
+            break
+
+_workerConfig = None
+_workerStore = None
+
+def initRowWorker( inputConfig, encodingStorePath ):
+    from Utils.Face.encoding_store import EncodingStore
+    global _workerConfig, _workerStore
+    _workerConfig = inputConfig
+    _workerStore = EncodingStore( encodingStorePath, readOnly = True ) if encodingStorePath else None
+
+def generateRow( workItem ):
+    try:
+        outRow = _workerConfig.generateParams( workItem[2], encodingStore = _workerStore )
+        return workItem, outRow[:_workerConfig.getShape()[0]], None
+    except Exception as e:
+        return workItem, None, str(e)
+
+# Predict a batch of rows with a single call, then queue the looks to be written
+def predictBatch( batch, predictionModels, outputDir, inputDir, writer ):
+    outputs = predictionModels[0].runModel( [ outRow for workItem, outRow in batch ] )
+    for predictionModel in predictionModels:
+        predictions = predictionModel.selectOutputs( outputs )
+        for ( root, folderName, relatedFiles ), prediction in zip( [ workItem for workItem, outRow in batch ], predictions ):
+            try:
                 outName = root.lstrip(inputDir)
                 outName = outName.lstrip('/')
                 outName = outName.lstrip('\\')
                 outputFolder = os.path.join( outputDir, outName )
-                try:
-                    os.makedirs(outputFolder)
-                except:
-                    pass
+                outputFullPath = os.path.join( outputFolder, "{}_{}.json".format(folderName, predictionModel.name))
 
-                # In multiDir, the 'folder' is the baseName of the file
-                if multiDir:
-                    folderName = baseName
-                else:
-                    folderName = os.path.split(root)[-1]
-
-                outputFullPath = os.path.join( outputFolder, "{}_{}.json".format(folderName, modelName))
-                # discard animatable flags
-                face.updateJson( discardAnimatable = True )
-                face.save( outputFullPath )
-                print( "Generated {}".format(outputFullPath) )
+                rounded = [float(round(x,5)) for x in prediction]
+                # The predicted face is shared, so it is serialized here rather than by the writers
+                face = predictionModel.getPredictedFace( rounded )
+                writer.write( outputFullPath, json.dumps( face.jsonData, indent=3 ) )
             except Exception as e:
                 print( "ERROR: Failed to generate model from {} - {}".format(root, str(e) ) )
+    return len(batch)
 
-            # If not multiDir then we've already processed all of the files
-            if not multiDir:
-                break
+# Write files from a pool of threads, blocking once maxPending are waiting
+class LookWriter:
+    def __init__(self, numThreads, maxPending):
+        self._executor = concurrent.futures.ThreadPoolExecutor( max_workers = numThreads )
+        self._pending = threading.BoundedSemaphore( maxPending )
 
-        if not args.recursive:
-            break
+    def write(self, path, text):
+        self._pending.acquire()
+        future = self._executor.submit( LookWriter._writeFile, path, text )
+        future.add_done_callback( lambda f: self._pending.release() )
 
+    @staticmethod
+    def _writeFile( path, text ):
+        try:
+            os.makedirs( os.path.dirname(path), exist_ok=True )
+            with open(path, 'w') as outfile:
+                outfile.write( text )
+            print( "Generated {}".format(path) )
+        except Exception as e:
+            print( "ERROR: Failed to write {} - {}".format(path, str(e)) )
 
+    def close(self):
+        self._executor.shutdown( wait = True )
 
 
 ###############################
@@ -102,12 +160,18 @@ def main( args ):
 #
 def parseArgs():
     parser = argparse.ArgumentParser( description="Generate a VaM model from a face encoding" )
-    parser.add_argument('--modelFile', help="Model to use for predictions", required=True)
+    parser.add_argument('--modelFile', help="Model to use for predictions. A distilled .bundle predicts for each of its heads", required=True)
     parser.add_argument('--inputDir', help="Directory containing input encodings", required=True)
     parser.add_argument("--recursive", action='store_true', default=False, help="Iterate to subdirectories of input path")
     parser.add_argument('--outputDir', help="Output VaM files directory", required=True)
     parser.add_argument("--multiDir", action='store_true', default=False, help="Allow multiple predictions per directory. Assume supporting files start with json files name")
     parser.add_argument("--skipChance", type=float, default=0.0, help="Chance to skip generating a model. Used for training set sampling. Defaults to 0.0")
+    parser.add_argument('--encodingStore', help="Encoding store to read encodings from, as well as .encoding files", default=None)
+    parser.add_argument('--batchSize', type=int, help="Rows to predict with a single call. Defaults to 512", default=512)
+    parser.add_argument('--numProcesses', type=int, help="Processes generating rows, 0 to generate them in this process. Defaults to the number of CPUs", default=multiprocessing.cpu_count())
+    parser.add_argument('--writeThreads', type=int, help="Threads writing output looks. Defaults to 4", default=4)
+    parser.add_argument('--maxPendingWrites', type=int, help="Most looks waiting to be written before predicting pauses. Defaults to 1024", default=1024)
+    parser.add_argument("--useKeras", action='store_true', default=False, help="Predict with Keras even if the model has been exported for NumPy")
     parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
 
 
@@ -119,4 +183,4 @@ def parseArgs():
 #
 if __name__ == "__main__":
     args = parseArgs()
-    main( args )
\ No newline at end of file
+    main( args )
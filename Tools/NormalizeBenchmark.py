@@ -0,0 +1,100 @@
+# Compare face normalization with and without coarse-to-fine detection on a set of images
+import argparse
+import fnmatch
+import os
+import time
+import numpy
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    # Delay heavy imports
+    from PIL import Image
+    from Utils.Face.normalize import FaceNormalizer
+    from Utils.Face.detect import FaceDetector
+    from Utils.Process.stage_timer import StageTimer
+
+    # Images are decoded once up front, so only normalization is timed
+    images = []
+    for fileName in findImages( args ):
+        images.append( FaceNormalizer.decodeImage( Image.open(fileName), FaceNormalizer.WORK_WIDTH ) )
+    if len(images) == 0:
+        raise Exception( "No images found in {}".format(args.inputPath) )
+    print( "Loaded {} images".format(len(images)) )
+
+    results = {}
+    for name, coarseWidth in ( ( "full", 0 ), ( "coarse", args.coarseWidth ) ):
+        normalizer = FaceNormalizer( args.normalizeSize, coarseWidth = coarseWidth, detector = FaceDetector( args.detectors ) )
+        timer = StageTimer()
+        best = None
+        for _ in range(args.repeat):
+            detections = []
+            start = time.time()
+            for npImg in images:
+                try:
+                    detections.append( normalizer.normalizeArray( npImg, timer )[1] )
+                except Exception:
+                    detections.append( None )
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results[name] = ( best, detections )
+        print( "{} detection, stages over {} runs:".format( name, args.repeat ) )
+        timer.printStats()
+        normalizer.getDetector().getStats().printStats()
+
+    print( "{:<12}{:>12}{:>16}{:>10}".format( "detection", "seconds", "images/second", "faces" ) )
+    for name, ( elapsed, detections ) in results.items():
+        numFound = sum( 1 for detection in detections if detection is not None )
+        print( "{:<12}{:>12.2f}{:>16.2f}{:>10}".format( name, elapsed, len(images) / elapsed if elapsed > 0 else 0, numFound ) )
+    print( "Speedup: {:.2f}x".format( results["full"][0] / max( results["coarse"][0], 1e-9 ) ) )
+
+    # Where both found the face, how far apart the landmarks are in the normalized image
+    distances = [ numpy.linalg.norm( full.points - coarse.points, axis=1 ).mean() for full, coarse in zip( results["full"][1], results["coarse"][1] )
+                  if full is not None and coarse is not None ]
+    if len(distances) > 0:
+        print( "Landmark difference (pixels): mean {:.3f}, max {:.3f} over {} faces".format( float( numpy.mean(distances) ), float( numpy.max(distances) ), len(distances) ) )
+
+def findImages( args ):
+    fileFilter = args.filter.split(',')
+    fileNames = []
+    for root, subdirs, files in os.walk(args.inputPath):
+        for filter in fileFilter:
+            for file in fnmatch.filter(files, filter):
+                if not os.path.splitext(file)[0].endswith("normalized"):
+                    fileNames.append( os.path.join(root, file) )
+        if not args.recursive:
+            break
+    return sorted(fileNames)[:args.numImages] if args.numImages > 0 else sorted(fileNames)
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Benchmark face normalization with and without coarse-to-fine detection" )
+    parser.add_argument('--inputPath', help="Directory of fixture images", required=True)
+    parser.add_argument('--filter', help="File filter to process. Defaults to \"*.png,*.jpg\"", default="*.png,*.jpg")
+    parser.add_argument("--recursive", action='store_true', default=False, help="Recursively enter directories")
+    parser.add_argument('--numImages', type=int, help="Most images to use, 0 for all of them. Defaults to 0", default=0)
+    parser.add_argument('--normalizeSize', type=int, help="Size of normalized output. Defaults to 150", default=150)
+    parser.add_argument('--coarseWidth', type=int, help="Width faces are first looked for at. Defaults to 200", default=200)
+    parser.add_argument("--detectors", help="Face detectors tried in order until one finds a face, as model:upsample with models hog or cnn. Defaults to hog:1", default="hog:1")
+    parser.add_argument('--repeat', type=int, help="Times to normalize the images with each, keeping the fastest. Defaults to 3", default=3)
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    return parser.parse_args()
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
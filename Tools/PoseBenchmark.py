@@ -0,0 +1,121 @@
+# Compare batched head pose estimation against one cv2.solvePnP per face
+import argparse
+import os
+import time
+import numpy
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    # Delay heavy imports
+    from Utils.Face.pose import HeadPose
+
+    imageSize = ( args.imageSize, args.imageSize )
+    if args.encodingPath or args.encodingStore:
+        imagePoints = HeadPose.getImagePoints( loadLandmarks( args ) )
+        truth = None
+        print( "Loaded {} faces".format(len(imagePoints)) )
+    else:
+        imagePoints, truth = createRandomFaces( args.numFaces, imageSize, args.noise )
+        print( "Generated {} random faces".format(len(imagePoints)) )
+    if len(imagePoints) == 0:
+        raise Exception( "No faces to estimate the pose of" )
+
+    _, _, converged = HeadPose.solve( imagePoints, imageSize, args.iterations )
+    print( "{} of {} faces didn't converge and are solved with solvePnP".format( int( numpy.sum( ~converged ) ), len(imagePoints) ) )
+
+    best = {}
+    for _ in range(args.repeat):
+        for name, estimate in ( ( "solvePnP", lambda: HeadPose.estimateWithSolvePnP( imagePoints, imageSize ) ),
+                                ( "batched", lambda: HeadPose.estimate( imagePoints, imageSize, args.iterations ) ) ):
+            start = time.time()
+            angles = estimate()
+            elapsed = time.time() - start
+            if name not in best or elapsed < best[name][0]:
+                best[name] = ( elapsed, angles )
+
+    print( "{:<12}{:>12}{:>14}".format( "solver", "seconds", "faces/second" ) )
+    for name, ( elapsed, angles ) in best.items():
+        print( "{:<12}{:>12.4f}{:>14.0f}".format( name, elapsed, len(imagePoints) / elapsed if elapsed > 0 else 0 ) )
+    print( "Speedup: {:.1f}x".format( best["solvePnP"][0] / max( best["batched"][0], 1e-9 ) ) )
+
+    # Only the angle the face is turned by is used, so that is what is compared
+    print( "{:<24}{:>12}{:>12}{:>12}".format( "angle error (degrees)", "mean abs", "p99 abs", "max abs" ) )
+    reportError( "batched vs solvePnP", best["batched"][1][1], best["solvePnP"][1][1] )
+    if truth is not None:
+        reportError( "solvePnP vs truth", best["solvePnP"][1][1], truth )
+        reportError( "batched vs truth", best["batched"][1][1], truth )
+
+def reportError( name, angles, expected ):
+    errors = numpy.abs( angles - expected )
+    print( "{:<24}{:>12.4f}{:>12.4f}{:>12.4f}".format( name, float( numpy.mean(errors) ), float( numpy.percentile(errors, 99) ), float( numpy.max(errors) ) ) )
+
+# (N,68,2) landmark points from .encoding files and an encoding store
+def loadLandmarks( args ):
+    from Utils.Face.encoded import EncodedFace
+    from Utils.Face.encoding_store import EncodingStore
+
+    landmarks = []
+    if args.encodingStore:
+        store = EncodingStore( args.encodingStore, readOnly = True )
+        for faces in store.getFacesByDirectory().values():
+            landmarks.extend( faces.getLandmarkArrays() )
+    if args.encodingPath:
+        for root, subdirs, files in os.walk(args.encodingPath):
+            for file in files:
+                if file.endswith(".encoding"):
+                    face = EncodedFace.createFromFile( os.path.join( root, file ) )
+                    landmarks.append( face.getLandmarkArray() )
+    return numpy.array( landmarks ).reshape( ( -1, 68, 2 ) )
+
+# Image points of the head model seen in random poses, with pixel noise added, and
+# the angle each face was turned by
+def createRandomFaces( numFaces, imageSize, noise ):
+    from Utils.Face.pose import HeadPose
+
+    # Turned, tilted and rolled from facing the camera, which flips the model's y and z
+    angles = numpy.radians( numpy.stack( ( numpy.random.uniform( -15, 15, numFaces ),
+                                           numpy.random.uniform( -60, 60, numFaces ),
+                                           numpy.random.uniform( -20, 20, numFaces ) ), axis=1 ) )
+    rotations = numpy.matmul( HeadPose.rodrigues( angles ), numpy.diag( [ 1.0, -1.0, -1.0 ] ) )
+    # Far enough away that the face fills about half of the image
+    translations = numpy.stack( ( numpy.random.uniform( -50, 50, numFaces ),
+                                  numpy.random.uniform( -50, 50, numFaces ),
+                                  numpy.random.uniform( 800, 1600, numFaces ) ), axis=1 )
+
+    camera = numpy.einsum( 'nij,pj->npi', rotations, HeadPose.MODEL_POINTS ) + translations[:, None, :]
+    height, width = imageSize
+    imagePoints = camera[..., :2] / camera[..., 2:] * width + ( width / 2, height / 2 )
+    imagePoints += numpy.random.normal( 0, noise, imagePoints.shape )
+    return imagePoints, HeadPose.rotationsToAngles( rotations )[1]
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Benchmark batched head pose estimation against cv2.solvePnP" )
+    parser.add_argument('--encodingPath', help="Directory of .encoding files to take landmarks from. Random faces are used if neither this nor an encoding store is given", default=None)
+    parser.add_argument('--encodingStore', help="Encoding store to take landmarks from", default=None)
+    parser.add_argument('--imageSize', type=int, help="Width and height of the encoded images. Defaults to 150, the default normalized size", default=150)
+    parser.add_argument('--numFaces', type=int, help="Number of random faces. Defaults to 10000", default=10000)
+    parser.add_argument('--noise', type=float, help="Pixel noise added to random faces. Defaults to 1.0", default=1.0)
+    parser.add_argument('--iterations', type=int, help="Refinement steps of the batched solver. Defaults to 10", default=10)
+    parser.add_argument('--repeat', type=int, help="Times to run each solver, keeping the fastest. Defaults to 3", default=3)
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    return parser.parse_args()
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
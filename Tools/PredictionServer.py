@@ -0,0 +1,156 @@
+# Serve VaM look predictions on localhost, or load test a running server
+import argparse
+import base64
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    if args.loadTest:
+        loadTest( args )
+    else:
+        serve( args )
+
+
+###############################
+# Keep models loaded and answer prediction requests
+#
+def serve( args ):
+    from Utils.Prediction.predictor import MultiModelPredictor
+    from Utils.Prediction.server import PredictionServer
+
+    modelFiles = glob.glob( args.modelPath )
+    print( "Loading {} models".format(len(modelFiles)))
+    multiPredictor = MultiModelPredictor( modelFiles, useKeras = args.useKeras )
+
+    encodeArgs = argparse.Namespace(normalizeSize=150, normalize=True, numJitters=10, jitterEpsilon=0.02, debugPose = False, flipFirst = False, saveEncodings = False,
+                                    requirements = multiPredictor.getRequirements())
+    server = PredictionServer( ( "127.0.0.1", args.port ), multiPredictor, args.defaultJson, encodeArgs,
+                               maxBatchSize = args.maxBatchSize, maxWait = args.maxWaitMs / 1000.0, encodeThreads = args.encodeThreads )
+    print( "Serving predictions on http://127.0.0.1:{}/predict, statistics on /stats. Press CTRL+C to exit".format(args.port) )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    server.stats.printReport()
+
+
+###############################
+# Load generator
+#
+def readPersons( imagePath ):
+    persons = []
+    for root, subdirs, files in os.walk(imagePath):
+        images = []
+        for file in files:
+            if file.endswith( ( '.png', '.jpg' ) ) and not os.path.splitext(file)[0].endswith("normalized"):
+                with open( os.path.join(root, file), 'rb' ) as f:
+                    images.append( base64.b64encode( f.read() ).decode('ascii') )
+        if len(images) > 0:
+            persons.append( ( os.path.basename(root), images ) )
+    return persons
+
+def sendRequest( url, name, images ):
+    body = json.dumps( { "name": name, "images": images } ).encode('utf-8')
+    request = urllib.request.Request( url, data=body, headers={ "Content-Type": "application/json" } )
+    start = time.time()
+    try:
+        with urllib.request.urlopen( request ) as response:
+            response.read()
+        ok = True
+    except Exception:
+        ok = False
+    return ok, time.time() - start
+
+def loadTest( args ):
+    from Utils.Prediction.server import LatencyStats
+
+    baseUrl = "http://127.0.0.1:{}".format(args.port)
+    persons = readPersons( args.imagePath )
+    if len(persons) == 0:
+        raise Exception( "No images found in {}".format(args.imagePath) )
+
+    print( "Sending {} requests from {} people with concurrency {}".format(args.numRequests, len(persons), args.concurrency) )
+    stats = LatencyStats()
+    numFailed = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor( max_workers=args.concurrency ) as executor:
+        futures = [ executor.submit( sendRequest, baseUrl + "/predict", *persons[idx % len(persons)] ) for idx in range(args.numRequests) ]
+        for future in concurrent.futures.as_completed(futures):
+            ok, elapsed = future.result()
+            stats.record( "request", elapsed )
+            if not ok:
+                numFailed += 1
+    elapsed = time.time() - start
+
+    print( "Server: {} requests ({} failed) in {:.2f} seconds, {:.2f} people/second".format(args.numRequests, numFailed, elapsed, args.numRequests / elapsed) )
+    stats.printReport()
+
+    print( "Server stage latencies:" )
+    with urllib.request.urlopen( baseUrl + "/stats" ) as response:
+        for stage, stage_stats in sorted( json.loads( response.read().decode('utf-8') ).items() ):
+            print( "{:>12}: n={:<7} mean={:.4f} p50={:.4f} p90={:.4f} p99={:.4f}".format(
+                   stage, stage_stats["count"], stage_stats["mean"], stage_stats["p50"], stage_stats["p90"], stage_stats["p99"] ) )
+
+    if args.compareCli:
+        compareCli( args, len(persons) )
+
+# Time foto2vam.py itself on the same images, from starting it to it exiting, writing into a
+# temporary directory. Every person in imagePath is predicted once, whatever numRequests is
+def compareCli( args, numPersons ):
+    cliScript = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ), "foto2vam.py" )
+    with tempfile.TemporaryDirectory() as outputPath:
+        command = [ sys.executable, cliScript, "--inputPath", args.imagePath, "--modelPath", args.modelPath, "--defaultJson", args.defaultJson,
+                    "--outputPath", os.path.join( outputPath, "Output" ), "--mergedOutputPath", os.path.join( outputPath, "Output_Merged" ) ]
+        if args.useKeras:
+            command.append( "--useKeras" )
+        start = time.time()
+        subprocess.run( command, check=True, stdout=subprocess.DEVNULL )
+        elapsed = time.time() - start
+    print( "foto2vam.py: {} people in {:.2f} seconds, {:.2f} people/second, including starting up and loading models".format(numPersons, elapsed, numPersons / elapsed if elapsed > 0 else 0) )
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Serve VaM look predictions on localhost" )
+    parser.add_argument('--modelPath', help="Path to model, can include wildcard", default=os.path.join("models", "*.model") )
+    parser.add_argument('--defaultJson', help="JSON file to copy base look from", default=os.path.join("mergeBase.json") )
+    parser.add_argument('--port', type=int, help="Port to listen on 127.0.0.1. Defaults to 8642", default=8642)
+    parser.add_argument('--maxBatchSize', type=int, help="Most people to predict in one batch. Defaults to 64", default=64)
+    parser.add_argument('--maxWaitMs', type=float, help="Longest time to wait for a batch to fill, in milliseconds. Defaults to 10", default=10.0)
+    parser.add_argument('--encodeThreads', type=int, help="Number of requests to encode images for at once, so batches can fill. Defaults to the number of CPUs", default=multiprocessing.cpu_count())
+    parser.add_argument("--useKeras", action='store_true', default=False, help="Predict with Keras even if models have been exported for NumPy")
+    parser.add_argument("--loadTest", action='store_true', default=False, help="Send requests to a running server instead of serving")
+    parser.add_argument('--imagePath', help="Load test: directory with one subdirectory of images per person", default="Input")
+    parser.add_argument('--numRequests', type=int, help="Load test: number of requests to send. Defaults to 100", default=100)
+    parser.add_argument('--concurrency', type=int, help="Load test: number of requests in flight. Defaults to 8", default=8)
+    parser.add_argument("--compareCli", action='store_true', default=False, help="Load test: also time running foto2vam.py on the same images")
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    return parser.parse_args()
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
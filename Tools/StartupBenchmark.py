@@ -0,0 +1,111 @@
+# Report how long each foto2vam tool takes to start, so slow imports are noticed
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+
+###############################
+# Run the program
+#
+def main( args ):
+    if args.pydev:
+        print("Enabling debugging with pydev")
+        import pydevd
+        pydevd.settrace(suspend=False)
+
+    sys.path.insert( 0, ROOT_DIR )
+    from foto2vam import TOOLS
+
+    toolNames = args.tools.split(',') if args.tools else sorted(TOOLS.keys())
+    # The root script itself, run without a tool
+    entries = [ ( "foto2vam", "foto2vam" ) ] + [ ( name, TOOLS[name][0] ) for name in toolNames ]
+
+    print( "{:<26}{:>12}{:>12}  {}".format( "tool", "import (s)", "--help (s)", "slowest imports" ) )
+    regressions = []
+    for name, moduleName in entries:
+        importTime, slowest = timeImport( moduleName, args.repeat )
+        helpArgs = [] if name == "foto2vam" else [ name ]
+        helpTime = timeHelp( helpArgs, args.repeat )
+        slowestText = ", ".join( "{} {:.2f}".format(module, seconds) for module, seconds in slowest[:args.numSlowest] )
+        print( "{:<26}{:>12}{:>12}  {}".format( name, formatTime(importTime), formatTime(helpTime), slowestText ) )
+        if args.maxSeconds and helpTime is not None and helpTime > args.maxSeconds:
+            regressions.append( name )
+
+    if len(regressions) > 0:
+        print( "Startup slower than {} seconds: {}".format( args.maxSeconds, ", ".join(regressions) ) )
+        sys.exit(1)
+
+def formatTime( seconds ):
+    return "failed" if seconds is None else "{:.3f}".format(seconds)
+
+# Import a module in a fresh interpreter. Returns the best wall time and the
+# slowest imports made directly by the module, from -X importtime
+def timeImport( moduleName, repeat ):
+    best = None
+    slowest = []
+    for _ in range(repeat):
+        start = time.time()
+        result = subprocess.run( [ sys.executable, "-X", "importtime", "-c", "import {}".format(moduleName) ],
+                                 cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True )
+        elapsed = time.time() - start
+        if result.returncode != 0:
+            return None, []
+        if best is None or elapsed < best:
+            best = elapsed
+            slowest = parseImportTime( result.stderr )
+    return best, slowest
+
+def parseImportTime( output ):
+    # Lines look like "import time:      self [us] |  cumulative | imported package",
+    # with nested imports indented two spaces beneath the module importing them
+    direct = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2]
+        depth = ( len(name) - len(name.lstrip()) - 1 ) // 2
+        # Only keep what the timed module imports itself. Depth 0 is the module
+        # and the interpreter's own startup imports
+        if depth == 1:
+            direct.append( ( name.strip(), int(fields[1]) / 1e6 ) )
+    return sorted( direct, key = lambda x: x[1], reverse = True )
+
+def timeHelp( toolArgs, repeat ):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = subprocess.run( [ sys.executable, os.path.join( ROOT_DIR, "foto2vam.py" ) ] + toolArgs + [ "--help" ],
+                                 cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+        elapsed = time.time() - start
+        if result.returncode != 0:
+            return None
+        best = elapsed if best is None else min( best, elapsed )
+    return best
+
+
+###############################
+# parse arguments
+#
+def parseArgs():
+    parser = argparse.ArgumentParser( description="Report startup time of each tool" )
+    parser.add_argument('--tools', help="Comma separated tools to time. Defaults to all", default=None)
+    parser.add_argument('--repeat', type=int, help="Runs per tool, the fastest is reported. Defaults to 3", default=3)
+    parser.add_argument('--numSlowest', type=int, help="Number of slowest imports to list per tool. Defaults to 3", default=3)
+    parser.add_argument('--maxSeconds', type=float, help="Exit with an error if any tool's --help takes longer than this", default=None)
+    parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+
+    return parser.parse_args()
+
+
+###############################
+# program entry point
+#
+if __name__ == "__main__":
+    args = parseArgs()
+    main( args )
@@ -3,17 +3,6 @@ import argparse
 import os
 import numpy
 import collections
-from keras.models import load_model, Model
-from keras.initializers import RandomUniform
-from keras.optimizers import Adam
-
-from keras.layers import Input, Dense, Dropout, BatchNormalization, LeakyReLU
-
-# Work around low-memory GPU issue
-import tensorflow as tf
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-session = tf.Session(config=config)
 
 ###############################
 # Run the program
@@ -24,6 +13,15 @@ def main( args ):
         import pydevd
         pydevd.settrace(suspend=False)
 
+    # Delay heavy imports
+    from keras.models import load_model
+
+    # Work around low-memory GPU issue
+    import tensorflow as tf
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    session = tf.Session(config=config)
+
     validationCsv = args.validationCsv
     trainingCsv = args.trainingCsv
     outputModelFile = args.outputFile
@@ -72,6 +70,10 @@ def main( args ):
         model.fit(X,Y, epochs=25, batch_size=256, verbose=0, shuffle=True)
 
 def generateModel( numInputs, numOutputs ):
+    from keras.models import Model
+    from keras.optimizers import Adam
+    from keras.layers import Input, Dense, Dropout, LeakyReLU
+
     print("Generating a model with {} inputs and {} outputs".format(numInputs, numOutputs))
     layer1 = 2*numInputs
     layer2 = 10*numInputs
@@ -9,6 +9,7 @@ import tempfile
 import shutil
 import time
 import random
+import re
 import copy
 import msgpack
 import gc
@@ -166,7 +167,9 @@ def getLooksFromPath( seedJsonPath, recursive = True ):
 
     return lookList
 
-def getEncodingsFromPaths( imagePaths, recursive = True, cache = False ):
+# With requirements, images VaM rendered at an angle where no encoding is read
+# only have their landmarks found
+def getEncodingsFromPaths( imagePaths, recursive = True, cache = False, requirements = None ):
     # We'll create a flat fileList, and placeholder arrays for the return encodings
     fileList = []
     encodings = []
@@ -184,7 +187,7 @@ def getEncodingsFromPaths( imagePaths, recursive = True, cache = False ):
 
     # Now batch create the encodings!
     if len(fileList) > 0:
-        batched_encodings = createEncodings( fileList )
+        batched_encodings = createEncodings( fileList, requirements )
 
     # Now unflatten the batched encodings
     idx = 0
@@ -196,14 +199,17 @@ def getEncodingsFromPaths( imagePaths, recursive = True, cache = False ):
     return encodings
 
 
-def createEncodings( fileList ):
+def createEncodings( fileList, requirements = None ):
     from PIL import Image
     from Utils.Face.encoded import EncodedFace
 
     imageList = []
     for file in fileList:
         imageList.append( np.array( Image.open(file) ) )
-    encodedFaces = EncodedFace.batchEncode( imageList, batch_size=64, keepImage = True )
+    needsEncoding = None
+    if requirements is not None:
+        needsEncoding = [ requirements.needsEncoding( angle ) if angle is not None else True for angle in map( getRenderAngle, fileList ) ]
+    encodedFaces = EncodedFace.batchEncode( imageList, batch_size=64, keepImage = True, needsEncoding = needsEncoding )
 
     return encodedFaces
 
@@ -319,7 +325,8 @@ def morphs_to_image_proc( config, inputQueue, outputQueue, tmpDir, doneEvent, ex
     vamFace = config.getBaseFace()
 
     inputCnt = config.getShape()[0]
-
+    # Angles no generator reads aren't rendered
+    requiredAngles = config.getRequirements().getAngles()
 
     while not doneEvent.is_set():
         try:
@@ -332,7 +339,7 @@ def morphs_to_image_proc( config, inputQueue, outputQueue, tmpDir, doneEvent, ex
             tmpdir = tempfile.mkdtemp( dir=tmpDir )
             jsonFile = os.path.join( tmpdir, "face.json" )
             vamFace.save( jsonFile )
-            vamWindow.loadLook( jsonFile, config.getAngles() )
+            vamWindow.loadLook( jsonFile, requiredAngles )
             vamWindow.syncPipe( vamWindow._pipe )
             outputQueue.put( tmpdir )
 
@@ -352,6 +359,7 @@ def image_to_encoding_proc( config, batchSize, inputQueue, outputQueue, training
     pathList = []
     inputCnt = config.getShape()[0]
     outputCnt = config.getShape()[1]
+    requirements = config.getRequirements()
     while not doneEvent.is_set():
         submitWork = False
         try:
@@ -363,7 +371,7 @@ def image_to_encoding_proc( config, batchSize, inputQueue, outputQueue, training
 
         if submitWork:
             try:
-                encodings = getEncodingsFromPaths( pathList, recursive=False, cache = False )
+                encodings = getEncodingsFromPaths( pathList, recursive=False, cache = False, requirements = requirements )
                 for data in zip( pathList, encodings ):
                     try:
                         if not validatePerson( data[1] ):
@@ -404,7 +412,14 @@ def validatePerson( encodingList ):
     return ok
 
 
+# The angle VaM rendered an image at, from its <look>_<angle>.png name, or None
+def getRenderAngle( fileName ):
+    match = re.search( r'_(-?\d+)\.png$', fileName )
+    return float( match.group(1) ) if match else None
+
 def samePerson( encodingList, tolerance=.6 ):
+     # Only faces which were given an encoding can be compared
+     encodingList = [ encoding for encoding in encodingList if encoding.hasEncoding() ]
      for idx,encoding in enumerate(encodingList):
          for encoding2 in encodingList[idx+1:]:
              if encoding.compare(encoding2) > tolerance:
@@ -0,0 +1,164 @@
+# Class to persist intermediate results, keyed on the content that produced them
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class ResultCache:
+    # Layers of cached results
+    ENCODING = "encoding"       # image bytes + normalize/jitter settings -> encoding json
+    ROW = "row"                 # encoding set + config -> input params
+    PREDICTION = "prediction"   # input params + model file -> predicted morphs
+    SCAN = "scan"               # image bytes + normalize/quality settings -> angle and quality score
+    LAYERS = [ ENCODING, ROW, PREDICTION, SCAN ]
+
+    # Returned by get() when there's no entry, since None is a valid cached value
+    MISSING = object()
+
+    # Check the cache size after this many puts
+    EVICT_CHECK_INTERVAL = 100
+    # Hit and miss counts are kept for this many of the most recent runs
+    STATS_RUNS = 50
+
+    def __init__(self, path, maxBytes = 1024*1024*1024, runId = None):
+        self._path = path
+        self._maxBytes = maxBytes
+        self._runId = runId if runId is not None else ResultCache.newRunId()
+        self._hits = {}
+        self._misses = {}
+        self._putsSinceCheck = 0
+        # ( layer, key ) -> when it was last read. Hits only update last_used along with
+        # the next write, so warm runs don't commit to the shared file on every lookup
+        self._touched = {}
+        for layer in ResultCache.LAYERS:
+            self._hits[layer] = 0
+            self._misses[layer] = 0
+
+        if os.path.dirname(path):
+            os.makedirs( os.path.dirname(path), exist_ok=True )
+        # Several worker processes can share one cache file. Within a process it's
+        # only used by one thread at a time, but not always the one that opened it
+        self._db = sqlite3.connect( path, timeout=60, check_same_thread=False )
+        self._db.execute( "CREATE TABLE IF NOT EXISTS entries ( layer TEXT, key TEXT, value BLOB, size INTEGER, last_used REAL, PRIMARY KEY (layer, key) )" )
+        self._db.execute( "CREATE INDEX IF NOT EXISTS entries_last_used ON entries ( last_used )" )
+        self._db.execute( "CREATE TABLE IF NOT EXISTS stats ( run TEXT, layer TEXT, hits INTEGER, misses INTEGER )" )
+        self._db.commit()
+
+    @staticmethod
+    def newRunId():
+        return "{}-{}".format( time.strftime("%Y%m%d-%H%M%S"), os.getpid() )
+
+    def getRunId(self):
+        return self._runId
+
+    @staticmethod
+    def hashBytes( *parts ):
+        hasher = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            hasher.update(part)
+            # Separate parts so ("ab","c") and ("a","bc") differ
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    @staticmethod
+    def hashJson( obj ):
+        return ResultCache.hashBytes( json.dumps( obj, sort_keys=True ) )
+
+    @staticmethod
+    def hashFile( path ):
+        hasher = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter( lambda: f.read(1024*1024), b'' ):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def get(self, layer, key):
+        row = self._db.execute( "SELECT value FROM entries WHERE layer = ? AND key = ?", ( layer, key ) ).fetchone()
+        if row is None:
+            self._misses[layer] += 1
+            return ResultCache.MISSING
+        self._hits[layer] += 1
+        self._touched[( layer, key )] = time.time()
+        return json.loads( row[0] )
+
+    # Write last_used of the entries read since the last write, for the caller to commit
+    def _writeTouched(self):
+        if len(self._touched) > 0:
+            self._db.executemany( "UPDATE entries SET last_used = ? WHERE layer = ? AND key = ?",
+                                  [ ( lastUsed, layer, key ) for ( layer, key ), lastUsed in self._touched.items() ] )
+            self._touched = {}
+
+    def put(self, layer, key, value):
+        data = json.dumps( value )
+        self._touched.pop( ( layer, key ), None )
+        self._writeTouched()
+        self._db.execute( "INSERT OR REPLACE INTO entries ( layer, key, value, size, last_used ) VALUES ( ?, ?, ?, ?, ? )",
+                          ( layer, key, data, len(data), time.time() ) )
+        self._db.commit()
+        self._putsSinceCheck += 1
+        if self._putsSinceCheck >= ResultCache.EVICT_CHECK_INTERVAL:
+            self._putsSinceCheck = 0
+            self.evict()
+
+    # Drop least recently used entries until the cache is back under 90% of its limit
+    def evict(self):
+        self._writeTouched()
+        self._db.commit()
+        totalSize = self._db.execute( "SELECT COALESCE(SUM(size), 0) FROM entries" ).fetchone()[0]
+        if totalSize <= self._maxBytes:
+            return 0
+        target = totalSize - int( 0.9 * self._maxBytes )
+        freed = 0
+        evicted = 0
+        for layer, key, size in self._db.execute( "SELECT layer, key, size FROM entries ORDER BY last_used" ).fetchall():
+            if freed >= target:
+                break
+            self._db.execute( "DELETE FROM entries WHERE layer = ? AND key = ?", ( layer, key ) )
+            freed += size
+            evicted += 1
+        self._db.commit()
+        return evicted
+
+    # Record this process's hits and misses under the run id, so one report can
+    # cover all of the processes sharing the cache
+    def flushStats(self):
+        self._writeTouched()
+        for layer in ResultCache.LAYERS:
+            if self._hits[layer] == 0 and self._misses[layer] == 0:
+                continue
+            self._db.execute( "INSERT INTO stats ( run, layer, hits, misses ) VALUES ( ?, ?, ?, ? )",
+                              ( self._runId, layer, self._hits[layer], self._misses[layer] ) )
+            self._hits[layer] = 0
+            self._misses[layer] = 0
+        self._db.commit()
+
+    def getStats(self):
+        self.flushStats()
+        stats = {}
+        for layer in ResultCache.LAYERS:
+            hits, misses = self._db.execute( "SELECT COALESCE(SUM(hits), 0), COALESCE(SUM(misses), 0) FROM stats WHERE run = ? AND layer = ?", ( self._runId, layer ) ).fetchone()
+            entries, size = self._db.execute( "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE layer = ?", ( layer, ) ).fetchone()
+            stats[layer] = { "hits": hits, "misses": misses, "entries": entries, "bytes": size }
+        return stats
+
+    def printStats(self):
+        print( "Result cache {}:".format(self._path) )
+        for layer, stats in self.getStats().items():
+            lookups = stats["hits"] + stats["misses"]
+            hitRate = 100.0 * stats["hits"] / lookups if lookups > 0 else 0
+            print( "  {:<12} {:>7} hits {:>7} misses ({:5.1f}% hit rate), {} entries, {:.1f} MB".format(
+                   layer, stats["hits"], stats["misses"], hitRate, stats["entries"], stats["bytes"] / (1024*1024) ) )
+
+    # Drop the stats of all but the most recent STATS_RUNS runs
+    def pruneStats(self):
+        self._db.execute( "DELETE FROM stats WHERE run NOT IN ( SELECT run FROM stats GROUP BY run ORDER BY MAX(rowid) DESC LIMIT ? )", ( ResultCache.STATS_RUNS, ) )
+        self._db.commit()
+
+    def close(self):
+        self.flushStats()
+        self.pruneStats()
+        self._db.close()
@@ -0,0 +1,154 @@
+# Class to keep normalized face crops in one packed file instead of a _normalized.png per image
+
+import os
+import json
+import threading
+import zlib
+import numpy
+from Utils.Face.normalize import FaceDetection
+
+# Directory layout:
+#   store.json    format version
+#   crops.bin     crop pixels, one record after another, raw or zlib compressed
+#   index.jsonl   one JSON object per record: its key, where it is in crops.bin,
+#                 its codec and shape, and the FaceDetection found with it
+#
+# Records are only ever appended. A key which is added again is replaced by its
+# newest record. A record only counts once its index line is complete and crops.bin
+# holds all of it, so a partly written last record is dropped before appending.
+# One process adds crops. Others can open the store read only, and find what it
+# adds since, as every record is flushed once it's written
+class CropStore:
+    FORMAT_VERSION = 1
+    CODECS = [ "raw", "zlib" ]
+    # zlib's fastest level, still several times faster than saving a PNG
+    ZLIB_LEVEL = 1
+
+    def __init__(self, path, readOnly = False, codec = "zlib"):
+        if codec not in CropStore.CODECS:
+            raise Exception( "Unknown crop codec \"{}\", expected one of {}".format( codec, CropStore.CODECS ) )
+        self._path = path
+        self._readOnly = readOnly
+        self._codec = codec
+        # Prepare threads share a store
+        self._lock = threading.Lock()
+        self._reader = None
+        self._writers = None
+        # key -> index record, and how far into each file the valid records reach
+        self._index = {}
+        self._indexSize = 0
+        self._dataSize = 0
+
+        headerFile = os.path.join( path, "store.json" )
+        if os.path.exists( headerFile ):
+            with open( headerFile, 'r' ) as f:
+                header = json.load(f)
+            if header["format_version"] != CropStore.FORMAT_VERSION:
+                raise Exception("Crop store version mismatch! Store was {}, reader was {}".format(header["format_version"], CropStore.FORMAT_VERSION))
+        elif readOnly:
+            raise Exception( "No crop store at {}".format(path) )
+        else:
+            os.makedirs( path, exist_ok=True )
+            with open( headerFile, 'w' ) as f:
+                json.dump( { "format_version": CropStore.FORMAT_VERSION }, f )
+        self._readIndex()
+
+    def _getFile(self, name):
+        return os.path.join( self._path, name )
+
+    # Read index records added since it was last read
+    def _readIndex(self):
+        indexFile = self._getFile( "index.jsonl" )
+        if not os.path.exists( indexFile ):
+            return
+        with open( indexFile, 'rb' ) as f:
+            f.seek( self._indexSize )
+            text = f.read()
+        dataFile = self._getFile( "crops.bin" )
+        dataSize = os.path.getsize( dataFile ) if os.path.exists( dataFile ) else 0
+        for line in text.split(b'\n')[:-1]:
+            try:
+                record = json.loads( line )
+            except ValueError:
+                break
+            if record["offset"] + record["size"] > dataSize:
+                break
+            self._index[record["key"]] = record
+            self._indexSize += len(line) + 1
+            self._dataSize = max( self._dataSize, record["offset"] + record["size"] )
+
+    def getPath(self):
+        return self._path
+
+    def __len__(self):
+        return len( self._index )
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._index
+
+    # ( npImg, FaceDetection ) of the crop stored under key, or None if there isn't one
+    def get(self, key):
+        with self._lock:
+            record = self._index.get( key )
+            if record is None and self._readOnly:
+                # The writer may have added it since
+                self._readIndex()
+                record = self._index.get( key )
+            if record is None:
+                return None
+            if self._writers:
+                self._writers["data"].flush()
+            if self._reader is None:
+                self._reader = open( self._getFile( "crops.bin" ), 'rb' )
+            self._reader.seek( record["offset"] )
+            data = self._reader.read( record["size"] )
+
+        if record["codec"] == "zlib":
+            data = zlib.decompress( data )
+        npImg = numpy.frombuffer( bytearray(data), dtype=numpy.uint8 ).reshape( record["shape"] )
+        points = numpy.array( record["points"], dtype=numpy.int32 ) if record["points"] is not None else None
+        return npImg, FaceDetection( tuple( record["region"] ), points, record["faceWidth"], record["landmarksOutside"] )
+
+    # Store an RGB crop and the FaceDetection of the face in it under key
+    def add(self, key, npImg, detection):
+        if self._readOnly:
+            raise Exception( "Crop store {} was opened read only".format(self._path) )
+        npImg = numpy.ascontiguousarray( npImg, dtype=numpy.uint8 )
+        data = npImg.tobytes()
+        if self._codec == "zlib":
+            data = zlib.compress( data, CropStore.ZLIB_LEVEL )
+
+        with self._lock:
+            if self._writers is None:
+                # Drop any partly written record first
+                for name, size in ( ( "crops.bin", self._dataSize ), ( "index.jsonl", self._indexSize ) ):
+                    fileName = self._getFile( name )
+                    if os.path.exists( fileName ) and os.path.getsize( fileName ) != size:
+                        with open( fileName, 'r+b' ) as f:
+                            f.truncate( size )
+                self._writers = { "data": open( self._getFile( "crops.bin" ), 'ab' ), "index": open( self._getFile( "index.jsonl" ), 'ab' ) }
+
+            record = { "key": key, "offset": self._dataSize, "size": len(data), "codec": self._codec, "shape": list( npImg.shape ),
+                       "region": [ int(value) for value in detection.region ],
+                       "points": detection.points.tolist() if detection.points is not None else None,
+                       "faceWidth": float( detection.faceWidth ) if detection.faceWidth is not None else None,
+                       "landmarksOutside": float( detection.landmarksOutside ) if detection.landmarksOutside is not None else None }
+            line = ( json.dumps( record ) + '\n' ).encode('utf-8')
+            self._writers["data"].write( data )
+            self._writers["data"].flush()
+            self._writers["index"].write( line )
+            self._writers["index"].flush()
+            self._index[key] = record
+            self._dataSize += len(data)
+            self._indexSize += len(line)
+
+    def close(self):
+        with self._lock:
+            if self._writers:
+                for writer in self._writers.values():
+                    writer.close()
+                self._writers = None
+            if self._reader:
+                self._reader.close()
+                self._reader = None
@@ -0,0 +1,113 @@
+# Class to find faces with a cascade of detectors, cheapest first
+from Utils.Lazy.lazy_module import LazyModule
+import threading
+import time
+
+dlib = LazyModule( "dlib" )
+face_recognition_models = LazyModule( "face_recognition_models" )
+
+
+# How many images each stage was tried on and found a face in, and the time it took.
+# Detectors used by different threads can share one
+class DetectorStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stage -> [ tried, resolved, seconds ], in the order stages were first used
+        self._stages = {}
+        self._numMissed = 0
+
+    def record(self, stage, resolved, seconds):
+        with self._lock:
+            totals = self._stages.setdefault( stage, [ 0, 0, 0.0 ] )
+            totals[0] += 1
+            totals[1] += 1 if resolved else 0
+            totals[2] += seconds
+
+    def recordMissed(self):
+        with self._lock:
+            self._numMissed += 1
+
+    def printStats(self):
+        with self._lock:
+            stages = [ ( stage, tuple(totals) ) for stage, totals in self._stages.items() ]
+            numMissed = self._numMissed
+        print( "{:<20}{:>10}{:>10}{:>12}{:>14}".format( "detector stage", "tried", "resolved", "seconds", "ms per try" ) )
+        for stage, ( tried, resolved, seconds ) in stages:
+            print( "{:<20}{:>10}{:>10}{:>12.2f}{:>14.2f}".format( stage, tried, resolved, seconds, 1000 * seconds / tried if tried > 0 else 0 ) )
+        print( "{:<20}{:>10}".format( "no face", numMissed ) )
+
+
+# Each stage is a model, "hog" or "cnn", and how many times the image is upsampled
+# before it's searched, written as "hog:1". Stages are tried in order, and an image
+# stops at the first one that finds a face. Models are loaded on first use, one set
+# per detector, so give each thread its own and share a DetectorStats between them
+class FaceDetector:
+    # What face_recognition.face_locations and dlib's frontal face detector did by default
+    DEFAULT_CASCADE = "hog:1"
+    MODELS = [ "hog", "cnn" ]
+
+    _shared = {}
+    _sharedLock = threading.Lock()
+
+    def __init__(self, cascade = DEFAULT_CASCADE, stats = None):
+        self._stages = FaceDetector.parseCascade( cascade )
+        self._stats = stats if stats is not None else DetectorStats()
+        self._models = {}
+
+    # [ ( model, upsample ) ] from a cascade such as "hog:0,hog:1,cnn:0"
+    @staticmethod
+    def parseCascade( cascade ):
+        stages = []
+        for part in cascade.split(','):
+            model, _, upsample = part.strip().partition(':')
+            if model not in FaceDetector.MODELS:
+                raise Exception( "Unknown face detector \"{}\" in \"{}\", expected one of {}".format( model, cascade, FaceDetector.MODELS ) )
+            stages.append( ( model, int(upsample) if upsample else 0 ) )
+        return stages
+
+    # One detector for each cascade in this process, for callers without their own
+    @staticmethod
+    def getShared( cascade = DEFAULT_CASCADE ):
+        with FaceDetector._sharedLock:
+            if cascade not in FaceDetector._shared:
+                FaceDetector._shared[cascade] = FaceDetector( cascade )
+            return FaceDetector._shared[cascade]
+
+    def getStats(self):
+        return self._stats
+
+    # Load every stage's model now, such as before forking workers
+    def load(self):
+        for model, _ in self._stages:
+            self._getModel( model )
+
+    def _getModel(self, model):
+        if model not in self._models:
+            if model == "hog":
+                self._models[model] = dlib.get_frontal_face_detector()
+            else:
+                self._models[model] = dlib.cnn_face_detection_model_v1( face_recognition_models.cnn_face_detector_model_location() )
+        return self._models[model]
+
+    # dlib rectangles of the faces in image, a grayscale or RGB array, from the first stage
+    # that finds any. stages replaces the cascade, and label is put before the stage names
+    # in the stats, for searches which aren't the usual one
+    def detect(self, image, stages = None, label = None):
+        for model, upsample in ( stages if stages is not None else self._stages ):
+            start = time.time()
+            rects = self._getModel( model )( image, upsample )
+            if model == "cnn":
+                rects = [ detection.rect for detection in rects ]
+            stage = "{}:{}".format( model, upsample ) if label is None else "{} {}:{}".format( label, model, upsample )
+            self._stats.record( stage, len(rects) > 0, time.time() - start )
+            if len(rects) > 0:
+                return list(rects)
+        if stages is None and label is None:
+            self._stats.recordMissed()
+        return []
+
+    # Face locations in image as ( top, right, bottom, left ), kept inside the image
+    # as face_recognition.face_locations does
+    def locate(self, image):
+        height, width = image.shape[:2]
+        return [ ( max( rect.top(), 0 ), min( rect.right(), width ), min( rect.bottom(), height ), max( rect.left(), 0 ) ) for rect in self.detect( image ) ]
@@ -1,159 +1,317 @@
 # Class to handle faces encoded for recognition
 
-try:
-    import face_recognition_hst as face_recognition
-except ImportError:
-    import face_recognition
 import numpy
+import collections.abc
 from PIL import Image, ImageDraw
-import cv2
-import math
+from Utils.Lazy.lazy_module import LazyModule
+from Utils.Face.pose import HeadPose
+from Utils.Face.detect import FaceDetector
 import json
 
+# Heavy backends are only imported once a face is actually encoded
+face_recognition = LazyModule( "face_recognition_hst", "face_recognition" )
+cv2 = LazyModule( "cv2" )
 
+
+# Faces are kept as a float32 encoding and an int16 (68,2) landmark array, without
+# an instance dict, so that hundreds of thousands of them stay small
 class EncodedFace:
     ENCODING_TYPE = "dlib.face_recognition"
     ENCODING_VERSION = 1
 
-    def __init__(self, image, region=None, keepImg=False, imgPadding=125, num_jitters=2, debugPose = False):
+    __slots__ = ( "_encodings", "_landmarkArray", "_angle", "_img", "_region", "_mirroredFromAngle", "_numJitters" )
+
+    # Which of dlib's 68 landmark points make up each of face_recognition's features
+    LANDMARK_INDICES = { "chin": list(range(0, 17)),
+                         "left_eyebrow": list(range(17, 22)),
+                         "right_eyebrow": list(range(22, 27)),
+                         "nose_bridge": list(range(27, 31)),
+                         "nose_tip": list(range(31, 36)),
+                         "left_eye": list(range(36, 42)),
+                         "right_eye": list(range(42, 48)),
+                         "top_lip": list(range(48, 55)) + [64, 63, 62, 61, 60],
+                         "bottom_lip": list(range(54, 60)) + [48, 60, 67, 66, 65, 64] }
+
+    # The same features as slices where they can be, so getFeature returns a view of the landmark array
+    LANDMARK_FEATURES = { name: slice( indices[0], indices[-1] + 1 ) if indices == list( range( indices[0], indices[-1] + 1 ) ) else indices
+                          for name, indices in LANDMARK_INDICES.items() }
+
+    # For each of the 68 points, the point on the other side of the face which it becomes when mirrored
+    LANDMARK_MIRROR = list(range(16, -1, -1)) + list(range(26, 16, -1)) + [ 27, 28, 29, 30 ] + list(range(35, 30, -1)) + \
+                      [ 45, 44, 43, 42, 47, 46, 39, 38, 37, 36, 41, 40 ] + list(range(54, 47, -1)) + list(range(59, 54, -1)) + \
+                      list(range(64, 59, -1)) + [ 67, 66, 65 ]
+
+    # region and landmarkPoints are where the face is in image, if already known,
+    # as from FaceNormalizer.normalizeWithDetection. Otherwise the face is
+    # detected once here, with detector or the process' default FaceDetector,
+    # and that location used for the encoding and landmarks.
+    # With faceLeft, a face turned right is mirrored before it is encoded. Its
+    # region and landmarks are flipped rather than found again, and the pose
+    # comes from the landmarks, so only the encoding is computed on the flipped pixels.
+    # If requirements (from Config.getRequirements) say nothing reads the encoding
+    # of a face at this angle, it isn't computed and the face only has landmarks.
+    # With jitterEpsilon, num_jitters is only the most jitters used, see _encodeAdaptive
+    def __init__(self, image, region=None, keepImg=False, imgPadding=125, num_jitters=2, debugPose = False, landmarkPoints = None, faceLeft = False, requirements = None, jitterEpsilon = None, detector = None):
+        self._encodings = None
+        self._landmarkArray = None
+        self._angle = None
+        self._img = None
+        self._region = None
+        self._mirroredFromAngle = None
+        self._numJitters = None
         if image is None:
             return
 
-        nImg = numpy.array(image)
+        nImg = numpy.asarray(image)
 
         if region is None:
             try:
-                self._region = face_recognition.face_locations(nImg)[0]
+                self._region = ( detector if detector is not None else FaceDetector.getShared() ).locate(nImg)[0]
             except Exception as e:
                 raise Exception("Failed to find a face in the picture")
 
             # print("Face found at {}".format(self._region))
         else:
-            self._region = _region
+            self._region = region
         top, right, bottom, left = self._region
 
         # Apply padding to save more of image
-        top = max(0, top - imgPadding)
-        left = max(0, left - imgPadding)
-        bottom = min(nImg.shape[0], bottom + imgPadding)
-        right = min(nImg.shape[1], right + imgPadding)
+        cropTop = max(0, top - imgPadding)
+        cropLeft = max(0, left - imgPadding)
+        cropBottom = min(nImg.shape[0], bottom + imgPadding)
+        cropRight = min(nImg.shape[1], right + imgPadding)
 
         # crop image to just the face
-        self._img = nImg[top:bottom, left:right]
+        self._img = nImg[cropTop:cropBottom, cropLeft:cropRight]
+        faceLocation = ( top - cropTop, right - cropLeft, bottom - cropTop, left - cropLeft )
 
-        # Get encodings for the face in the image
         try:
-            self._encodings = face_recognition.face_encodings(self._img, num_jitters=num_jitters)[0]
-            self._landmarks = face_recognition.face_landmarks(self._img)[0]
+            if landmarkPoints is None:
+                points = EncodedFace.landmarksToArray( face_recognition.face_landmarks(self._img, face_locations=[faceLocation])[0] )
+            else:
+                points = numpy.asarray(landmarkPoints) - ( cropLeft, cropTop )
         except Exception:
             raise Exception("Failed to find face in image")
+        self._landmarkArray = numpy.asarray( points, dtype=numpy.int16 )
         (_, self._angle, _) = self._estimatePose(debugPose = debugPose)
 
+        if faceLeft and self._angle < 0:
+            self._mirroredFromAngle = self._angle
+            cropWidth = self._img.shape[1]
+            self._img = numpy.ascontiguousarray( self._img[:, ::-1] )
+            faceLocation = ( faceLocation[0], cropWidth - 1 - faceLocation[3], faceLocation[2], cropWidth - 1 - faceLocation[1] )
+            self._region = ( top, nImg.shape[1] - 1 - left, bottom, nImg.shape[1] - 1 - right )
+            self._landmarkArray = EncodedFace.mirrorLandmarkArray( self._landmarkArray, cropWidth )
+            (_, self._angle, _) = self._estimatePose(debugPose = debugPose)
+
+        # Get encodings for the face in the image
+        if requirements is None or requirements.needsEncoding( self._angle ):
+            try:
+                if jitterEpsilon is None:
+                    encoding = face_recognition.face_encodings(self._img, known_face_locations=[faceLocation], num_jitters=num_jitters)[0]
+                    self._numJitters = num_jitters
+                else:
+                    encoding, self._numJitters = EncodedFace._encodeAdaptive( self._img, faceLocation, num_jitters, jitterEpsilon )
+            except Exception:
+                raise Exception("Failed to find face in image")
+            self._encodings = numpy.asarray( encoding, dtype=numpy.float32 )
+
         if not keepImg:
             self._img = None
 
+    # Average jittered encodings a couple at a time, stopping once more of them
+    # move the average by less than jitterEpsilon, or maxJitters have been
+    # used. dlib only jitters when asked for at least 2, so steps are of 2.
+    # Returns the encoding and how many jitters it took
+    @staticmethod
+    def _encodeAdaptive( img, faceLocation, maxJitters, jitterEpsilon, jitterStep = 2 ):
+        total = None
+        numJitters = 0
+        while numJitters < maxJitters:
+            step = min( jitterStep, maxJitters - numJitters )
+            encoding = numpy.asarray( face_recognition.face_encodings(img, known_face_locations=[faceLocation], num_jitters=step)[0] )
+            newTotal = encoding * step if total is None else total + encoding * step
+            moved = None if total is None else numpy.linalg.norm( newTotal / ( numJitters + step ) - total / numJitters )
+            total = newTotal
+            numJitters += step
+            if moved is not None and moved < jitterEpsilon:
+                break
+        return total / numJitters, numJitters
+
+    # Packed as lists and a landmark dict, as before faces were array backed, so
+    # existing training caches still load
     @staticmethod
     def msgpack_encode(obj):
         if isinstance(obj, EncodedFace):
-            return {'__EncodedFace__': True, 'angle': obj._angle, 'encodings': obj._encodings, 'landmarks': obj._landmarks }
+            return {'__EncodedFace__': True, 'angle': obj._angle, 'encodings': obj.getEncodings(), 'landmarks': obj.getLandmarks(), 'num_jitters': obj._numJitters }
         return obj
 
     @staticmethod
     def msgpack_decode(obj):
         if '__EncodedFace__' in obj:
-            decodedFace = EncodedFace(None)
-            decodedFace._angle = obj['angle']
-            decodedFace._encodings = obj['encodings']
-            decodedFace._landmarks = obj['landmarks']
+            decodedFace = EncodedFace.createFromArrays( obj['encodings'], EncodedFace.landmarksToArray( obj['landmarks'] ), obj['angle'] )
+            decodedFace._numJitters = obj.get( 'num_jitters' )
             obj = decodedFace
         return obj
 
 
 
+    # Import face_recognition now, which loads its models, such as before forking workers
+    @staticmethod
+    def loadModels():
+        face_recognition.load()
+
+    # needsEncoding, if given, says for each image whether its encoding is read.
+    # Images whose encoding isn't only have their face and landmarks found.
+    # With faceLeft, faces looking right are flipped and encoded again in one more call.
+    # mirroredFromAngles gives the angle of images the caller already flipped, or None.
+    # With a FaceDetector, faces are found with its cascade and then encoded one at a
+    # time, instead of by the batch call, which can only look for them with HOG
     @staticmethod
-    def batchEncode( imageList, batch_size = 128, keepImage = False, debugPose = False ):
-        encodings, landmarks = face_recognition.batch_face_encodings_and_landmarks( imageList, landmark_model="large", batch_size=batch_size, location_model="hog" )
+    def batchEncode( imageList, batch_size = 128, keepImage = False, debugPose = False, needsEncoding = None, faceLeft = False, mirroredFromAngles = None, detector = None ):
+        if needsEncoding is None:
+            needsEncoding = [ True ] * len(imageList)
+        if mirroredFromAngles is None:
+            mirroredFromAngles = [ None ] * len(imageList)
+        encodeList = [ image for image, needed in zip( imageList, needsEncoding ) if needed and detector is None ]
+        if len(encodeList) > 0:
+            encodings, landmarks = face_recognition.batch_face_encodings_and_landmarks( encodeList, landmark_model="large", batch_size=batch_size, location_model="hog" )
+            batched = iter( zip( encodings, landmarks ) )
         encodedList = []
-        for data in zip(encodings,landmarks, imageList):
-            if len(data[0]) > 0:
+        for image, needed in zip( imageList, needsEncoding ):
+            if needed and detector is None:
+                faceEncodings, faceLandmarks = next( batched )
+            else:
+                locations = ( detector if detector is not None else FaceDetector.getShared() ).locate( image )[:1]
+                faceLandmarks = face_recognition.face_landmarks( image, face_locations=locations ) if len(locations) > 0 else []
+                faceEncodings = face_recognition.face_encodings( image, known_face_locations=locations ) if needed and len(locations) > 0 else None
+            if len(faceLandmarks) > 0 and ( faceEncodings is None or len(faceEncodings) > 0 ):
                 encodedFace = EncodedFace(None)
-                encodedFace._encodings = list(data[0][0])
-                encodedFace._landmarks = data[1][0]
-                encodedFace._img = data[2]
-                _, encodedFace._angle, _ = encodedFace._estimatePose( debugPose = debugPose )
-
-                if not keepImage:
-                    encodedFace._img = None
+                if faceEncodings is not None:
+                    encodedFace._encodings = numpy.asarray( faceEncodings[0], dtype=numpy.float32 )
+                encodedFace._landmarkArray = EncodedFace.landmarksToArray( faceLandmarks[0] )
+                encodedFace._img = image
             else:
                 encodedFace = None
             encodedList.append(encodedFace)
+
+        # Pose every face found with one call, unless each is being shown
+        foundFaces = [ encodedFace for encodedFace in encodedList if encodedFace is not None ]
+        if debugPose:
+            for encodedFace in foundFaces:
+                _, encodedFace._angle, _ = encodedFace._estimatePose( debugPose = debugPose )
+        elif len(foundFaces) > 0:
+            imagePoints = HeadPose.getImagePoints( [ encodedFace._landmarkArray for encodedFace in foundFaces ] )
+            _, angles, _ = HeadPose.estimate( imagePoints, [ encodedFace._img.shape[:2] for encodedFace in foundFaces ] )
+            for encodedFace, angle in zip( foundFaces, angles ):
+                encodedFace._angle = float(angle)
+
+        for encodedFace, mirroredFromAngle in zip( encodedList, mirroredFromAngles ):
+            if encodedFace is not None:
+                encodedFace._mirroredFromAngle = mirroredFromAngle
+
+        if faceLeft:
+            rightIdx = [ idx for idx, encodedFace in enumerate(encodedList) if encodedFace is not None and encodedFace._angle < 0 and mirroredFromAngles[idx] is None ]
+            if len(rightIdx) > 0:
+                flippedList = [ numpy.ascontiguousarray( imageList[idx][:, ::-1] ) for idx in rightIdx ]
+                mirroredList = EncodedFace.batchEncode( flippedList, batch_size, True, debugPose, [ needsEncoding[idx] for idx in rightIdx ], detector = detector )
+                for idx, mirroredFace in zip( rightIdx, mirroredList ):
+                    # A face only found unflipped is kept as it was
+                    if mirroredFace is not None:
+                        mirroredFace._mirroredFromAngle = encodedList[idx]._angle
+                        encodedList[idx] = mirroredFace
+                foundFaces = [ encodedFace for encodedFace in encodedList if encodedFace is not None ]
+
+        if not keepImage:
+            for encodedFace in foundFaces:
+                encodedFace._img = None
         return encodedList
 
     @staticmethod
     def createFromFile( fileName ):
         with open(fileName, 'r') as f:
             jsonData = json.load(f)
+        return EncodedFace.createFromJson( jsonData )
 
+    @staticmethod
+    def createFromJson( jsonData ):
         if jsonData["encoding_version"] != EncodedFace.ENCODING_VERSION:
             raise Exception("Encoding version mismatch! File was {}, reader was {}".format(jsonData["encoding_version"], EncodedFace.ENCODING_VERSION ) )
 
+        newEncoding = EncodedFace.createFromArrays( jsonData["encoding"], EncodedFace.landmarksToArray( jsonData["landmarks"] ), jsonData["angle"] )
+        newEncoding._numJitters = jsonData.get( "num_jitters" )
+        return newEncoding
+
+    # From an encoding, a (68,2) landmark point array and an angle, as an EncodingStore holds them.
+    # Arrays of the right type are used as they are, not copied, when copy is False.
+    # encoding is None for a face which was only given landmarks
+    @staticmethod
+    def createFromArrays( encoding, landmarkArray, angle, copy = True ):
+        makeArray = numpy.array if copy else numpy.asarray
         newEncoding = EncodedFace( None )
-        newEncoding._encodings = numpy.array(jsonData["encoding"])
-        newEncoding._landmarks = jsonData["landmarks"]
-        newEncoding._angle = jsonData["angle"]
+        newEncoding._encodings = makeArray( encoding, dtype=numpy.float32 ) if encoding is not None else None
+        newEncoding._landmarkArray = makeArray( landmarkArray, dtype=numpy.int16 )
+        newEncoding._angle = angle
         return newEncoding
 
+    @staticmethod
+    def landmarksToArray( landmarks ):
+        landmarkArray = numpy.zeros( ( 68, 2 ), dtype=numpy.int16 )
+        for name, indices in EncodedFace.LANDMARK_INDICES.items():
+            points = landmarks[name]
+            if len(points) != len(indices):
+                raise Exception( "Landmark {} has {} points, expected {}".format(name, len(points), len(indices)) )
+            for idx, point in zip( indices, points ):
+                landmarkArray[idx] = point
+        return landmarkArray
+
+    # Landmark points of the same face in an image width pixels wide, flipped left to right
+    @staticmethod
+    def mirrorLandmarkArray( landmarkArray, width ):
+        mirrored = numpy.array( landmarkArray )[EncodedFace.LANDMARK_MIRROR]
+        mirrored[:, 0] = width - 1 - mirrored[:, 0]
+        return mirrored
+
+    @staticmethod
+    def landmarksFromArray( landmarkArray ):
+        landmarks = {}
+        for name, indices in EncodedFace.LANDMARK_INDICES.items():
+            landmarks[name] = [ ( int(landmarkArray[idx][0]), int(landmarkArray[idx][1]) ) for idx in indices ]
+        return landmarks
+
 
     # Determine angle the face is facing
     def _estimatePose(self, img_size = None , landmarks = None, debugPose = False):
         if img_size is None:
             img_size = self._img.shape
         if landmarks is None:
-            landmarks = self._landmarks
-        # 2D image points. Adapted from https://www.learnopencv.com/head-pose-estimation-using-opencv-and-dlib/
-        image_points = numpy.array([
-                                    landmarks['nose_bridge'][3],  # Nose tip
-                                    landmarks['chin'][8],  # Chin
-                                    landmarks['left_eye'][0],  # Left eye left corner
-                                    landmarks['right_eye'][3],  # Right eye right corner
-                                    landmarks['top_lip'][0],  # Left mouth corner
-                                    landmarks['bottom_lip'][0],  # Right mouth corner
-                                ], dtype="double")
-
-        # 3D model points
-        model_points = numpy.array([
-                                    (0.0, 0.0, 0.0),  # Nose tip
-                                    (0.0, -330.0, -65.0),  # Chin
-                                    (-225.0, 170.0, -135.0),  # Left eye left corner
-                                    (225.0, 170.0, -135.0),  # Right eye right corne
-                                    (-150.0, -150.0, -125.0),  # Left Mouth corner
-                                    (150.0, -150.0, -125.0)  # Right mouth corner
-
-                                ])
-
-        # Camera internals
-        focal_length = img_size[1]
-        center = (img_size[1] / 2, img_size[0] / 2)
-        camera_matrix = numpy.array(
-                                 [[focal_length, 0, center[0]],
-                                 [0, focal_length, center[1]],
-                                 [0, 0, 1]], dtype="double"
-                                 )
-
-        dist_coeffs = numpy.zeros((4, 1))  # Assuming no lens distortion
-        (success, rotation_vector, translation_vector) = cv2.solvePnP(model_points, image_points, camera_matrix, dist_coeffs, flags=cv2.SOLVEPNP_ITERATIVE)
-
-        rMat = cv2.Rodrigues(rotation_vector)[0]
-        attitude = self._rotation_matrix_to_attitude_angles(rMat)
-
-        attitude_list = []
-        for val in numpy.nditer(attitude.T):
-            attitude_list.append( math.degrees(val) )
+            landmarkArray = self._landmarkArray
+        else:
+            landmarkArray = EncodedFace.landmarksToArray( landmarks )
+        # 2D image points: nose tip, chin, eye and mouth corners
+        image_points = HeadPose.getImagePoints( landmarkArray[None] )[0]
+
+        # The same solver batchEncode poses many faces with at once
+        rotations, translations, converged = HeadPose.solve( image_points[None], img_size )
+        HeadPose.resolveUnconverged( image_points[None], img_size, rotations, translations, converged )
+        attitude_list = [ float(angles[0]) for angles in HeadPose.rotationsToAngles( rotations ) ]
 
         # Display image with markings
         if debugPose:
             debugImage = self._img.copy()
 
+            # Camera internals
+            focal_length = img_size[1]
+            center = (img_size[1] / 2, img_size[0] / 2)
+            camera_matrix = numpy.array(
+                                     [[focal_length, 0, center[0]],
+                                     [0, focal_length, center[1]],
+                                     [0, 0, 1]], dtype="double"
+                                     )
+            dist_coeffs = numpy.zeros((4, 1))  # Assuming no lens distortion
+            rotation_vector = cv2.Rodrigues(rotations[0])[0]
+            translation_vector = translations[0].reshape((3, 1))
+
             # Draw face landmarks
             for p in image_points:
                 cv2.circle(debugImage, (int(p[0]), int(p[1])), 3, (0,0,255), -1)
@@ -177,9 +335,8 @@ class EncodedFace:
             cv2.line(debugImage, origin, yAxis, (0,255,0), 2 )
             cv2.line(debugImage, origin, zAxis, (0,0,255), 2 )
 
-            for _,pointList in landmarks.items():
-                for p in pointList:
-                    cv2.circle(debugImage, p, 1, (0,255,0), -1)
+            for p in landmarkArray:
+                cv2.circle(debugImage, (int(p[0]), int(p[1])), 1, (0,255,0), -1)
 
             cv2.putText( debugImage, "Rot: {}, {}, {}".format(round(attitude_list[0],3), round(attitude_list[1],3), round(attitude_list[2],3)),
                          (10,30),
@@ -207,41 +364,53 @@ class EncodedFace:
 
         return attitude_list
 
-    # Taken from https://stackoverflow.com/questions/44726404/camera-pose-from-solvepnp
-    # Only seems to get 'yaw' correct, but that's what we want
-    def _rotation_matrix_to_attitude_angles(self, R):
-        cos_beta = math.sqrt(R[2,1] * R[2,1] + R[2,2] * R[2,2])
-        validity = cos_beta < 1e-6
-        if not validity:
-            alpha = math.atan2(R[1,0], R[0,0])    # yaw   [z]
-            beta  = math.atan2(-R[2,0], cos_beta) # pitch [y]
-            gamma = math.atan2(R[2,1], R[2,2])    # roll  [x]
-        else:
-            alpha = math.atan2(R[1,0], R[0,0])    # yaw   [z]
-            beta  = math.atan2(-R[2,0], cos_beta) # pitch [y]
-            gamma = 0                             # roll  [x]
-        return numpy.array([alpha, beta, gamma])
-
     def getAngle(self):
         return self._angle
 
+    # The angle the face had before it was mirrored to face left, or None
+    def getMirroredFromAngle(self):
+        return self._mirroredFromAngle
+
     def getImage(self):
         return self._img
 
     def getEncodings(self):
-        return list(self._encodings)
+        return self._encodings.tolist() if self._encodings is not None else None
+
+    # The (128,) float32 encoding itself, not a copy. None if the face was encoded
+    # for configs which only read its landmarks
+    def getEncodingArray(self):
+        return self._encodings
+
+    def hasEncoding(self):
+        return self._encodings is not None
 
+    # How many jittered encodings were averaged, if known
+    def getNumJitters(self):
+        return self._numJitters
+
+    # Landmarks as a dict of feature name to a list of points, as saved in .encoding
+    # files. Built on each call, so prefer getLandmarkArray or getFeature
     def getLandmarks(self):
-        return self._landmarks
+        return EncodedFace.landmarksFromArray( self._landmarkArray )
+
+    # The (68,2) int16 landmark points themselves, not a copy
+    def getLandmarkArray(self):
+        return self._landmarkArray
+
+    # The points of one feature. A view of the landmark array, except for the lips
+    def getFeature(self, name):
+        return self._landmarkArray[EncodedFace.LANDMARK_FEATURES[name]]
 
     def getRegion(self):
         return self._region
 
     def compare(self, otherFace):
-        return face_recognition.face_distance([numpy.array(self._encodings)], numpy.array(otherFace._encodings)).mean()
+        return face_recognition.face_distance([self._encodings], otherFace._encodings).mean()
 
     def getEncodingJson(self):
-        return { 'angle': self._angle, 'landmarks': self._landmarks, 'encoding': self._encodings.tolist(), 'encoding_format': self.ENCODING_TYPE, 'encoding_version': self.ENCODING_VERSION }
+        return { 'angle': self._angle, 'landmarks': self.getLandmarks(), 'encoding': self.getEncodings(), 'num_jitters': self._numJitters,
+                 'encoding_format': self.ENCODING_TYPE, 'encoding_version': self.ENCODING_VERSION }
 
     def saveEncodings(self, filename):
         jsonData = self.getEncodingJson()
@@ -258,7 +427,72 @@ class EncodedFace:
             img = self._img
         if landmarks:
             draw = ImageDraw.Draw(img)
-            for key, val in self._landmarks.items():
-                draw.point(val)
+            draw.point( [ ( int(x), int(y) ) for x, y in self._landmarkArray ] )
 
         img.save(filename)
+
+
+# Many faces in three arrays, one row per face. Faces taken from it are views
+# of its rows, so reading a whole directory or store is a few array copies
+# rather than one per face. Rows appended after a face was taken may be in
+# newly allocated arrays, which that face doesn't see
+class EncodedFaces( collections.abc.Sequence ):
+    __slots__ = ( "_encodings", "_landmarkArrays", "_angles", "_count" )
+
+    def __init__(self, capacity = 16):
+        self._encodings = numpy.zeros( ( capacity, 128 ), dtype=numpy.float32 )
+        self._landmarkArrays = numpy.zeros( ( capacity, 68, 2 ), dtype=numpy.int16 )
+        self._angles = numpy.zeros( capacity, dtype=numpy.float32 )
+        self._count = 0
+
+    # From (N,128) encodings, (N,68,2) landmark points and (N,) angles, used without copying if already the right types
+    @staticmethod
+    def createFromArrays( encodings, landmarkArrays, angles ):
+        faces = EncodedFaces( 0 )
+        faces._encodings = numpy.asarray( encodings, dtype=numpy.float32 )
+        faces._landmarkArrays = numpy.asarray( landmarkArrays, dtype=numpy.int16 )
+        faces._angles = numpy.asarray( angles, dtype=numpy.float32 )
+        faces._count = len( faces._angles )
+        return faces
+
+    @staticmethod
+    def createFromFaces( faceList ):
+        faces = EncodedFaces( len(faceList) )
+        for face in faceList:
+            faces.append( face )
+        return faces
+
+    def append(self, face):
+        if self._count == len( self._angles ):
+            capacity = max( 16, 2 * self._count )
+            self._encodings = numpy.resize( self._encodings, ( capacity, 128 ) )
+            self._landmarkArrays = numpy.resize( self._landmarkArrays, ( capacity, 68, 2 ) )
+            self._angles = numpy.resize( self._angles, capacity )
+        # Rows without an encoding are NaN
+        self._encodings[self._count] = face.getEncodingArray() if face.hasEncoding() else numpy.nan
+        self._landmarkArrays[self._count] = face.getLandmarkArray()
+        self._angles[self._count] = face.getAngle()
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        if isinstance( idx, slice ):
+            return [ self[i] for i in range( *idx.indices( self._count ) ) ]
+        if idx < 0:
+            idx += self._count
+        if idx < 0 or idx >= self._count:
+            raise IndexError( "Face {} of {}".format(idx, self._count) )
+        encoding = self._encodings[idx]
+        return EncodedFace.createFromArrays( encoding if not numpy.isnan( encoding[0] ) else None, self._landmarkArrays[idx], float( self._angles[idx] ), copy = False )
+
+    # (N,128) encodings, (N,68,2) landmark points and (N,) angles of every face, not copies
+    def getEncodingArrays(self):
+        return self._encodings[:self._count]
+
+    def getLandmarkArrays(self):
+        return self._landmarkArrays[:self._count]
+
+    def getAngles(self):
+        return self._angles[:self._count]
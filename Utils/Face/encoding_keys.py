@@ -0,0 +1,57 @@
+# Keys results for an image are cached and its crop is stored under
+from Utils.Face.encoded import EncodedFace
+from Utils.Face.normalize import FaceNormalizer
+from Utils.Face.detect import FaceDetector
+from Utils.Face.pose import HeadPose
+from Utils.Face.quality import QualityGate
+from Utils.Cache.result_cache import ResultCache
+
+
+# Each key is the hash of the image's contents, from ResultCache.hashFile, and every
+# setting in the CreateTrainingEncodings arguments that changes what is kept under it.
+# The image is hashed once and handed to each key made for it
+class EncodingKeys:
+
+    @staticmethod
+    def hashImage( inputFile ):
+        return ResultCache.hashFile( inputFile )
+
+    @staticmethod
+    def getCascade( args ):
+        return getattr(args, "detectors", None) or FaceDetector.DEFAULT_CASCADE
+
+    # The width normalizers first look for faces at. Normalizers are made with it, and keys include it
+    @staticmethod
+    def getCoarseWidth( args ):
+        coarseWidth = getattr(args, "coarseWidth", None)
+        return coarseWidth if coarseWidth is not None else FaceNormalizer.COARSE_WIDTH
+
+    # Scans depend on every setting that changes the face found or its score
+    @staticmethod
+    def getScanKey( imageHash, args ):
+        gate = QualityGate.createFromArgs( args )
+        settings = { "normalizeSize": args.normalizeSize, "flipFirst": args.flipFirst, "draftDecode": True, "coarseWidth": EncodingKeys.getCoarseWidth( args ),
+                     "detectors": EncodingKeys.getCascade( args ), "quality": gate.getKeyData() if gate is not None else None, "poseSolver": HeadPose.SOLVER }
+        return ResultCache.hashBytes( imageHash, ResultCache.hashJson(settings) )
+
+    # Crops depend on every setting that changes the crop or its detection
+    @staticmethod
+    def getCropKey( imageHash, args ):
+        settings = { "normalizeSize": args.normalizeSize, "flipFirst": args.flipFirst, "draftDecode": True, "coarseWidth": EncodingKeys.getCoarseWidth( args ),
+                     "detectors": EncodingKeys.getCascade( args ) }
+        return ResultCache.hashBytes( imageHash, ResultCache.hashJson(settings) )
+
+    # Encodings depend on every setting that changes the encoding
+    @staticmethod
+    def getEncodingKey( imageHash, args ):
+        settings = { "normalize": args.normalize, "normalizeSize": args.normalizeSize, "numJitters": args.numJitters, "jitterEpsilon": getattr(args, "jitterEpsilon", None),
+                     "flipFirst": args.flipFirst, "encodingVersion": EncodedFace.ENCODING_VERSION, "normalizerLandmarks": True, "mirroredLandmarks": True, "draftDecode": True,
+                     "coarseWidth": EncodingKeys.getCoarseWidth( args ), "detectors": EncodingKeys.getCascade( args ), "poseSolver": HeadPose.SOLVER }
+        # The batch API encodes without jitters, so its encodings are kept apart
+        if getattr(args, "batchSize", 0) > 0:
+            settings["batched"] = True
+        # Faces the quality gate turns away or encodes cheaply depend on its thresholds
+        gate = QualityGate.getShared( args )
+        if gate is not None:
+            settings["quality"] = gate.getKeyData()
+        return ResultCache.hashBytes( imageHash, ResultCache.hashJson(settings) )
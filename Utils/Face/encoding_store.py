@@ -0,0 +1,275 @@
+# Class to keep many face encodings in a few memory-mapped column files instead of one .encoding JSON per image
+
+import os
+import json
+import numpy
+from Utils.Face.encoded import EncodedFace, EncodedFaces
+
+# Directory layout:
+#   store.json     format and array sizes
+#   index.txt      one key per row, in row order
+#   encodings.f32  (N, ENCODING_SIZE) float32
+#   landmarks.i16  (N, 68, 2) int16
+#   angles.f32     (N,) float32, NaN for images without a usable face
+#
+# Faces encoded with only their landmarks have a NaN encoding
+#
+# Rows are only ever appended. A key which is added again is replaced by its
+# newest row, and compact() drops the rows replaced. Keys are image paths relative
+# to the store, without extension, so an image and its .encoding file find the same row
+class EncodingStore:
+    FORMAT_VERSION = 1
+    ENCODING_SIZE = 128
+    NUM_LANDMARKS = 68
+    # Rows copied at a time by compact()
+    COMPACT_ROWS = 65536
+
+    COLUMNS = { "encodings": ( "encodings.f32", numpy.float32, ( ENCODING_SIZE, ) ),
+                "landmarks": ( "landmarks.i16", numpy.int16, ( NUM_LANDMARKS, 2 ) ),
+                "angles": ( "angles.f32", numpy.float32, () ) }
+
+    def __init__(self, path, readOnly = False):
+        self._path = path
+        self._readOnly = readOnly
+        self._writers = None
+        self._mapped = {}
+        self._numMapped = 0
+
+        headerFile = os.path.join( path, "store.json" )
+        if os.path.exists( headerFile ):
+            with open( headerFile, 'r' ) as f:
+                header = json.load(f)
+            if header["format_version"] != EncodingStore.FORMAT_VERSION or header["encoding_version"] != EncodedFace.ENCODING_VERSION:
+                raise Exception("Encoding store version mismatch! Store was {}/{}, reader was {}/{}".format(header["format_version"], header["encoding_version"], EncodingStore.FORMAT_VERSION, EncodedFace.ENCODING_VERSION))
+        elif readOnly:
+            raise Exception( "No encoding store at {}".format(path) )
+        else:
+            os.makedirs( path, exist_ok=True )
+            with open( headerFile, 'w' ) as f:
+                json.dump( { "format_version": EncodingStore.FORMAT_VERSION, "encoding_version": EncodedFace.ENCODING_VERSION,
+                             "encoding_size": EncodingStore.ENCODING_SIZE, "num_landmarks": EncodingStore.NUM_LANDMARKS }, f )
+
+        # A row only counts once every column and the index have it, so a
+        # partly written last row is ignored
+        indexText = ""
+        indexFile = os.path.join( path, "index.txt" )
+        if os.path.exists( indexFile ):
+            with open( indexFile, 'r', encoding='utf-8', newline='\n' ) as f:
+                indexText = f.read()
+        keys = indexText.split('\n')[:-1]
+        self._numRows = min( [ len(keys) ] + [ self._getFileRows(name) for name in EncodingStore.COLUMNS ] )
+        self._index = {}
+        for row, key in enumerate( keys[:self._numRows] ):
+            self._index[key] = row
+        # Keys to rewrite the index with before appending, if it has more than the columns
+        self._validKeys = keys[:self._numRows] if len(keys) != self._numRows or not indexText.endswith('\n') else None
+
+    def _getColumnFile(self, name):
+        return os.path.join( self._path, EncodingStore.COLUMNS[name][0] )
+
+    def _getRowBytes(self, name):
+        fileName, dtype, shape = EncodingStore.COLUMNS[name]
+        return numpy.dtype(dtype).itemsize * int( numpy.prod(shape) )
+
+    def _getFileRows(self, name):
+        columnFile = self._getColumnFile( name )
+        if not os.path.exists( columnFile ):
+            return 0
+        return os.path.getsize( columnFile ) // self._getRowBytes( name )
+
+    def getPath(self):
+        return self._path
+
+    def getKey(self, fileName):
+        return self._getRelPath( os.path.splitext(fileName)[0] )
+
+    def _getRelPath(self, path):
+        return os.path.relpath( os.path.abspath(path), os.path.abspath( self._path ) ).replace( os.sep, '/' )
+
+    def getFileName(self, key, extension = ".encoding"):
+        return os.path.join( self._path, *key.split('/') ) + extension
+
+    def getKeys(self):
+        return list( self._index.keys() )
+
+    def __len__(self):
+        return len( self._index )
+
+    def contains(self, fileName):
+        return self.getKey( fileName ) in self._index
+
+    # True if the image was recorded as having no usable face
+    def isFailed(self, fileName):
+        return numpy.isnan( self._getRow( self.getKey(fileName) )[2] )
+
+    # EncodedFace stored for an image or .encoding file. Returns None if it was
+    # recorded as failed, and raises KeyError if it isn't in the store
+    def getFace(self, fileName):
+        return self.getFaceByKey( self.getKey(fileName) )
+
+    def getFaceByKey(self, key):
+        encoding, landmarks, angle = self._getRow( key )
+        if numpy.isnan( angle ):
+            return None
+        return EncodedFace.createFromArrays( encoding if not numpy.isnan( encoding[0] ) else None, landmarks, float(angle) )
+
+    def _getRow(self, key):
+        row = self._index[key]
+        if row >= self._numMapped:
+            self._map()
+        return ( self._mapped["encodings"][row], self._mapped["landmarks"][row], self._mapped["angles"][row] )
+
+    def _map(self):
+        if self._writers:
+            for writer in self._writers.values():
+                writer.flush()
+        self._mapped = {}
+        for name, ( fileName, dtype, shape ) in EncodingStore.COLUMNS.items():
+            if self._numRows == 0:
+                self._mapped[name] = numpy.zeros( ( 0, ) + shape, dtype=dtype )
+            else:
+                self._mapped[name] = numpy.memmap( self._getColumnFile(name), dtype=dtype, mode='r', shape=( self._numRows, ) + shape )
+        self._numMapped = self._numRows
+
+    # Stored faces, keyed by the directory of their image, for every key under dirPath.
+    # Each directory's rows are read at once into an EncodedFaces
+    def getFacesByDirectory(self, dirPath = None):
+        prefix = None if dirPath is None else self._getRelPath( dirPath ) + '/'
+        if prefix == "./":
+            prefix = None
+        rowsByDir = {}
+        for key in sorted( self._index.keys() ):
+            if prefix is not None and not key.startswith( prefix ):
+                continue
+            rowsByDir.setdefault( os.path.dirname( self.getFileName(key) ), [] ).append( self._index[key] )
+
+        if len(rowsByDir) > 0 and self._numMapped < self._numRows:
+            self._map()
+        facesByDir = {}
+        for dirName, rows in rowsByDir.items():
+            rows = numpy.array( rows )
+            rows = rows[~numpy.isnan( self._mapped["angles"][rows] )]
+            if len(rows) > 0:
+                facesByDir[dirName] = EncodedFaces.createFromArrays( self._mapped["encodings"][rows], self._mapped["landmarks"][rows], self._mapped["angles"][rows] )
+        return facesByDir
+
+    def addFace(self, fileName, encodedFace):
+        encoding = encodedFace.getEncodingArray()
+        if encoding is None:
+            encoding = numpy.full( EncodingStore.ENCODING_SIZE, numpy.nan, dtype=numpy.float32 )
+        self._append( self.getKey(fileName), encoding, encodedFace.getLandmarkArray(), encodedFace.getAngle() )
+
+    # Remember that an image has no usable face, so it isn't encoded again
+    def addFailed(self, fileName):
+        self._append( self.getKey(fileName), numpy.zeros( EncodingStore.ENCODING_SIZE, dtype=numpy.float32 ),
+                      numpy.zeros( ( EncodingStore.NUM_LANDMARKS, 2 ), dtype=numpy.int16 ), float('nan') )
+
+    def _append(self, key, encoding, landmarks, angle):
+        if self._readOnly:
+            raise Exception( "Encoding store {} was opened read only".format(self._path) )
+        if '\n' in key:
+            raise Exception( "Can't store {}".format(key) )
+        if encoding.shape != ( EncodingStore.ENCODING_SIZE, ):
+            raise Exception( "Encoding has shape {}, the store needs {}".format(encoding.shape, EncodingStore.ENCODING_SIZE) )
+
+        if self._writers is None:
+            # Drop any partly written row first
+            for name in EncodingStore.COLUMNS:
+                columnFile = self._getColumnFile(name)
+                if os.path.exists( columnFile ) and os.path.getsize( columnFile ) != self._numRows * self._getRowBytes(name):
+                    self._mapped = {}
+                    self._numMapped = 0
+                    with open( columnFile, 'r+b' ) as f:
+                        f.truncate( self._numRows * self._getRowBytes(name) )
+            indexFile = os.path.join( self._path, "index.txt" )
+            if self._validKeys is not None:
+                with open( indexFile, 'w', encoding='utf-8', newline='\n' ) as f:
+                    f.write( "".join( key + '\n' for key in self._validKeys ) )
+                self._validKeys = None
+            self._writers = { name: open( self._getColumnFile(name), 'ab' ) for name in EncodingStore.COLUMNS }
+            self._writers["index"] = open( indexFile, 'a', encoding='utf-8', newline='\n' )
+        self._writers["encodings"].write( encoding.astype(numpy.float32).tobytes() )
+        self._writers["landmarks"].write( landmarks.astype(numpy.int16).tobytes() )
+        self._writers["angles"].write( numpy.float32(angle).tobytes() )
+        self._writers["index"].write( key + '\n' )
+        self._index[key] = self._numRows
+        self._numRows += 1
+
+    def flush(self):
+        if self._writers:
+            for writer in self._writers.values():
+                writer.flush()
+
+    def close(self):
+        if self._writers:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = None
+        self._mapped = {}
+        self._numMapped = 0
+
+    # Rewrite the store with only the newest row of each key, dropping rows which were
+    # replaced and any partly written last row. Returns the number of rows dropped.
+    # Nothing else may have the store open meanwhile
+    def compact(self):
+        if self._readOnly:
+            raise Exception( "Encoding store {} was opened read only".format(self._path) )
+        self.close()
+        keys = sorted( self._index, key = self._index.get )
+        rows = numpy.array( [ self._index[key] for key in keys ], dtype=numpy.int64 )
+        for name, ( fileName, dtype, shape ) in EncodingStore.COLUMNS.items():
+            columnFile = self._getColumnFile( name )
+            with open( columnFile + ".tmp", 'wb' ) as f:
+                if self._numRows > 0:
+                    source = numpy.memmap( columnFile, dtype=dtype, mode='r', shape=( self._numRows, ) + shape )
+                    for start in range( 0, len(rows), EncodingStore.COMPACT_ROWS ):
+                        f.write( source[rows[start:start+EncodingStore.COMPACT_ROWS]].tobytes() )
+                    del source
+            os.replace( columnFile + ".tmp", columnFile )
+        indexFile = os.path.join( self._path, "index.txt" )
+        with open( indexFile + ".tmp", 'w', encoding='utf-8', newline='\n' ) as f:
+            f.write( "".join( key + '\n' for key in keys ) )
+        os.replace( indexFile + ".tmp", indexFile )
+
+        numDropped = self._numRows - len(keys)
+        self._index = { key: row for row, key in enumerate(keys) }
+        self._numRows = len(keys)
+        self._validKeys = None
+        return numDropped
+
+    # Add every .encoding file under inputPath. Returns the number added
+    def importJson(self, inputPath, recursive = True):
+        numAdded = 0
+        for root, subdirs, files in os.walk(inputPath):
+            for file in files:
+                if not file.endswith(".encoding"):
+                    continue
+                fileName = os.path.join( root, file )
+                try:
+                    self.addFace( fileName, EncodedFace.createFromFile( fileName ) )
+                    numAdded += 1
+                except Exception as e:
+                    print( "Failed to import {} - {}".format(fileName, str(e)) )
+            for file in files:
+                if file.endswith(".encoding.failed"):
+                    self.addFailed( os.path.join( root, file[:-len(".failed")] ) )
+            if not recursive:
+                break
+        return numAdded
+
+    # Write every stored face as a .encoding file, next to where its image was
+    def exportJson(self, outputPath = None):
+        numWritten = 0
+        for key in self.getKeys():
+            fileName = self.getFileName( key )
+            if outputPath is not None:
+                fileName = os.path.join( outputPath, *key.split('/') ) + ".encoding"
+            face = self.getFaceByKey( key )
+            os.makedirs( os.path.dirname(fileName), exist_ok=True )
+            if face is None:
+                with open( "{}.failed".format(fileName), 'w' ) as f:
+                    pass
+            else:
+                face.saveEncodings( fileName )
+                numWritten += 1
+        return numWritten
@@ -1,43 +1,179 @@
 # Class to manipulate a normalize a face image
-import imutils
-from imutils.face_utils import FaceAligner
-from imutils.face_utils import rect_to_bb
 from PIL import Image
-import cv2
-import dlib
-import face_recognition_models
+from Utils.Lazy.lazy_module import LazyModule
+from Utils.Process.stage_timer import StageTimer
+from Utils.Face.detect import FaceDetector
 import numpy
 
+# Heavy backends are only imported once a normalizer is created
+imutils = LazyModule( "imutils" )
+face_utils = LazyModule( "imutils.face_utils" )
+cv2 = LazyModule( "cv2" )
+dlib = LazyModule( "dlib" )
+face_recognition_models = LazyModule( "face_recognition_models" )
+
+# Where the face is in a normalized image, so the encoder doesn't have to find it again
+class FaceDetection:
+    def __init__(self, region, points = None, faceWidth = None, landmarksOutside = None):
+        # ( top, right, bottom, left ), as face_recognition locations are
+        self.region = region
+        # dlib's 68 landmark points as a (68,2) array, or None if they aren't known
+        self.points = points
+        # How wide the face was in the photo, in its pixels, and the fraction of its
+        # landmarks which were outside the photo, or None if they aren't known
+        self.faceWidth = faceWidth
+        self.landmarksOutside = landmarksOutside
+
+
 class FaceNormalizer:
+    # Images are resized to this width before the face is looked for
+    WORK_WIDTH = 800
+    # Faces are first looked for in a copy this wide, then again at full size only
+    # around the one found. Padding is the fraction of the face size searched on each side
+    COARSE_WIDTH = 200
+    REFINE_PADDING = 0.5
 
-    def __init__(self, size=256, align = True, histogram = True):
-        predictor = dlib.shape_predictor( face_recognition_models.pose_predictor_model_location() )
-        self._detector = dlib.get_frontal_face_detector()
+    # A coarseWidth of 0 looks for faces in the whole image at full size. detector is
+    # a FaceDetector, by default of dlib's frontal face detector alone
+    def __init__(self, size=256, align = True, histogram = True, coarseWidth = COARSE_WIDTH, detector = None):
+        self._predictor = dlib.shape_predictor( face_recognition_models.pose_predictor_model_location() )
+        self._detector = detector if detector is not None else FaceDetector()
+        self._detector.load()
         self._size = size
         self._align = align
         self._histogram = histogram
+        self._coarseWidth = coarseWidth
 
         if self._align:
-            self._aligner = FaceAligner( predictor=predictor, desiredFaceWidth = self._size)
+            self._aligner = face_utils.FaceAligner( predictor=self._predictor, desiredFaceWidth = self._size)
         else:
             self._aligner = None
 
 
+    def getDetector(self):
+        return self._detector
+
     def normalize(self, image):
-        npImg = numpy.array(image)
-        # PIL loads RGB, CV2 wants BGR
-        npImg = cv2.cvtColor(npImg, cv2.COLOR_RGB2BGR)
-        npImg = imutils.resize(npImg, width=800)
-        aligned = self._alignNpImg( npImg )
+        return self.normalizeWithDetection( image )[0]
+
+    # Normalize, also returning a FaceDetection of the face in the normalized image
+    def normalizeWithDetection(self, image):
+        npImg, detection = self.normalizeArray( image )
+        return Image.fromarray(npImg), detection
+
+    # As normalizeWithDetection, for a PIL image or RGB array, returning an RGB array.
+    # The image stays RGB throughout: faces are found in the grayscale image, and
+    # warpAffine doesn't mind the channel order. Stages are added to timer if given.
+    # sourceWidth is the width of the photo the array was decoded from, if it was
+    # decoded at a reduced size, so the detection's faceWidth is in the photo's pixels
+    def normalizeArray(self, image, timer = None, sourceWidth = None):
+        timer = timer if timer is not None else StageTimer()
+        npImg = image
+        if not isinstance( image, numpy.ndarray ):
+            sourceWidth = image.width
+            with timer.stage("decode"):
+                npImg = FaceNormalizer.decodeImage( image, FaceNormalizer.WORK_WIDTH )
+        if sourceWidth is None:
+            sourceWidth = npImg.shape[1]
+        with timer.stage("resize"):
+            if npImg.shape[1] != FaceNormalizer.WORK_WIDTH:
+                npImg = imutils.resize(npImg, width=FaceNormalizer.WORK_WIDTH)
+        aligned = self._alignNpImg( npImg, timer )
         if aligned is None:
             raise Exception("No face found in image!")
-        npImg = cv2.cvtColor(aligned, cv2.COLOR_BGR2RGB)
-        return Image.fromarray(npImg)
+        aligned[1].faceWidth *= sourceWidth / npImg.shape[1]
+        return aligned
+
+    # An RGB array of a PIL image, or the array itself. With width, a JPEG that hasn't
+    # been loaded yet is decoded at the smallest scale at least that wide, which for
+    # large photos takes a fraction of the time and memory of decoding it whole
+    @staticmethod
+    def decodeImage( image, width = None ):
+        if isinstance( image, numpy.ndarray ):
+            return image
+        if width is not None and image.format == "JPEG" and image.width >= width * 2:
+            image.draft( "RGB", ( width, max( 1, image.height * width // image.width ) ) )
+        if image.mode != "RGB":
+            image = image.convert( "RGB" )
+        return numpy.asarray( image )
 
 
-    def _alignNpImg(self, npImg):
-        gray = cv2.cvtColor(npImg, cv2.COLOR_BGR2GRAY)
-        rects = self._detector(gray, 1)
+    def _alignNpImg(self, npImg, timer):
+        with timer.stage("detect"):
+            found = self._findFace( npImg )
+            if found is None:
+                return None
+            gray, rect, ( offsetX, offsetY ) = found
+            shape = face_utils.shape_to_np( self._predictor(gray, rect) ) + ( offsetX, offsetY )
+            rect = dlib.rectangle( rect.left() + offsetX, rect.top() + offsetY, rect.right() + offsetX, rect.bottom() + offsetY )
+        with timer.stage("align"):
+            matrix = self._getAlignMatrix( shape )
+            output = cv2.warpAffine(npImg, matrix, (self._aligner.desiredFaceWidth, self._aligner.desiredFaceHeight), flags=cv2.INTER_CUBIC)
+
+        # Move the detection into the aligned image. The rotation is small, so
+        # the region keeps its center and is scaled like the face
+        points = numpy.rint( numpy.hstack( [ shape, numpy.ones( ( len(shape), 1 ) ) ] ).dot( matrix.T ) ).astype(numpy.int32)
+        scale = numpy.hypot( matrix[0, 0], matrix[0, 1] )
+        centerX, centerY = matrix.dot( [ ( rect.left() + rect.right() ) / 2, ( rect.top() + rect.bottom() ) / 2, 1 ] )
+        halfWidth = rect.width() * scale / 2
+        halfHeight = rect.height() * scale / 2
+        region = ( max( int( round( centerY - halfHeight ) ), 0 ), min( int( round( centerX + halfWidth ) ), output.shape[1] ),
+                   min( int( round( centerY + halfHeight ) ), output.shape[0] ), max( int( round( centerX - halfWidth ) ), 0 ) )
+        height, width = npImg.shape[:2]
+        outside = ( shape[:, 0] < 0 ) | ( shape[:, 0] >= width ) | ( shape[:, 1] < 0 ) | ( shape[:, 1] >= height )
+        return output, FaceDetection( region, points, rect.width(), float( numpy.mean( outside ) ) )
+
+    # ( gray, rect, offset ) for the face in npImg, with rect in the part of the image gray
+    # is of and offset where that part starts, or None if there's no face. The detector's
+    # cascade looks for the face in a small copy of the image, then HOG again in the
+    # grayscale of just the region around it. Only when the small copy has no face is
+    # the whole image searched with the cascade
+    def _findFace(self, npImg):
+        height, width = npImg.shape[:2]
+        scale = width / self._coarseWidth if self._coarseWidth else 1
+        if scale > 1:
+            small = cv2.resize( npImg, ( self._coarseWidth, max( int( round( height / scale ) ), 1 ) ), interpolation=cv2.INTER_AREA )
+            rects = self._detector.detect( cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), label = "coarse" )
+            if len(rects) > 0:
+                coarse = rects[0]
+                padding = FaceNormalizer.REFINE_PADDING * max( coarse.width(), coarse.height() )
+                left = max( int( ( coarse.left() - padding ) * scale ), 0 )
+                top = max( int( ( coarse.top() - padding ) * scale ), 0 )
+                right = min( int( numpy.ceil( ( coarse.right() + padding ) * scale ) ), width )
+                bottom = min( int( numpy.ceil( ( coarse.bottom() + padding ) * scale ) ), height )
+                gray = cv2.cvtColor( npImg[top:bottom, left:right], cv2.COLOR_RGB2GRAY )
+                # The face was found in the small copy, so it's big enough here without upsampling
+                rects = self._detector.detect( gray, [ ( "hog", 0 ) ], label = "refine" )
+                if len(rects) > 0:
+                    rect = rects[0]
+                else:
+                    rect = dlib.rectangle( int( coarse.left() * scale ) - left, int( coarse.top() * scale ) - top,
+                                           int( coarse.right() * scale ) - left, int( coarse.bottom() * scale ) - top )
+                return gray, rect, ( left, top )
+
+        gray = cv2.cvtColor(npImg, cv2.COLOR_RGB2GRAY)
+        rects = self._detector.detect( gray )
         if len(rects) == 0:
             return None
-        return self._aligner.align(npImg, gray, rects[0])
\ No newline at end of file
+        return gray, rects[0], ( 0, 0 )
+
+    # Same transform as imutils' FaceAligner.align, which doesn't return it
+    def _getAlignMatrix(self, shape):
+        (lStart, lEnd) = face_utils.FACIAL_LANDMARKS_68_IDXS["left_eye"]
+        (rStart, rEnd) = face_utils.FACIAL_LANDMARKS_68_IDXS["right_eye"]
+        leftEyeCenter = shape[lStart:lEnd].mean(axis=0).astype("int")
+        rightEyeCenter = shape[rStart:rEnd].mean(axis=0).astype("int")
+
+        dY = rightEyeCenter[1] - leftEyeCenter[1]
+        dX = rightEyeCenter[0] - leftEyeCenter[0]
+        angle = numpy.degrees(numpy.arctan2(dY, dX)) - 180
+
+        desiredLeftEye = self._aligner.desiredLeftEye
+        desiredDist = ( ( 1.0 - desiredLeftEye[0] ) - desiredLeftEye[0] ) * self._aligner.desiredFaceWidth
+        scale = desiredDist / numpy.sqrt((dX ** 2) + (dY ** 2))
+
+        eyesCenter = ( int( (leftEyeCenter[0] + rightEyeCenter[0]) // 2 ), int( (leftEyeCenter[1] + rightEyeCenter[1]) // 2 ) )
+        matrix = cv2.getRotationMatrix2D(eyesCenter, angle, scale)
+        matrix[0, 2] += ( self._aligner.desiredFaceWidth * 0.5 - eyesCenter[0] )
+        matrix[1, 2] += ( self._aligner.desiredFaceHeight * desiredLeftEye[1] - eyesCenter[1] )
+        return matrix
@@ -0,0 +1,215 @@
+# Class to estimate the head pose of many faces at once from their landmarks
+from Utils.Lazy.lazy_module import LazyModule
+import numpy
+
+cv2 = LazyModule( "cv2" )
+
+
+# Solves the same problem as cv2.solvePnP with SOLVEPNP_ITERATIVE, for a stack of
+# faces at a time. Each face starts from a closed form weak perspective pose and
+# is refined with a few Levenberg-Marquardt steps, all faces in the same arrays.
+# Faces which haven't settled after those steps are solved again with solvePnP
+class HeadPose:
+    # Identifies the solver for cache keys, as its angles differ a little from solvePnP's
+    SOLVER = "batched-lm-1"
+
+    # Which of dlib's 68 landmark points are used, and where they are on a generic head.
+    # Adapted from https://www.learnopencv.com/head-pose-estimation-using-opencv-and-dlib/
+    LANDMARKS = [ 30,   # Nose tip
+                  8,    # Chin
+                  36,   # Left eye left corner
+                  45,   # Right eye right corner
+                  48,   # Left mouth corner
+                  54 ]  # Right mouth corner
+
+    MODEL_POINTS = numpy.array([
+                                (0.0, 0.0, 0.0),  # Nose tip
+                                (0.0, -330.0, -65.0),  # Chin
+                                (-225.0, 170.0, -135.0),  # Left eye left corner
+                                (225.0, 170.0, -135.0),  # Right eye right corner
+                                (-150.0, -150.0, -125.0),  # Left Mouth corner
+                                (150.0, -150.0, -125.0)  # Right mouth corner
+                            ])
+
+    ITERATIONS = 10
+    # A face has converged once its last step changed the reprojection error by less than
+    # this fraction, or the error is next to nothing
+    CONVERGED_CHANGE = 1e-4
+    CONVERGED_COST = 1e-12
+
+    # The (N,6,2) points used for the pose from (N,68,2) landmark points
+    @staticmethod
+    def getImagePoints( landmarkArrays ):
+        return numpy.asarray( landmarkArrays, dtype=numpy.float64 )[:, HeadPose.LANDMARKS]
+
+    # Angles in degrees for (N,6,2) image points, in the order EncodedFace._estimatePose
+    # returns them, so the second array is the angle a face is turned by. imageSizes
+    # are the (height, width) of each face's image, or of all of them. Without fallback
+    # faces which didn't converge keep the batched solver's angles
+    @staticmethod
+    def estimate( imagePoints, imageSizes, iterations = ITERATIONS, fallback = True ):
+        rotations, _, converged = HeadPose.solve( imagePoints, imageSizes, iterations )
+        if fallback:
+            HeadPose.resolveUnconverged( imagePoints, imageSizes, rotations, None, converged )
+        return HeadPose.rotationsToAngles( rotations )
+
+    # Solve the faces which didn't converge again with cv2.solvePnP, in place
+    @staticmethod
+    def resolveUnconverged( imagePoints, imageSizes, rotations, translations, converged ):
+        stuck = numpy.flatnonzero( ~converged )
+        if len(stuck) > 0:
+            imagePoints = numpy.asarray( imagePoints, dtype=numpy.float64 )
+            imageSizes = HeadPose._getImageSizes( imageSizes, imagePoints.shape[0] )
+            stuckRotations, stuckTranslations = HeadPose.solveWithSolvePnP( imagePoints[stuck], imageSizes[stuck] )
+            rotations[stuck] = stuckRotations
+            if translations is not None:
+                translations[stuck] = stuckTranslations
+
+    # (N,2) ( height, width ) from the size of each image, or of all of them
+    @staticmethod
+    def _getImageSizes( imageSizes, numFaces ):
+        return numpy.broadcast_to( numpy.asarray( imageSizes, dtype=numpy.float64 )[..., :2], ( numFaces, 2 ) )
+
+    # (N,3,3) rotations and (N,3) translations which put the head model in each camera,
+    # and whether each face converged
+    @staticmethod
+    def solve( imagePoints, imageSizes, iterations = ITERATIONS ):
+        imagePoints = numpy.asarray( imagePoints, dtype=numpy.float64 )
+        numFaces = imagePoints.shape[0]
+        if numFaces == 0:
+            return numpy.zeros( ( 0, 3, 3 ) ), numpy.zeros( ( 0, 3 ) ), numpy.zeros( 0, dtype=bool )
+
+        # Camera internals, as in EncodedFace: the focal length is the image width
+        # and the centre is the middle of the image. Points are moved to where a
+        # camera with a focal length of 1 would see them
+        imageSizes = HeadPose._getImageSizes( imageSizes, numFaces )
+        focal = imageSizes[:, 1]
+        center = numpy.stack( ( imageSizes[:, 1] / 2, imageSizes[:, 0] / 2 ), axis=1 )
+        points = ( imagePoints - center[:, None, :] ) / focal[:, None, None]
+
+        rotations, translations = HeadPose._weakPerspective( points )
+        cost = HeadPose._cost( points, rotations, translations )
+        damping = numpy.full( numFaces, 1e-3 )
+        change = numpy.ones( numFaces )
+        for _ in range(iterations):
+            step = HeadPose._levenbergMarquardtStep( points, rotations, translations, damping )
+            newRotations = numpy.matmul( HeadPose.rodrigues( step[:, :3] ), rotations )
+            newTranslations = translations + step[:, 3:]
+            newCost = HeadPose._cost( points, newRotations, newTranslations )
+
+            # Each face keeps its step only if it helped
+            better = newCost < cost
+            change = numpy.where( better, ( cost - newCost ) / numpy.maximum( cost, 1e-300 ), 0.0 )
+            rotations = numpy.where( better[:, None, None], newRotations, rotations )
+            translations = numpy.where( better[:, None], newTranslations, translations )
+            cost = numpy.where( better, newCost, cost )
+            damping = numpy.where( better, damping / 10, damping * 10 )
+
+        # Still improving, or settled with the head behind the camera
+        camera, _ = HeadPose._project( rotations, translations )
+        converged = ( ( change < HeadPose.CONVERGED_CHANGE ) | ( cost < HeadPose.CONVERGED_COST ) ) & numpy.all( camera[..., 2] > 0, axis=1 ) & numpy.isfinite( cost )
+        return rotations, translations, converged
+
+    # Scaled orthographic pose from a least squares fit of the centred model to the centred
+    # points. Depth is ignored, which is close for a face a long way from the camera
+    @staticmethod
+    def _weakPerspective( points ):
+        model = HeadPose.MODEL_POINTS
+        modelCentre = model.mean( axis=0 )
+        pointsCentre = points.mean( axis=1 )
+        # (2,3) projection for each face, fit with the model's pseudo-inverse
+        projections = numpy.einsum( 'njk,ij->nki', points - pointsCentre[:, None, :], numpy.linalg.pinv( model - modelCentre ) )
+
+        # The closest two orthonormal rows give the rotation, their scale the distance
+        u, s, vt = numpy.linalg.svd( projections, full_matrices=False )
+        rows = numpy.matmul( u, vt )
+        scale = s.mean( axis=1 )
+        rotations = numpy.concatenate( ( rows, numpy.cross( rows[:, 0], rows[:, 1] )[:, None, :] ), axis=1 )
+
+        depth = 1.0 / scale
+        modelCentreInCamera = numpy.einsum( 'nij,j->ni', rotations, modelCentre )
+        translations = numpy.concatenate( ( pointsCentre * depth[:, None] - modelCentreInCamera[:, :2],
+                                            ( depth - modelCentreInCamera[:, 2] )[:, None] ), axis=1 )
+        return rotations, translations
+
+    @staticmethod
+    def _project( rotations, translations ):
+        camera = numpy.einsum( 'nij,pj->npi', rotations, HeadPose.MODEL_POINTS ) + translations[:, None, :]
+        return camera, camera[..., :2] / camera[..., 2:]
+
+    @staticmethod
+    def _cost( points, rotations, translations ):
+        _, projected = HeadPose._project( rotations, translations )
+        return numpy.sum( ( projected - points ) ** 2, axis=(1, 2) )
+
+    # The (N,6) step for every face, as a rotation vector applied before the current
+    # rotation and a change in translation
+    @staticmethod
+    def _levenbergMarquardtStep( points, rotations, translations, damping ):
+        camera, projected = HeadPose._project( rotations, translations )
+        residuals = ( projected - points ).reshape( ( points.shape[0], -1 ) )
+
+        x, y, z = camera[..., 0], camera[..., 1], camera[..., 2]
+        zero = numpy.zeros_like( z )
+        # How each projected point moves with the point in camera space
+        dProjected = numpy.stack( ( numpy.stack( ( 1 / z, zero, -x / z ** 2 ), axis=-1 ),
+                                    numpy.stack( ( zero, 1 / z, -y / z ** 2 ), axis=-1 ) ), axis=-2 )
+        # and how the point in camera space moves with a small rotation, then translation
+        rotated = camera - translations[:, None, :]
+        dCamera = numpy.concatenate( ( -HeadPose._skew( rotated ), numpy.broadcast_to( numpy.eye(3), rotated.shape + ( 3, ) ) ), axis=-1 )
+        jacobian = numpy.matmul( dProjected, dCamera ).reshape( ( points.shape[0], -1, 6 ) )
+
+        jtj = numpy.matmul( jacobian.transpose( 0, 2, 1 ), jacobian )
+        jtr = numpy.einsum( 'nki,nk->ni', jacobian, residuals )
+        jtj = jtj + damping[:, None, None] * ( numpy.eye(6) * jtj.diagonal( axis1=1, axis2=2 )[:, None, :] + numpy.eye(6) * 1e-12 )
+        return -numpy.linalg.solve( jtj, jtr[..., None] )[..., 0]
+
+    @staticmethod
+    def _skew( vectors ):
+        x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+        zero = numpy.zeros_like( x )
+        return numpy.stack( ( numpy.stack( ( zero, -z, y ), axis=-1 ),
+                              numpy.stack( ( z, zero, -x ), axis=-1 ),
+                              numpy.stack( ( -y, x, zero ), axis=-1 ) ), axis=-2 )
+
+    # (N,3,3) rotation matrices from (N,3) rotation vectors, as cv2.Rodrigues
+    @staticmethod
+    def rodrigues( rotationVectors ):
+        theta = numpy.linalg.norm( rotationVectors, axis=1 )
+        small = theta < 1e-12
+        safeTheta = numpy.where( small, 1.0, theta )
+        k = HeadPose._skew( rotationVectors / safeTheta[:, None] )
+        sinTheta = numpy.where( small, 0.0, numpy.sin( theta ) )[:, None, None]
+        cosTheta = numpy.where( small, 1.0, numpy.cos( theta ) )[:, None, None]
+        return numpy.eye(3) + sinTheta * k + ( 1 - cosTheta ) * numpy.matmul( k, k )
+
+    # Angles in degrees from rotation matrices. Adapted from
+    # https://stackoverflow.com/questions/44726404/camera-pose-from-solvepnp
+    # Only the second, the angle the face is turned by, is used
+    @staticmethod
+    def rotationsToAngles( rotations ):
+        cosBeta = numpy.sqrt( rotations[:, 2, 1] ** 2 + rotations[:, 2, 2] ** 2 )
+        alpha = numpy.arctan2( rotations[:, 1, 0], rotations[:, 0, 0] )
+        beta = numpy.arctan2( -rotations[:, 2, 0], cosBeta )
+        gamma = numpy.where( cosBeta < 1e-6, 0.0, numpy.arctan2( rotations[:, 2, 1], rotations[:, 2, 2] ) )
+        return numpy.degrees( alpha ), numpy.degrees( beta ), numpy.degrees( gamma )
+
+    # One cv2.solvePnP per face, as the pose used to be found. Used for faces the
+    # batched solver doesn't converge on, and to check and benchmark against
+    @staticmethod
+    def estimateWithSolvePnP( imagePoints, imageSizes ):
+        rotations, _ = HeadPose.solveWithSolvePnP( imagePoints, imageSizes )
+        return HeadPose.rotationsToAngles( rotations )
+
+    @staticmethod
+    def solveWithSolvePnP( imagePoints, imageSizes ):
+        imagePoints = numpy.asarray( imagePoints, dtype=numpy.float64 )
+        imageSizes = HeadPose._getImageSizes( imageSizes, imagePoints.shape[0] )
+        rotations = numpy.zeros( ( imagePoints.shape[0], 3, 3 ) )
+        translations = numpy.zeros( ( imagePoints.shape[0], 3 ) )
+        for idx, ( facePoints, ( height, width ) ) in enumerate( zip( imagePoints, imageSizes ) ):
+            camera_matrix = numpy.array( [[width, 0, width / 2], [0, width, height / 2], [0, 0, 1]], dtype="double" )
+            (success, rotation_vector, translation_vector) = cv2.solvePnP( HeadPose.MODEL_POINTS, facePoints, camera_matrix, numpy.zeros((4, 1)), flags=cv2.SOLVEPNP_ITERATIVE )
+            rotations[idx] = cv2.Rodrigues( rotation_vector )[0]
+            translations[idx] = translation_vector.reshape(3)
+        return rotations, translations
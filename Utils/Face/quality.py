@@ -0,0 +1,174 @@
+# Class to turn away photos not worth encoding, from the face found when normalizing
+from Utils.Face.pose import HeadPose
+import collections
+import threading
+import numpy
+
+
+# What QualityGate.check found for one face
+class QualityReport:
+    def __init__(self, reasons, angle, sharpness, faceWidth, deprioritize):
+        # Why the face failed the gate, empty if it passed
+        self.reasons = reasons
+        self.angle = angle
+        self.sharpness = sharpness
+        self.faceWidth = faceWidth
+        self.passed = len(reasons) == 0
+        self.rejected = not self.passed and not deprioritize
+        self.deprioritized = not self.passed and deprioritize
+
+    # Sharper and larger faces score higher, for ranking photos against each other
+    def getScore(self):
+        if self.faceWidth is None:
+            return self.sharpness
+        return self.sharpness * min( self.faceWidth / QualityGate.FULL_FACE_WIDTH, 1.0 )
+
+    def describe(self):
+        return ", ".join( self.reasons )
+
+
+# Raised for faces the quality gate rejects. Unlike images without a face they aren't
+# marked as failed, so they're checked again once the thresholds change
+class QualityRejected(Exception):
+    pass
+
+
+# Counts of faces checked and each reason they failed, added up across threads
+class QualityStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def record(self, report):
+        with self._lock:
+            self._counts["checked"] += 1
+            self._counts["passed" if report.passed else "rejected" if report.rejected else "deprioritized"] += 1
+            for reason in report.reasons:
+                self._counts["reason " + reason] += 1
+
+    def getCounts(self):
+        with self._lock:
+            return dict( self._counts )
+
+    def printStats(self):
+        counts = self.getCounts()
+        print( "Quality gate: {} checked, {} passed, {} deprioritized, {} rejected".format( counts.get("checked", 0), counts.get("passed", 0),
+                                                                                         counts.get("deprioritized", 0), counts.get("rejected", 0) ) )
+        for key, count in sorted( counts.items(), key = lambda item: -item[1] ):
+            if key.startswith("reason "):
+                print( "  {:<20}{:>10}".format( key[len("reason "):], count ) )
+
+
+# Checks run on a normalized face and its FaceDetection, before it's encoded. A check
+# with a threshold of None isn't run. Faces failing any check are rejected, or with
+# deprioritize are encoded as cheaply as possible instead. Each process has its own
+# stats, so workers print theirs as they do their detector's
+class QualityGate:
+    # Faces at least this wide in the photo score as well as any larger
+    FULL_FACE_WIDTH = 300
+    # How far around each eye's landmarks its region reaches, as a fraction of its width
+    EYE_PADDING = 0.25
+    # What addArguments adds, for callers passing them on to another tool's args
+    ARGUMENTS = [ "minSharpness", "minFaceWidth", "maxYaw", "maxLandmarksOutside", "minEyeContrast", "qualityAction" ]
+
+    _shared = {}
+    _sharedLock = threading.Lock()
+
+    def __init__(self, minSharpness = None, minFaceWidth = None, maxYaw = None, maxLandmarksOutside = None, minEyeContrast = None, deprioritize = False):
+        self._minSharpness = minSharpness
+        self._minFaceWidth = minFaceWidth
+        self._maxYaw = maxYaw
+        self._maxLandmarksOutside = maxLandmarksOutside
+        self._minEyeContrast = minEyeContrast
+        self._deprioritize = deprioritize
+        self._stats = QualityStats()
+
+    # The gate the quality arguments ask for, or None if they set no thresholds
+    @staticmethod
+    def createFromArgs( args ):
+        gate = QualityGate( getattr(args, "minSharpness", None), getattr(args, "minFaceWidth", None), getattr(args, "maxYaw", None),
+                            getattr(args, "maxLandmarksOutside", None), getattr(args, "minEyeContrast", None), getattr(args, "qualityAction", "reject") == "deprioritize" )
+        return gate if gate.isEnabled() else None
+
+    # One gate for each set of thresholds in this process, so stats add up across the
+    # images and threads using them. None if args sets no thresholds
+    @staticmethod
+    def getShared( args ):
+        gate = QualityGate.createFromArgs( args )
+        if gate is None:
+            return None
+        with QualityGate._sharedLock:
+            return QualityGate._shared.setdefault( tuple( gate.getKeyData() ), gate )
+
+    @staticmethod
+    def addArguments( parser ):
+        parser.add_argument("--minSharpness", type=float, help="Quality gate: least variance of the Laplacian of the normalized face, lower is blurrier. Disabled by default", default=None)
+        parser.add_argument("--minFaceWidth", type=float, help="Quality gate: least width of the face in the photo, in pixels. Disabled by default", default=None)
+        parser.add_argument("--maxYaw", type=float, help="Quality gate: most degrees the face can be turned, from its landmarks. Disabled by default", default=None)
+        parser.add_argument("--maxLandmarksOutside", type=float, help="Quality gate: largest fraction of landmarks outside the photo, for faces cut off by the frame. Disabled by default", default=None)
+        parser.add_argument("--minEyeContrast", type=float, help="Quality gate: least contrast of the eyes relative to the face, for eyes covered by hair, hands or sunglasses. Disabled by default", default=None)
+        parser.add_argument("--qualityAction", choices=[ "reject", "deprioritize" ], help="What happens to faces failing the quality gate: reject skips them, deprioritize encodes them with a single jitter. Defaults to reject", default="reject")
+
+    def isEnabled(self):
+        return any( threshold is not None for threshold in ( self._minSharpness, self._minFaceWidth, self._maxYaw, self._maxLandmarksOutside, self._minEyeContrast ) )
+
+    def isDeprioritizing(self):
+        return self._deprioritize
+
+    def getStats(self):
+        return self._stats
+
+    # Identifies the thresholds for cache keys
+    def getKeyData(self):
+        return [ self._minSharpness, self._minFaceWidth, self._maxYaw, self._maxLandmarksOutside, self._minEyeContrast, self._deprioritize ]
+
+    # Check a normalized RGB array and the FaceDetection of the face in it, and record the result
+    def check(self, npImg, detection):
+        gray = numpy.dot( npImg[..., :3], numpy.array( [ 0.299, 0.587, 0.114 ], dtype=numpy.float32 ) )
+        top, right, bottom, left = detection.region
+        face = gray[top:bottom, left:right]
+        sharpness = QualityGate.getSharpness( face )
+        _, angles, _ = HeadPose.estimate( HeadPose.getImagePoints( detection.points[None] ), npImg.shape[:2] )
+        angle = float(angles[0])
+
+        reasons = []
+        if self._minSharpness is not None and sharpness < self._minSharpness:
+            reasons.append( "blurry" )
+        if self._minFaceWidth is not None and detection.faceWidth is not None and detection.faceWidth < self._minFaceWidth:
+            reasons.append( "small face" )
+        if self._maxYaw is not None and abs(angle) > self._maxYaw:
+            reasons.append( "turned away" )
+        if self._maxLandmarksOutside is not None and detection.landmarksOutside is not None and detection.landmarksOutside > self._maxLandmarksOutside:
+            reasons.append( "cut off" )
+        if self._minEyeContrast is not None and QualityGate.getEyeContrast( gray, face, detection.points ) < self._minEyeContrast:
+            reasons.append( "eyes covered" )
+
+        report = QualityReport( reasons, angle, sharpness, detection.faceWidth, self._deprioritize )
+        self._stats.record( report )
+        return report
+
+    # Variance of the 4-neighbour Laplacian. Normalized faces are all about the same
+    # size, so this compares between photos
+    @staticmethod
+    def getSharpness( gray ):
+        if gray.shape[0] < 3 or gray.shape[1] < 3:
+            return 0.0
+        laplacian = 4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:]
+        return float( laplacian.var() )
+
+    # The lower of each eye region's standard deviation over the face's. An eye covered by
+    # something plain is flatter than the rest of the face, where an open one is busier
+    @staticmethod
+    def getEyeContrast( gray, face, points ):
+        faceDeviation = float( face.std() ) if face.size > 0 else 0.0
+        if faceDeviation == 0:
+            return 0.0
+        contrasts = []
+        for eye in ( points[36:42], points[42:48] ):
+            minX, minY = eye.min( axis=0 )
+            maxX, maxY = eye.max( axis=0 )
+            padding = QualityGate.EYE_PADDING * ( maxX - minX )
+            region = gray[ max( int( minY - padding ), 0 ):max( int( numpy.ceil( maxY + padding ) ), 0 ),
+                           max( int( minX - padding ), 0 ):max( int( numpy.ceil( maxX + padding ) ), 0 ) ]
+            contrasts.append( float( region.std() ) / faceDeviation if region.size > 0 else 0.0 )
+        return min( contrasts )
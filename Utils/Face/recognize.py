@@ -1,13 +1,15 @@
 # Class to manipulate a normalize a face image
-import imutils
-from imutils.face_utils import FaceAligner
-from imutils.face_utils import rect_to_bb
 from PIL import Image
-import cv2
-import dlib
-import face_recognition_models
+from Utils.Lazy.lazy_module import LazyModule
 import numpy
 
+# Heavy backends are only imported once a normalizer is created
+imutils = LazyModule( "imutils" )
+face_utils = LazyModule( "imutils.face_utils" )
+cv2 = LazyModule( "cv2" )
+dlib = LazyModule( "dlib" )
+face_recognition_models = LazyModule( "face_recognition_models" )
+
 class FaceNormalizer:
 
     def __init__(self, size=256, align = True, histogram = True):
@@ -18,7 +20,7 @@ class FaceNormalizer:
         self._histogram = histogram
 
         if self._align:
-            self._aligner = FaceAligner( predictor=predictor)
+            self._aligner = face_utils.FaceAligner( predictor=predictor)
         else:
             self._aligner = None
 
@@ -40,15 +40,17 @@ class VamFace:
         # values, defaulting to 0-1.0 if a value is not present
         self.morphFloats = []
         self.morphInfo = []
+        minValues = self.minFace._getMorphValues() if not self.minFace is None else {}
+        maxValues = self.maxFace._getMorphValues() if not self.maxFace is None else {}
         for morph in self.morphs:
             minVal = 0
             maxVal = 1.0
             defaultVal = 0
 
-            val = self.minFace._getMorphValue(morph['name']) if not self.minFace is None else None
+            val = minValues.get( morph['name'] )
             minVal = float(val) if not val is None else minVal
 
-            val = self.maxFace._getMorphValue(morph['name']) if not self.maxFace is None else None
+            val = maxValues.get( morph['name'] )
             maxVal = float(val) if not val is None else maxVal
 
             if 'value' in morph:
@@ -56,6 +58,34 @@ class VamFace:
             self.morphFloats.append( defaultVal )
             self.morphInfo.append( { 'min': minVal, 'max': maxVal, 'name': morph['name'] } )
 
+    # Data needed to rebuild this face with createFromTemplateData, without the original files
+    def getTemplateData(self):
+        self.updateJson()
+        return { 'json': self.jsonData,
+                 'min': [ info['min'] for info in self.morphInfo ],
+                 'max': [ info['max'] for info in self.morphInfo ] }
+
+    @staticmethod
+    def createFromTemplateData( templateData ):
+        newFace = VamFace(None)
+        newFace.jsonData = copy.deepcopy( templateData['json'] )
+        newFace._storables = newFace.jsonData["atoms"][0]["storables"]
+        newFace.morphs = VamFace.getStorable( newFace._storables, "geometry" )['morphs']
+        newFace.headRotation = VamFace.getStorable( newFace._storables, "headControl")['rotation']
+
+        names = [ morph['name'] for morph in newFace.morphs ]
+        newFace.minFace = VamFace._createValueFace( names, templateData['min'] )
+        newFace.maxFace = VamFace._createValueFace( names, templateData['max'] )
+        newFace._createMorphFloats()
+        return newFace
+
+    # A face holding only morph names and values, as the min/max faces are used
+    @staticmethod
+    def _createValueFace( names, values ):
+        valueFace = VamFace(None)
+        valueFace.morphs = [ { 'name': name, 'value': value } for name, value in zip( names, values ) ]
+        return valueFace
+
     # Note: msgpack really only is good for verifying a cache uses the same face, not for really saving off faces
     @staticmethod
     def msgpack_encode(obj):
@@ -290,6 +320,14 @@ class VamFace:
         morph = self._getMorph(key)
         return morph['value'] if morph and 'value' in morph else None
 
+    # All morph values by name. Where a name repeats the first morph wins, as in _getMorph
+    def _getMorphValues(self):
+        values = {}
+        for morph in self.morphs:
+            if morph['name'] not in values:
+                values[morph['name']] = morph['value'] if 'value' in morph else None
+        return values
+
     @staticmethod
     def setStorable(storables, id, param, value, create = False ):
         storable = VamFace.getStorable(storables, id, create)
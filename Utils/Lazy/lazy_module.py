@@ -0,0 +1,36 @@
+# Class to defer importing heavy modules (dlib, cv2, tensorflow...) until first use
+import importlib
+
+
+class LazyModule:
+
+    # Each name is tried in order, so alternatives can be given for a module
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            error = None
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError as e:
+                    error = e
+            if self._module is None:
+                raise error
+        return self._module
+
+    # Import now, such as before forking workers that should share the module
+    def load(self):
+        return self._load()
+
+    def isLoaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<LazyModule {} ({})>".format( "/".join(self._names), "loaded" if self.isLoaded() else "not loaded" )
@@ -0,0 +1,127 @@
+# Class to keep a model's weights and everything its Config needs in one memory-mappable file
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy
+from Utils.Training.config import Config
+from Utils.Prediction.numpy_model import NumpyModel
+
+# File layout:
+#   MAGIC | header length (uint64, little endian) | JSON header | arrays
+# Every array starts on an ALIGNMENT boundary, so it can be used straight from the mapped file.
+# The header holds a hash of everything else in it and of the arrays, so the bundle can
+# be identified without reading all of it
+#
+# A distilled bundle (see the DistillModels tool) also lists heads. Its config
+# then only generates the shared inputs, and each head is a slice of the outputs
+# with the config of the model it replaces
+class ModelBundle:
+    MAGIC = b"F2VBNDL\0"
+    FORMAT_VERSION = 1
+    ALIGNMENT = 64
+
+    def __init__(self, header, layers, mappedFile = None):
+        self._header = header
+        self._layers = layers
+        # Arrays from load() point into this, so it has to stay open
+        self._mappedFile = mappedFile
+
+    @staticmethod
+    def getBundlePath( modelFile ):
+        return os.path.splitext(modelFile)[0] + ".bundle"
+
+    # heads is a list of ( name, config, outputCount ), in output order
+    @staticmethod
+    def create( numpyModel, config, heads = None ):
+        header = { "format_version": ModelBundle.FORMAT_VERSION }
+        if heads is None:
+            config.setShape( ( numpyModel.getInputSize(), numpyModel.getOutputSize() ) )
+        else:
+            config.setShape( ( numpyModel.getInputSize(), 0 ) )
+            headList = []
+            start = 0
+            for name, headConfig, outputCount in heads:
+                headList.append( { "name": name, "config": headConfig.getBundleData(), "outputs": [ start, start + outputCount ] } )
+                start += outputCount
+            if start != numpyModel.getOutputSize():
+                raise Exception( "Heads have {} outputs but the model has {}".format(start, numpyModel.getOutputSize()) )
+            header["heads"] = headList
+        header["config"] = config.getBundleData()
+        return ModelBundle( header, numpyModel.getLayers() )
+
+    def getNumpyModel(self):
+        return NumpyModel( self._layers )
+
+    def createConfig(self):
+        return Config.createFromBundleData( self._header["config"] )
+
+    # SHA1 of the bundle's header and arrays, or None for a bundle saved before it was kept
+    def getContentHash(self):
+        return self._header.get( "content_hash" )
+
+    def isDistilled(self):
+        return "heads" in self._header
+
+    # List of ( name, config, ( start, end ) ) for a distilled bundle
+    def createHeads(self):
+        return [ ( head["name"], Config.createFromBundleData( head["config"] ), tuple(head["outputs"]) ) for head in self._header.get("heads", []) ]
+
+    def save(self, path):
+        layerSpecs = []
+        arrays = []
+        offset = 0
+        for spec, layerArrays in self._layers:
+            arraySpecs = {}
+            for name, array in layerArrays.items():
+                array = numpy.ascontiguousarray( array, dtype=numpy.float32 )
+                arraySpecs[name] = { "offset": offset, "shape": list(array.shape) }
+                arrays.append( ( offset, array ) )
+                offset = ModelBundle._align( offset + array.nbytes )
+            layerSpecs.append( { "spec": spec, "arrays": arraySpecs } )
+
+        header = dict( self._header )
+        header.pop( "content_hash", None )
+        header["layers"] = layerSpecs
+        hasher = hashlib.sha1( json.dumps( header, sort_keys=True ).encode('utf-8') )
+        for _, array in arrays:
+            hasher.update( array.tobytes() )
+        header["content_hash"] = hasher.hexdigest()
+        headerBytes = json.dumps( header ).encode('utf-8')
+        dataStart = ModelBundle._align( len(ModelBundle.MAGIC) + 8 + len(headerBytes) )
+
+        with open(path, 'wb') as f:
+            f.write( ModelBundle.MAGIC )
+            f.write( struct.pack( "<Q", len(headerBytes) ) )
+            f.write( headerBytes )
+            for arrayOffset, array in arrays:
+                f.seek( dataStart + arrayOffset )
+                f.write( array.tobytes() )
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            mappedFile = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+
+        magicLen = len(ModelBundle.MAGIC)
+        if mappedFile[:magicLen] != ModelBundle.MAGIC:
+            raise Exception("{} is not a model bundle".format(path))
+        headerLen = struct.unpack( "<Q", mappedFile[magicLen:magicLen+8] )[0]
+        header = json.loads( mappedFile[magicLen+8:magicLen+8+headerLen].decode('utf-8') )
+        if header["format_version"] != ModelBundle.FORMAT_VERSION:
+            raise Exception("Bundle format mismatch! File was {}, reader was {}".format(header["format_version"], ModelBundle.FORMAT_VERSION))
+        dataStart = ModelBundle._align( magicLen + 8 + headerLen )
+
+        layers = []
+        for layerSpec in header.pop("layers"):
+            arrays = {}
+            for name, arraySpec in layerSpec["arrays"].items():
+                count = int( numpy.prod( arraySpec["shape"] ) )
+                arrays[name] = numpy.frombuffer( mappedFile, dtype=numpy.float32, count=count, offset=dataStart + arraySpec["offset"] ).reshape( arraySpec["shape"] )
+            layers.append( ( layerSpec["spec"], arrays ) )
+        return ModelBundle( header, layers, mappedFile )
+
+    @staticmethod
+    def _align( offset ):
+        return ( offset + ModelBundle.ALIGNMENT - 1 ) // ModelBundle.ALIGNMENT * ModelBundle.ALIGNMENT
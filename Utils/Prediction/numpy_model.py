@@ -0,0 +1,130 @@
+# Class to run exported Dense/LeakyReLU/Dropout networks with only NumPy
+import json
+import os
+import numpy
+
+
+class NumpyModel:
+    FORMAT_VERSION = 1
+    ACTIVATIONS = { "linear": lambda x: x,
+                    "relu": lambda x: numpy.maximum(x, 0),
+                    "tanh": numpy.tanh,
+                    "sigmoid": lambda x: 1 / (1 + numpy.exp(-x)) }
+
+    # layers is a list of ( spec, arrays ) where spec is a dict with a "type"
+    def __init__(self, layers):
+        self._layers = layers
+        self._ops = [ self._createOp(spec, arrays) for spec, arrays in layers ]
+
+    @staticmethod
+    def getExportPath( modelFile ):
+        return os.path.splitext(modelFile)[0] + ".npz"
+
+    def _createOp(self, spec, arrays):
+        layerType = spec["type"]
+        if layerType == "dense":
+            kernel = arrays["kernel"]
+            bias = arrays.get("bias")
+            activation = NumpyModel.ACTIVATIONS[ spec.get("activation", "linear") ]
+            def dense(x):
+                x = numpy.matmul(x, kernel)
+                if bias is not None:
+                    x += bias
+                return activation(x)
+            return dense
+        if layerType == "leaky_relu":
+            alpha = numpy.float32(spec["alpha"])
+            return lambda x: numpy.where( x > 0, x, x * alpha )
+        if layerType == "scale_shift":
+            scale = arrays["scale"]
+            shift = arrays["shift"]
+            return lambda x: x * scale + shift
+        if layerType == "activation":
+            return NumpyModel.ACTIVATIONS[ spec["activation"] ]
+        raise Exception( "Unsupported layer type {}".format(layerType) )
+
+    def getLayers(self):
+        return self._layers
+
+    def getInputSize(self):
+        return self._layers[0][1]["kernel"].shape[0]
+
+    def getOutputSize(self):
+        denseLayers = [ arrays for spec, arrays in self._layers if spec["type"] == "dense" ]
+        return denseLayers[-1]["kernel"].shape[1]
+
+    def predict(self, rows, batch_size = 4096):
+        inputs = numpy.asarray(rows, dtype=numpy.float32)
+        outputs = []
+        for start in range(0, len(inputs), batch_size):
+            x = inputs[start:start+batch_size]
+            for op in self._ops:
+                x = op(x)
+            outputs.append(x)
+        return numpy.concatenate(outputs)
+
+    def save(self, path):
+        specs = []
+        arrays = {}
+        for idx, ( spec, layerArrays ) in enumerate(self._layers):
+            specs.append( spec )
+            for name, array in layerArrays.items():
+                arrays[ "{}_{}".format(idx, name) ] = array
+        header = { "format_version": NumpyModel.FORMAT_VERSION, "layers": specs }
+        with open(path, 'wb') as f:
+            numpy.savez( f, header=numpy.array( json.dumps(header) ), **arrays )
+
+    @staticmethod
+    def load(path):
+        with numpy.load(path, allow_pickle=False) as data:
+            header = json.loads( str(data["header"]) )
+            if header["format_version"] != NumpyModel.FORMAT_VERSION:
+                raise Exception("Model format mismatch! File was {}, reader was {}".format(header["format_version"], NumpyModel.FORMAT_VERSION))
+            layers = []
+            for idx, spec in enumerate(header["layers"]):
+                prefix = "{}_".format(idx)
+                arrays = { key[len(prefix):]: data[key].astype(numpy.float32) for key in data.files if key.startswith(prefix) }
+                layers.append( ( spec, arrays ) )
+        return NumpyModel( layers )
+
+    # Convert a Keras model made of a single chain of supported layers. Nested
+    # models, as TrainSelf creates, are flattened
+    @staticmethod
+    def fromKeras(model):
+        layers = []
+        NumpyModel._appendKerasLayers( model, layers )
+        if len(layers) == 0 or layers[0][0]["type"] != "dense":
+            raise Exception("Model must start with a Dense layer")
+        return NumpyModel( layers )
+
+    @staticmethod
+    def _appendKerasLayers(model, layers):
+        for layer in model.layers:
+            layerType = layer.__class__.__name__
+            config = layer.get_config()
+            if hasattr(layer, "layers"):
+                NumpyModel._appendKerasLayers( layer, layers )
+            elif layerType in ( "InputLayer", "Dropout" ):
+                # Dropout does nothing at inference
+                continue
+            elif layerType == "Dense":
+                weights = layer.get_weights()
+                arrays = { "kernel": weights[0].astype(numpy.float32) }
+                if config.get("use_bias", True):
+                    arrays["bias"] = weights[1].astype(numpy.float32)
+                layers.append( ( { "type": "dense", "activation": config["activation"] }, arrays ) )
+            elif layerType == "LeakyReLU":
+                layers.append( ( { "type": "leaky_relu", "alpha": float(config["alpha"]) }, {} ) )
+            elif layerType == "Activation":
+                layers.append( ( { "type": "activation", "activation": config["activation"] }, {} ) )
+            elif layerType == "BatchNormalization":
+                # Inference only needs a per-feature scale and shift
+                weights = dict( zip( [ w.name.split('/')[-1].split(':')[0] for w in layer.weights ], layer.get_weights() ) )
+                variance = weights["moving_variance"]
+                gamma = weights.get("gamma", numpy.ones_like(variance))
+                beta = weights.get("beta", numpy.zeros_like(variance))
+                scale = gamma / numpy.sqrt( variance + config["epsilon"] )
+                shift = beta - weights["moving_mean"] * scale
+                layers.append( ( { "type": "scale_shift" }, { "scale": scale.astype(numpy.float32), "shift": shift.astype(numpy.float32) } ) )
+            else:
+                raise Exception( "Layer {} of type {} can't be exported".format(layer.name, layerType) )
@@ -0,0 +1,409 @@
+# Class to run several trained models over a tree of encoded faces
+import os
+import collections
+import numpy
+from Utils.Training.config import Config
+from Utils.Training.param_generator import FaceRequirements
+from Utils.Face.encoded import EncodedFace
+from Utils.Face.vam import VamFace
+from Utils.Cache.result_cache import ResultCache
+from Utils.Prediction.numpy_model import NumpyModel
+from Utils.Prediction.bundle import ModelBundle
+
+
+# A single person (directory of encodings) and the predictions made for it
+class Person:
+    def __init__(self, name, relPath, faces):
+        self.name = name
+        self.relPath = relPath
+        self.faces = list(faces)
+        # modelName -> list of predicted morph floats
+        self.predictions = {}
+        # Configs with the same angles share running per-angle averages
+        self._faceBuckets = {}
+        self._facesKey = None
+
+    # Cache key for the set of faces, independent of their order
+    def getFacesKey(self):
+        if self._facesKey is None:
+            self._facesKey = ResultCache.hashBytes( *sorted( ResultCache.hashJson( face.getEncodingJson() ) for face in self.faces ) )
+        return self._facesKey
+
+    def getFaceBuckets(self, config):
+        key = tuple(config.getAngles())
+        if key not in self._faceBuckets:
+            self._faceBuckets[key] = config.createFaceBuckets( self.faces )
+        return self._faceBuckets[key]
+
+    def addFace(self, face):
+        self._facesKey = None
+        self.faces.append( face )
+        for faceBuckets in self._faceBuckets.values():
+            faceBuckets.addFace( face )
+
+    def removeFace(self, face):
+        self._facesKey = None
+        self.faces.remove( face )
+        for faceBuckets in self._faceBuckets.values():
+            faceBuckets.removeFace( face )
+
+    def getPredictionName(self, modelName):
+        return "{}_{}".format(self.name, modelName)
+
+    def getOutputPath(self, outputDir, modelName):
+        return os.path.join( outputDir, self.relPath, "{}.json".format(self.getPredictionName(modelName)) )
+
+    def getMergedOutputPath(self, outputDir, modelName, fromJson):
+        outName = "{}_mergedWith_{}.json".format( self.getPredictionName(modelName), os.path.splitext(os.path.basename(fromJson))[0])
+        return os.path.join( outputDir, self.relPath, outName )
+
+
+# A loaded model plus the config it was trained with. Heads of a distilled
+# model share one model and inputConfig, and each only uses its outputRange
+class PredictionModel:
+    def __init__(self, modelFile, model, config, name = None, inputConfig = None, outputRange = None):
+        self.modelFile = modelFile
+        self.configFile = os.path.splitext(modelFile)[0] + ".json"
+        self.name = name if name is not None else os.path.splitext(os.path.basename(modelFile))[0]
+        self.model = model
+        self.config = config
+        self.inputConfig = inputConfig if inputConfig is not None else config
+        self.outputRange = outputRange
+        self._templateFace = None
+        # Content hashes, only needed when caching results
+        self.configHash = None
+        self.modelHash = None
+
+    def getTemplateJson(self):
+        return self.config.getBaseJsonPath()
+
+    # Template used by MergeJson. Kept separately since the Config's base face
+    # loses its animatable flags when predictions are written out
+    def getTemplateFace(self):
+        if self._templateFace is None:
+            self._templateFace = self.config.createTemplateFace()
+        return self._templateFace
+
+    # Fill the base face with a prediction, in the same state it would be saved to disk
+    def getPredictedFace(self, prediction):
+        face = self.config.getBaseFace()
+        face.importFloatList( prediction )
+        # discard animatable flags
+        face.updateJson( discardAnimatable = True )
+        return face
+
+    def generateRow(self, person):
+        outRow = self.inputConfig.generateParams( [], person.getFaceBuckets( self.inputConfig ) )
+        return outRow[:self.inputConfig.getShape()[0]]
+
+    # Row from encoding and look files, as MakePrediction reads them
+    def generateRowFromFiles(self, relatedFiles):
+        outRow = self.inputConfig.generateParams( relatedFiles )
+        return outRow[:self.inputConfig.getShape()[0]]
+
+    # Outputs for every head sharing this model
+    def runModel(self, rows):
+        return self.model.predict( numpy.array(rows) )
+
+    def selectOutputs(self, outputs):
+        if self.outputRange is None:
+            return outputs
+        return outputs[:, self.outputRange[0]:self.outputRange[1]]
+
+    def predict(self, rows):
+        return self.selectOutputs( self.runModel( rows ) )
+
+
+# Keras model which can predict from any thread
+class KerasModel:
+    def __init__(self, model, graph):
+        self._model = model
+        self._graph = graph
+
+    def predict(self, rows):
+        with self._graph.as_default():
+            return self._model.predict( rows )
+
+
+class MultiModelPredictor:
+
+    # Models are loaded from an up to date bundle or export made by the ExportModel
+    # tool and run with NumPy, unless useKeras is set or neither exists.
+    # modelFiles may also name .bundle files directly, including distilled ones
+    # from the DistillModels tool, which load as one model per head
+    def __init__(self, modelFiles, cache = None, useKeras = False):
+        self._cache = cache
+        self._session = None
+        self._models = []
+        for modelFile in modelFiles:
+            self._models.extend( self._loadPredictionModels( modelFile, useKeras ) )
+
+    # The bundle to load modelFile from, or None to load the model and its config separately.
+    # A bundle is out of date once the model, its config or the base, min or max JSON
+    # files the config loads change after it
+    @staticmethod
+    def _findBundle(modelFile, useKeras):
+        bundleFile = ModelBundle.getBundlePath( modelFile )
+        if useKeras or not os.path.exists( bundleFile ):
+            return None
+        if bundleFile == modelFile:
+            return bundleFile
+        sourceFiles = [ modelFile ]
+        configFile = os.path.splitext(modelFile)[0] + ".json"
+        if os.path.exists( configFile ):
+            sourceFiles.extend( Config.getSourceFiles( configFile ) )
+        bundleTime = os.path.getmtime( bundleFile )
+        if all( bundleTime >= os.path.getmtime( sourceFile ) for sourceFile in sourceFiles if os.path.exists( sourceFile ) ):
+            return bundleFile
+        print( "Model bundle {} is older than {} or its config, not using it".format(bundleFile, modelFile) )
+        return None
+
+    # The config rows for modelFile are generated with, loaded without the model itself
+    @staticmethod
+    def loadInputConfig(modelFile, useKeras = False):
+        bundleFile = MultiModelPredictor._findBundle( modelFile, useKeras )
+        if bundleFile is not None:
+            return ModelBundle.load( bundleFile ).createConfig()
+        return Config.createFromFile( os.path.splitext(modelFile)[0] + ".json" )
+
+    def _loadPredictionModels(self, modelFile, useKeras):
+        bundleFile = MultiModelPredictor._findBundle( modelFile, useKeras )
+        if bundleFile is not None:
+            print( "Loading model bundle {}".format(bundleFile))
+            bundle = ModelBundle.load( bundleFile )
+            model = bundle.getNumpyModel()
+            config = bundle.createConfig()
+            if bundle.isDistilled():
+                predictionModels = [ PredictionModel( modelFile, model, headConfig, name = name, inputConfig = config, outputRange = outputRange )
+                                     for name, headConfig, outputRange in bundle.createHeads() ]
+            else:
+                predictionModels = [ PredictionModel( modelFile, model, config ) ]
+            if self._cache:
+                # The bundle holds the configs and the weights. Heads share rows but not predictions
+                bundleHash = bundle.getContentHash()
+                if bundleHash is None:
+                    bundleHash = ResultCache.hashFile( bundleFile )
+                for predictionModel in predictionModels:
+                    predictionModel.configHash = bundleHash
+                    predictionModel.modelHash = ResultCache.hashBytes( bundleHash, predictionModel.name ) if bundle.isDistilled() else bundleHash
+            return predictionModels
+
+        configFile = os.path.splitext(modelFile)[0] + ".json"
+        print( "Loading model {} with config {}".format(modelFile, configFile))
+        config = Config.createFromFile( configFile )
+        predictionModel = PredictionModel( modelFile, self._loadModel( modelFile, useKeras ), config )
+        if self._cache:
+            predictionModel.configHash = ResultCache.hashFile( configFile )
+            predictionModel.modelHash = ResultCache.hashFile( modelFile )
+        return [ predictionModel ]
+
+    def _loadModel(self, modelFile, useKeras):
+        exportFile = NumpyModel.getExportPath( modelFile )
+        if not useKeras:
+            if os.path.exists( exportFile ) and os.path.getmtime( exportFile ) >= os.path.getmtime( modelFile ):
+                return NumpyModel.load( exportFile )
+            print( "No up to date export for {}, using Keras. Run the ExportModel tool to avoid loading TensorFlow".format(modelFile) )
+
+        # Delay heavy imports
+        from keras.models import load_model
+        import tensorflow as tf
+        if self._session is None:
+            self._session = MultiModelPredictor._createSession()
+        model = load_model( modelFile )
+        # Keras needs the graph the models were loaded into when predicting from another thread
+        return KerasModel( model, tf.get_default_graph() )
+
+    @staticmethod
+    def _createSession():
+        # Work around low-memory GPU issue
+        import tensorflow as tf
+        tfconfig = tf.ConfigProto()
+        tfconfig.gpu_options.allow_growth = True
+        return tf.Session(config=tfconfig)
+
+    def getModels(self):
+        return self._models
+
+    # What the models read from faces, so faces can be encoded with only that
+    def getRequirements(self):
+        return FaceRequirements.merge( [ predictionModel.inputConfig.getRequirements() for predictionModel in self._models ] )
+
+    # The same for modelFiles, from only their configs, before the models are loaded
+    @staticmethod
+    def loadRequirements(modelFiles):
+        requirementsList = []
+        for modelFile in modelFiles:
+            bundleFile = MultiModelPredictor._findBundle( modelFile, False )
+            if bundleFile is not None:
+                config = ModelBundle.load( bundleFile ).createConfig()
+            else:
+                config = Config.createFromFile( os.path.splitext(modelFile)[0] + ".json" )
+            requirementsList.append( config.getRequirements() )
+        return FaceRequirements.merge( requirementsList )
+
+    # Lists of models which share a network, in load order
+    def getModelGroups(self):
+        groups = collections.OrderedDict()
+        for predictionModel in self._models:
+            groups.setdefault( id(predictionModel.model), [] ).append( predictionModel )
+        return list( groups.values() )
+
+    # Walk inputDir once, parsing every encoding into a Person per directory.
+    # With an encodingStore, the faces stored for images under inputDir are used instead
+    @staticmethod
+    def loadPersons(inputDir, recursive = True, encodingStore = None):
+        if encodingStore is not None:
+            facesByDir = encodingStore.getFacesByDirectory( inputDir )
+            if not recursive:
+                facesByDir = { root: faces for root, faces in facesByDir.items() if os.path.abspath(root) == os.path.abspath(inputDir) }
+            return MultiModelPredictor.personsFromFaces( inputDir, facesByDir )
+
+        persons = []
+        for root, subdirs, files in os.walk(inputDir):
+            faces = []
+            for file in files:
+                if not file.endswith(".encoding"):
+                    continue
+                try:
+                    faces.append( EncodedFace.createFromFile( os.path.join(root, file) ) )
+                except Exception:
+                    pass
+
+            if len(faces) > 0:
+                persons.append( MultiModelPredictor.createPerson( inputDir, root, faces ) )
+
+            if not recursive:
+                break
+        return persons
+
+    # Create Persons from faces already in memory, keyed by directory
+    @staticmethod
+    def personsFromFaces(inputDir, facesByDir):
+        persons = []
+        for root in sorted(facesByDir.keys()):
+            faces = facesByDir[root]
+            if len(faces) > 0:
+                persons.append( MultiModelPredictor.createPerson( inputDir, root, faces ) )
+        return persons
+
+    @staticmethod
+    def createPerson(inputDir, root, faces):
+        relPath = os.path.relpath(root, inputDir)
+        if relPath == os.curdir:
+            relPath = ""
+        return Person( os.path.split(os.path.abspath(root))[-1], relPath, faces )
+
+    # Run every model over every person with a single predict per network
+    def predict(self, persons):
+        for group in self.getModelGroups():
+            # Heads in a group share their inputs, so any of them can generate the rows
+            firstModel = group[0]
+            rows = []
+            rowPersons = []
+            predictionKeys = []
+            for person in persons:
+                try:
+                    row = self._generateRow( firstModel, person )
+                except Exception as e:
+                    for predictionModel in group:
+                        person.predictions.pop( predictionModel.name, None )
+                    print( "ERROR: Failed to generate params for {} with {} - {}".format(person.name, firstModel.name, str(e)))
+                    continue
+
+                keys = {}
+                if self._cache:
+                    rowHash = ResultCache.hashJson(row)
+                    missing = False
+                    for predictionModel in group:
+                        keys[predictionModel.name] = ResultCache.hashBytes( rowHash, predictionModel.modelHash )
+                        cached = self._cache.get( ResultCache.PREDICTION, keys[predictionModel.name] )
+                        if cached is ResultCache.MISSING:
+                            missing = True
+                        else:
+                            person.predictions[predictionModel.name] = cached
+                    if not missing:
+                        continue
+                rows.append( row )
+                rowPersons.append( person )
+                predictionKeys.append( keys )
+
+            if len(rows) == 0:
+                continue
+
+            outputs = firstModel.runModel( rows )
+            for predictionModel in group:
+                predictions = predictionModel.selectOutputs( outputs )
+                for person, prediction, keys in zip( rowPersons, predictions, predictionKeys ):
+                    person.predictions[predictionModel.name] = [float(round(x,5)) for x in prediction]
+                    if self._cache:
+                        self._cache.put( ResultCache.PREDICTION, keys[predictionModel.name], person.predictions[predictionModel.name] )
+        return persons
+
+    def _generateRow(self, predictionModel, person):
+        if not self._cache:
+            return predictionModel.generateRow( person )
+
+        rowKey = ResultCache.hashBytes( person.getFacesKey(), predictionModel.configHash )
+        cached = self._cache.get( ResultCache.ROW, rowKey )
+        if cached is None:
+            raise Exception( "Params could not be generated (cached)" )
+        if cached is not ResultCache.MISSING:
+            return cached
+
+        try:
+            row = predictionModel.generateRow( person )
+        except Exception:
+            self._cache.put( ResultCache.ROW, rowKey, None )
+            raise
+        self._cache.put( ResultCache.ROW, rowKey, row )
+        return row
+
+    # Write each person's prediction as a VaM look, as MakePrediction does
+    def savePredictions(self, persons, outputDir):
+        for predictionModel in self._models:
+            for person in persons:
+                if predictionModel.name not in person.predictions:
+                    continue
+                try:
+                    face = predictionModel.getPredictedFace( person.predictions[predictionModel.name] )
+                    outputFullPath = person.getOutputPath( outputDir, predictionModel.name )
+                    os.makedirs( os.path.dirname(outputFullPath), exist_ok=True )
+                    face.save( outputFullPath )
+                    print( "Generated {}".format(outputFullPath) )
+                except Exception as e:
+                    print( "ERROR: Failed to save prediction for {} - {}".format(person.name, str(e)) )
+
+    # Merge a person's prediction with fromFace in memory, as MergeJson does with invertTemplate
+    def mergePrediction(self, predictionModel, person, fromFace):
+        toFace = predictionModel.getPredictedFace( person.predictions[predictionModel.name] )
+        return VamFace.mergeFaces( templateFace=predictionModel.getTemplateFace(), toFace=toFace, fromFace=fromFace, invertTemplate = True, copyNonMorphs = True)
+
+    # Merge each prediction with fromJson and save the result
+    def saveMergedPredictions(self, persons, fromJson, outputDir):
+        fromFace = VamFace( fromJson, discardExtra = False )
+        for predictionModel in self._models:
+            for person in persons:
+                if predictionModel.name not in person.predictions:
+                    continue
+                try:
+                    newFace = self.mergePrediction( predictionModel, person, fromFace )
+                    outputFullPath = person.getMergedOutputPath( outputDir, predictionModel.name, fromJson )
+                    os.makedirs( os.path.dirname(outputFullPath), exist_ok=True )
+                    newFace.save( outputFullPath )
+                    print( "Generated {}".format(outputFullPath) )
+                except Exception as e:
+                    print( "ERROR: Failed to merge prediction for {} - {}".format(person.name, str(e)) )
+
+    # Delete what savePredictions and saveMergedPredictions wrote for each person, such
+    # as once every image of them is gone. outputDir is left alone if it's None
+    def deletePredictions(self, persons, fromJson, mergedOutputDir, outputDir = None):
+        for predictionModel in self._models:
+            for person in persons:
+                person.predictions.pop( predictionModel.name, None )
+                outputPaths = [ person.getMergedOutputPath( mergedOutputDir, predictionModel.name, fromJson ) ]
+                if outputDir is not None:
+                    outputPaths.append( person.getOutputPath( outputDir, predictionModel.name ) )
+                for outputFullPath in outputPaths:
+                    if os.path.exists( outputFullPath ):
+                        os.remove( outputFullPath )
+                        print( "Removed {}".format(outputFullPath) )
@@ -0,0 +1,256 @@
+# Classes to serve image -> VaM look predictions over HTTP, batching concurrent requests together
+import base64
+import collections
+import io
+import json
+import math
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from Utils.Face.vam import VamFace
+from Utils.Prediction.predictor import Person
+
+
+# Keeps the most recent timings of each stage and reports percentiles over them,
+# and the sizes of the batches predicted apart from the timings
+class LatencyStats:
+
+    def __init__(self, maxSamples = 10000):
+        self._maxSamples = maxSamples
+        self._samples = {}
+        self._counts = collections.Counter()
+        self._numBatches = 0
+        self._batchedPeople = 0
+        self._maxBatchSize = 0
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = collections.deque(maxlen=self._maxSamples)
+            self._samples[stage].append(seconds)
+            self._counts[stage] += 1
+
+    def recordBatch(self, size):
+        with self._lock:
+            self._numBatches += 1
+            self._batchedPeople += size
+            self._maxBatchSize = max( self._maxBatchSize, size )
+
+    def getBatchReport(self):
+        with self._lock:
+            return { "count": self._numBatches, "mean": self._batchedPeople / self._numBatches if self._numBatches > 0 else 0, "max": self._maxBatchSize }
+
+    @staticmethod
+    def _percentile(sortedSamples, percent):
+        idx = int(math.ceil(percent / 100.0 * len(sortedSamples))) - 1
+        return sortedSamples[max(0, idx)]
+
+    def getReport(self):
+        report = {}
+        with self._lock:
+            for stage, samples in self._samples.items():
+                sortedSamples = sorted(samples)
+                if len(sortedSamples) == 0:
+                    continue
+                report[stage] = { "count": self._counts[stage],
+                                  "mean": sum(sortedSamples) / len(sortedSamples),
+                                  "p50": self._percentile(sortedSamples, 50),
+                                  "p90": self._percentile(sortedSamples, 90),
+                                  "p99": self._percentile(sortedSamples, 99),
+                                  "max": sortedSamples[-1] }
+        report["batches"] = self.getBatchReport()
+        return report
+
+    def printReport(self):
+        report = self.getReport()
+        batches = report.pop( "batches" )
+        for stage, stats in sorted(report.items()):
+            print( "{:>12}: n={:<7} mean={:.4f} p50={:.4f} p90={:.4f} p99={:.4f} max={:.4f}".format(
+                   stage, stats["count"], stats["mean"], stats["p50"], stats["p90"], stats["p99"], stats["max"] ) )
+        print( "{:>12}: n={:<7} mean size={:.2f} max size={}".format( "batches", batches["count"], batches["mean"], batches["max"] ) )
+
+
+# A person waiting on the batcher
+class PendingPrediction:
+    def __init__(self, person):
+        self.person = person
+        self.looks = None
+        self.error = None
+        self.submitTime = time.time()
+        self._doneEvent = threading.Event()
+
+    def finish(self, looks = None, error = None):
+        self.looks = looks
+        self.error = error
+        self._doneEvent.set()
+
+    def wait(self, timeout = None):
+        return self._doneEvent.wait(timeout)
+
+
+# Collects people from concurrent requests and predicts them together, so each
+# model runs one predict over a full batch instead of one row at a time
+class MicroBatcher(threading.Thread):
+
+    def __init__(self, multiPredictor, fromFace, stats, maxBatchSize = 64, maxWait = 0.01):
+        super().__init__(daemon=True)
+        self._multiPredictor = multiPredictor
+        self._fromFace = fromFace
+        self._stats = stats
+        self._maxBatchSize = maxBatchSize
+        self._maxWait = maxWait
+        self._queue = queue.Queue()
+
+    def submit(self, person):
+        pending = PendingPrediction(person)
+        self._queue.put(pending)
+        return pending
+
+    def _collectBatch(self):
+        batch = [ self._queue.get() ]
+        deadline = time.time() + self._maxWait
+        while len(batch) < self._maxBatchSize:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append( self._queue.get(timeout=remaining) )
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._collectBatch()
+            start = time.time()
+            for pending in batch:
+                self._stats.record( "queue", start - pending.submitTime )
+            self._stats.recordBatch( len(batch) )
+
+            try:
+                self._multiPredictor.predict( [ pending.person for pending in batch ] )
+            except Exception as e:
+                for pending in batch:
+                    pending.finish( error = str(e) )
+                continue
+            predicted = time.time()
+            self._stats.record( "predict", predicted - start )
+
+            # Config base faces are shared, so merging stays on this thread
+            for pending in batch:
+                looks = {}
+                try:
+                    for predictionModel in self._multiPredictor.getModels():
+                        if predictionModel.name not in pending.person.predictions:
+                            continue
+                        newFace = self._multiPredictor.mergePrediction( predictionModel, pending.person, self._fromFace )
+                        newFace.updateJson()
+                        looks[predictionModel.name] = newFace.jsonData
+                except Exception as e:
+                    pending.finish( error = str(e) )
+                    continue
+                if len(looks) > 0:
+                    pending.finish( looks = looks )
+                else:
+                    pending.finish( error = "No model could make a prediction" )
+            self._stats.record( "merge", time.time() - predicted )
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, multiPredictor, fromJson, encodeArgs, maxBatchSize = 64, maxWait = 0.01, encodeThreads = 1):
+        super().__init__(address, PredictionRequestHandler)
+        # Delay heavy imports
+        from Tools.CreateTrainingEncodings import encodePilImage
+        self._encodePilImage = encodePilImage
+
+        self.stats = LatencyStats()
+        self.encodeArgs = encodeArgs
+        # Each of the requests encoding at once checks out a normalizer, made once here so
+        # dlib's models aren't loaded again for every request's thread
+        self._normalizers = queue.Queue()
+        for _ in range(encodeThreads):
+            self._normalizers.put( self._createNormalizer() )
+        self.batcher = MicroBatcher( multiPredictor, VamFace( fromJson, discardExtra = False ), self.stats, maxBatchSize, maxWait )
+        self.batcher.start()
+
+    def _createNormalizer(self):
+        if not self.encodeArgs.normalize:
+            return None
+        from Utils.Face.normalize import FaceNormalizer
+        return FaceNormalizer( self.encodeArgs.normalizeSize )
+
+    def encodeImages(self, images):
+        faces = []
+        normalizer = self._normalizers.get()
+        try:
+            for image in images:
+                try:
+                    encodedFace, _ = self._encodePilImage( image, normalizer, self.encodeArgs )
+                    faces.append( encodedFace )
+                except Exception:
+                    pass
+        finally:
+            self._normalizers.put( normalizer )
+        return faces
+
+    def predict(self, name, images):
+        start = time.time()
+        faces = self.encodeImages( images )
+        encoded = time.time()
+        self.stats.record( "encode", encoded - start )
+        if len(faces) == 0:
+            raise Exception( "No faces found in the images" )
+
+        pending = self.batcher.submit( Person( name, "", faces ) )
+        pending.wait()
+        self.stats.record( "total", time.time() - start )
+        if pending.error:
+            raise Exception( pending.error )
+        return pending.looks
+
+
+# POST /predict with {"name": ..., "images": [base64, ...]} and/or {"paths": [...]}
+# GET /stats for per-stage latency percentiles
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+
+    def _sendJson(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._sendJson( 200, self.server.stats.getReport() )
+        else:
+            self._sendJson( 404, { "error": "Unknown path {}".format(self.path) } )
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._sendJson( 404, { "error": "Unknown path {}".format(self.path) } )
+            return
+        try:
+            start = time.time()
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads( self.rfile.read(length).decode('utf-8') )
+            images = []
+            for data in request.get("images", []):
+                images.append( Image.open( io.BytesIO( base64.b64decode(data) ) ) )
+            for path in request.get("paths", []):
+                images.append( Image.open(path) )
+            self.server.stats.record( "decode", time.time() - start )
+
+            looks = self.server.predict( request.get("name", "person"), images )
+            self._sendJson( 200, { "looks": looks } )
+        except Exception as e:
+            self._sendJson( 400, { "error": str(e) } )
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,61 @@
+# Class to poll a directory tree for new, changed or removed images
+import os
+import fnmatch
+
+
+class FolderWatcher:
+
+    def __init__(self, inputPath, fileFilter, recursive = True):
+        self._inputPath = inputPath
+        self._fileFilter = fileFilter
+        self._recursive = recursive
+        # path -> (mtime, size) of files that have been reported
+        self._known = {}
+        # path -> (mtime, size) of files that have changed but not yet settled
+        self._pending = {}
+        self._firstPoll = True
+
+    def _scan(self):
+        found = {}
+        for root, subdirs, files in os.walk(self._inputPath):
+            for filter in self._fileFilter:
+                for file in fnmatch.filter(files, filter):
+                    path = os.path.join(root, file)
+                    # Skip images written by the normalizer
+                    if os.path.splitext(path)[0].endswith("normalized"):
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = ( stat.st_mtime, stat.st_size )
+            if not self._recursive:
+                break
+        return found
+
+    # Returns ( changed, removed ) lists of paths since the last poll. A new or
+    # modified file is only reported once it looks the same on two polls in a
+    # row, so files which are still being copied in aren't picked up half written.
+    # Everything present on the first poll is reported straight away.
+    def poll(self):
+        found = self._scan()
+
+        changed = []
+        for path, stat in found.items():
+            if self._known.get(path) == stat:
+                continue
+            if self._firstPoll or self._pending.get(path) == stat:
+                changed.append(path)
+                self._known[path] = stat
+                self._pending.pop(path, None)
+            else:
+                self._pending[path] = stat
+
+        removed = [ path for path in self._known if path not in found ]
+        for path in removed:
+            del self._known[path]
+        for path in [ path for path in self._pending if path not in found ]:
+            del self._pending[path]
+
+        self._firstPoll = False
+        return sorted(changed), sorted(removed)
@@ -0,0 +1,42 @@
+# Class to add up how long each stage of a pipeline takes
+import contextlib
+import threading
+import time
+
+
+# Safe to share between threads. Each process keeps its own
+class StageTimer:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [ count, seconds ], in the order stages were first seen
+        self._stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, count = 1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record( name, time.time() - start, count )
+
+    def record(self, name, seconds, count = 1):
+        with self._lock:
+            totals = self._stages.setdefault( name, [ 0, 0.0 ] )
+            totals[0] += count
+            totals[1] += seconds
+
+    def getStats(self):
+        with self._lock:
+            return { name: tuple(totals) for name, totals in self._stages.items() }
+
+    # One row per stage, and a last one for total = ( count, seconds ) if given
+    def printStats(self, title = "stage", total = None, sort = False):
+        rows = list( self.getStats().items() )
+        if sort:
+            rows.sort()
+        if total is not None:
+            rows.append( ( "total", total ) )
+        print( "{:<16}{:>10}{:>12}{:>14}{:>14}".format( title, "count", "seconds", "ms each", "per second" ) )
+        for name, ( count, seconds ) in rows:
+            print( "{:<16}{:>10}{:>12.2f}{:>14.2f}{:>14.2f}".format( name, count, seconds, 1000 * seconds / count if count > 0 else 0, count / seconds if seconds > 0 else 0 ) )
@@ -0,0 +1,119 @@
+# Class to start worker processes which share models loaded once in the parent
+import multiprocessing
+import queue
+import sys
+import time
+
+
+# Where fork is available the parent calls loader before starting the workers, and
+# each worker is given what it returned. Its memory is shared copy-on-write, so
+# models aren't loaded again or held once per worker. With spawn each worker calls
+# loader itself, so it must be picklable, such as a module level function or a
+# functools.partial of one. Workers run target( procId, shared, *args )
+class WorkerPool:
+
+    def __init__(self, numWorkers, loader = None, startMethod = None):
+        self._numWorkers = numWorkers
+        self._loader = loader
+        self._startMethod = WorkerPool.getStartMethod( startMethod )
+        self._context = multiprocessing.get_context( self._startMethod )
+        self._statsQueue = self._context.Queue()
+        self._procs = []
+
+    # Fork where the platform has it. macOS system frameworks aren't safe to use
+    # after forking, so it spawns there as on Windows
+    @staticmethod
+    def getStartMethod( startMethod = None ):
+        if startMethod is not None:
+            return startMethod
+        if "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin":
+            return "fork"
+        return "spawn"
+
+    # Queues and events used with the workers should come from this context
+    def getContext(self):
+        return self._context
+
+    def start(self, target, args = ()):
+        forked = self._startMethod == "fork"
+        shared = None
+        if forked and self._loader is not None:
+            loadStart = time.time()
+            shared = self._loader()
+            print( "Loaded shared models in {:.2f} seconds, {}".format( time.time() - loadStart, WorkerPool.describeMemory( WorkerPool.getMemory() ) ) )
+
+        started = time.time()
+        for idx in range(self._numWorkers):
+            # Forked workers are handed shared as it is, spawned ones load their own
+            proc = self._context.Process( target=WorkerPool._run, args=( idx, target, args, None if forked else self._loader, shared, started, self._statsQueue ) )
+            proc.start()
+            self._procs.append( proc )
+
+    def isAlive(self):
+        return any( proc.is_alive() for proc in self._procs )
+
+    def join(self):
+        # Read stats before joining so workers aren't blocked flushing the queue
+        stats = {}
+        while len(stats) < 2 * len(self._procs):
+            try:
+                procId, stage, values = self._statsQueue.get( block=True, timeout=1 )
+                stats[( procId, stage )] = values
+            except queue.Empty:
+                if not self.isAlive():
+                    break
+        for proc in self._procs:
+            proc.join()
+        self.printStats( stats )
+
+    def printStats(self, stats):
+        print( "{:<8}{:>12}{:>14}{:>18}{:>14}{:>18}".format( "worker", "startup s", "ready RSS MB", "ready private MB", "exit RSS MB", "exit private MB" ) )
+        for idx in range(len(self._procs)):
+            startup, readyRss, readyPrivate = stats.get( ( idx, "ready" ), ( None, None, None ) )
+            exitRss, exitPrivate = stats.get( ( idx, "exit" ), ( None, None ) )
+            print( "{:<8}{:>12}{:>14}{:>18}{:>14}{:>18}".format( idx, WorkerPool._format( startup ), WorkerPool._format( readyRss ), WorkerPool._format( readyPrivate ),
+                                                               WorkerPool._format( exitRss ), WorkerPool._format( exitPrivate ) ) )
+        print( "Workers were started with {}".format( self._startMethod ) )
+
+    @staticmethod
+    def _format( value ):
+        return "-" if value is None else "{:.2f}".format( value )
+
+    @staticmethod
+    def _run( procId, target, args, loader, shared, started, statsQueue ):
+        if loader is not None:
+            shared = loader()
+        statsQueue.put( ( procId, "ready", ( time.time() - started, ) + WorkerPool.getMemory() ) )
+        try:
+            target( procId, shared, *args )
+        finally:
+            statsQueue.put( ( procId, "exit", WorkerPool.getMemory() ) )
+
+    # ( RSS, private ) memory of this process in MB. Private memory leaves out pages still
+    # shared with the parent, so it shows what each worker really adds. It's None where
+    # /proc doesn't say, and RSS is then the peak, or None too on Windows
+    @staticmethod
+    def getMemory():
+        try:
+            values = {}
+            with open( "/proc/self/smaps_rollup" ) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == "kB":
+                        values[parts[0].rstrip(":")] = int( parts[1] )
+            return values["Rss"] / 1024, ( values["Private_Clean"] + values["Private_Dirty"] ) / 1024
+        except (OSError, KeyError):
+            try:
+                import resource
+            except ImportError:
+                return None, None
+            maxRss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+            # Bytes on macOS, KB elsewhere
+            return maxRss / ( 1024 * 1024 if sys.platform == "darwin" else 1024 ), None
+
+    @staticmethod
+    def describeMemory( memory ):
+        rss, private = memory
+        if rss is None:
+            return "memory unknown"
+        return "{:.2f} MB RSS".format( rss ) if private is None else "{:.2f} MB RSS, {:.2f} MB private".format( rss, private )
@@ -2,19 +2,31 @@
 
 import json
 import os
+import copy
 from Utils.Face.vam import VamFace
-from Utils.Training.param_generator import ParamGenerator
+from Utils.Training.param_generator import ParamGenerator, FaceBuckets, FaceRequirements
 
 class Config:
     CONFIG_VERSION = 1
 
-    def __init__(self, configJson, basePath = "" ):
-        minJson = os.path.join(basePath, configJson["minJson"]) if "minJson" in configJson else None
-        maxJson = os.path.join(basePath, configJson["maxJson"]) if "maxJson" in configJson else None
-        self._baseFace = VamFace( os.path.join(basePath, configJson["baseJson"]), minJson, maxJson )
-        self._baseFace.trimToAnimatable()
+    # If baseFaceData (from VamFace.getTemplateData) is given, the base face is
+    # rebuilt from it rather than loading the base, min and max JSON files
+    def __init__(self, configJson, basePath = "", baseFaceData = None, paramShape = None ):
+        self._configJson = configJson
+        if baseFaceData is None:
+            minJson = os.path.join(basePath, configJson["minJson"]) if "minJson" in configJson else None
+            maxJson = os.path.join(basePath, configJson["maxJson"]) if "maxJson" in configJson else None
+            self._baseJsonPath = os.path.join(basePath, configJson["baseJson"])
+            self._baseFace = VamFace( self._baseJsonPath, minJson, maxJson )
+            self._baseFace.trimToAnimatable()
+            baseFaceData = self._baseFace.getTemplateData()
+        else:
+            self._baseJsonPath = None
+            self._baseFace = VamFace.createFromTemplateData( baseFaceData )
+        # Kept so the untouched base face can be recreated, e.g. as a MergeJson template
+        self._baseFaceData = copy.deepcopy( baseFaceData )
 
-        self._paramShape = None
+        self._paramShape = tuple(paramShape) if paramShape is not None else None
         angles = set()
         self._input_params = self._parseParams(configJson.get("inputs", []), angles)
         self._output_params = self._parseParams(configJson.get("outputs", []), angles)
@@ -47,26 +59,82 @@ class Config:
 
         return Config( jsonData, os.path.dirname(fileName) )
 
+    # The config file and the base, min and max JSON files it loads
+    @staticmethod
+    def getSourceFiles( fileName ):
+        with open(fileName, 'r') as f:
+            jsonData = json.load(f)
+        basePath = os.path.dirname(fileName)
+        return [ fileName ] + [ os.path.join(basePath, jsonData[key]) for key in ( "baseJson", "minJson", "maxJson" ) if key in jsonData ]
+
+    # Everything needed to recreate this config with createFromBundleData, without any look JSON files
+    def getBundleData(self):
+        return { "config_version": Config.CONFIG_VERSION,
+                 "config": { "inputs": self._configJson.get("inputs", []), "outputs": self._configJson.get("outputs", []) },
+                 "baseFace": self._baseFaceData,
+                 "paramShape": self._paramShape }
+
+    @staticmethod
+    def createFromBundleData( bundleData ):
+        if bundleData["config_version"] != Config.CONFIG_VERSION:
+            raise Exception("Config version mismatch! Bundle was {}, reader was {}".format(bundleData["config_version"], Config.CONFIG_VERSION ) )
+        return Config( bundleData["config"], baseFaceData = bundleData["baseFace"], paramShape = bundleData["paramShape"] )
+
+    # Config generating the inputs of every one of configs once, for a model
+    # predicting all of their outputs from them (see the DistillModels tool)
+    @staticmethod
+    def createSharedInputConfig( configs ):
+        inputs = []
+        seen = set()
+        for config in configs:
+            for param in config._configJson.get("inputs", []):
+                key = json.dumps( param, sort_keys=True )
+                if key not in seen:
+                    seen.add( key )
+                    inputs.append( param )
+        return Config( { "inputs": inputs, "outputs": [] }, baseFaceData = configs[0]._baseFaceData )
+
+    # A fresh copy of the trimmed base face, with its animatable flags
+    def createTemplateFace(self):
+        return VamFace.createFromTemplateData( self._baseFaceData )
+
+    def setShape(self, paramShape):
+        self._paramShape = tuple(paramShape)
+
     def getBaseFace(self):
         return self._baseFace
 
+    def getBaseJsonPath(self):
+        return self._baseJsonPath
+
     def getShape(self):
         return self._paramShape
 
     def getAngles(self):
         return self._angles
 
-    def generateParams(self, relatedFiles ):
+    # Which angles of faces this config reads encodings and landmarks at
+    def getRequirements(self):
+        return FaceRequirements.createFromParams( self._input_params + self._output_params, self._angles )
+
+    # Create running per-angle averages of faces, suitable for generateParams
+    def createFaceBuckets(self, faces = []):
+        faceBuckets = FaceBuckets( self._angles )
+        for face in faces:
+            faceBuckets.addFace( face )
+        return faceBuckets
+
+    def generateParams(self, relatedFiles, faceBuckets = None, encodingStore = None ):
         if self._paramShape is None:
-            paramGen = ParamGenerator( self._input_params, self._angles, relatedFiles, self._baseFace )
+            paramGen = ParamGenerator( self._input_params, self._angles, relatedFiles, self._baseFace, faceBuckets, encodingStore )
             inputParams = paramGen.getParams()
             inputLen = len(inputParams)
-            paramGen = ParamGenerator( self._output_params, self._angles, relatedFiles, self._baseFace )
+            paramGen = ParamGenerator( self._output_params, self._angles, relatedFiles, self._baseFace, faceBuckets, encodingStore )
             outputParams = paramGen.getParams()
             outputLen = len(outputParams)
             self._paramShape = (inputLen, outputLen)
             outParams = inputParams + outputParams
         else:
-            paramGen = ParamGenerator( self._input_params + self._output_params, self._angles, relatedFiles, self._baseFace )
+            paramGen = ParamGenerator( self._input_params + self._output_params, self._angles, relatedFiles, self._baseFace, faceBuckets, encodingStore )
             outParams = paramGen.getParams()
         return outParams
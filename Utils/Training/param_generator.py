@@ -3,18 +3,165 @@
 import json
 import csv
 import math
+import numpy
 from Utils.Face.encoded import EncodedFace
 from Utils.Face.vam import VamFace
 
-class ParamGenerator:
+# Running per-angle sums of encodings and landmark sizes. Adding or removing
+# a face is O(1), so averages don't need every encoding to be re-read
+class FaceBuckets:
+
+    def __init__(self, angles):
+        self._angles = sorted(angles)
+        self._counts = {}
+        self._encodingCounts = {}
+        self._encodingSums = {}
+        self._sizeSums = {}
+        for angle in self._angles:
+            self._counts[angle] = 0
+            self._encodingCounts[angle] = 0
+            self._encodingSums[angle] = None
+            self._sizeSums[angle] = {}
+
+    def getAngles(self):
+        return self._angles
 
-    def __init__(self, paramConfig, requiredAngles, relatedFiles, baseFace ):
+    # Find the bucket with the closest angle
+    def nearestAngle(self, faceAngle):
+        return FaceBuckets.findNearestAngle( self._angles, faceAngle )
+
+    @staticmethod
+    def findNearestAngle(angles, faceAngle):
+        nearestBucket = abs(angles[0])
+        for angle in angles:
+            if abs( abs( faceAngle ) - abs( angle ) ) < abs( abs( faceAngle ) - abs(nearestBucket) ):
+                nearestBucket = abs(angle)
+        return nearestBucket
+
+    def addFace(self, face):
+        self._updateFace( face, 1 )
+
+    def removeFace(self, face):
+        self._updateFace( face, -1 )
+
+    def _updateFace(self, face, sign):
+        angle = self.nearestAngle( face.getAngle() )
+        self._counts[angle] += sign
+
+        # Faces encoded for a config which only reads landmarks have no encoding
+        encoding = face.getEncodingArray()
+        if encoding is not None:
+            self._encodingCounts[angle] += sign
+            if self._encodingSums[angle] is None:
+                self._encodingSums[angle] = numpy.zeros( encoding.shape, dtype=numpy.float64 )
+            if sign > 0:
+                self._encodingSums[angle] += encoding
+            else:
+                self._encodingSums[angle] -= encoding
+
+        sizeSums = self._sizeSums[angle]
+        for key,shape in ParamGenerator._calcArraySizes( face.getLandmarkArray() ).items():
+            if key not in sizeSums:
+                sizeSums[key] = [0,0]
+            for idx,dim in enumerate(shape):
+                sizeSums[key][idx] += sign * dim
+
+    def getCount(self, angle):
+        return self._counts[angle]
+
+    def getEncodingAverage(self, angle):
+        count = self._encodingCounts[angle]
+        if count == 0:
+            raise Exception( "No encodings found for angle {}".format(angle))
+        return ( self._encodingSums[angle] / count ).tolist()
+
+    def getSizeAverages(self, angle):
+        count = self._counts[angle]
+        averages = {}
+        if count == 0:
+            return averages
+        for key,shape in self._sizeSums[angle].items():
+            averages[key] = [ dim / count for dim in shape ]
+        return averages
+
+
+# The angles at which configs read encodings and landmarks, so faces can be
+# encoded with only what will be used. Faces are matched to each config's
+# angles as FaceBuckets matches them
+class FaceRequirements:
+
+    # parts are ( angles, encodingAngles, landmarkAngles ), one per config
+    def __init__(self, parts):
+        self._parts = [ ( sorted( set( abs(angle) for angle in angles ) ),
+                          set( abs(angle) for angle in encodingAngles ),
+                          set( abs(angle) for angle in landmarkAngles ) ) for angles, encodingAngles, landmarkAngles in parts ]
+
+    # From the parsed parameters of a config, which have angles in
+    @staticmethod
+    def createFromParams(params, angles):
+        artifactAngles = { "encoding": [], "landmarks": [] }
+        for param in params:
+            artifact = ParamGenerator.GENERATOR_ARTIFACTS.get( param["name"], "encoding" )
+            angle = ParamGenerator._getAngleParam( param["params"] )
+            if artifact is not None and angle is not None:
+                artifactAngles[artifact].append( angle )
+        return FaceRequirements( [ ( angles, artifactAngles["encoding"], artifactAngles["landmarks"] ) ] )
+
+    # Everything any of requirementsList needs
+    @staticmethod
+    def merge(requirementsList):
+        return FaceRequirements( [ part for requirements in requirementsList for part in requirements._parts ] )
+
+    # Angles with a generator reading them, the ones worth rendering or encoding at all
+    def getAngles(self):
+        angles = set()
+        for _, encodingAngles, landmarkAngles in self._parts:
+            angles |= encodingAngles | landmarkAngles
+        return sorted( angles )
+
+    # ( angles, angle ) of the bucket faceAngle falls in for each config which reads it
+    # there, with configs bucketing by the same angles sharing buckets
+    def getBuckets(self, faceAngle):
+        buckets = set()
+        for angles, encodingAngles, landmarkAngles in self._parts:
+            if len(angles) > 0:
+                angle = FaceBuckets.findNearestAngle( angles, faceAngle )
+                if angle in encodingAngles or angle in landmarkAngles:
+                    buckets.add( ( tuple(angles), angle ) )
+        return sorted( buckets )
+
+    def needsEncoding(self, faceAngle):
+        for angles, encodingAngles, _ in self._parts:
+            if len(angles) > 0 and FaceBuckets.findNearestAngle( angles, faceAngle ) in encodingAngles:
+                return True
+        return False
+
+    # Identifies the requirements for cache keys
+    def getKeyData(self):
+        return sorted( [ angles, sorted( encodingAngles ), sorted( landmarkAngles ) ] for angles, encodingAngles, landmarkAngles in self._parts )
+
+
+class ParamGenerator:
+    # What each generator reads from the faces at its angle, None for nothing
+    GENERATOR_ARTIFACTS = { "encoding": "encoding",
+                            "json": None,
+                            "eye_mouth_ratio": "landmarks",
+                            "mouth_chin_ratio": "landmarks",
+                            "eye_height_width_ratio": "landmarks",
+                            "nose_height_width_ratio": "landmarks",
+                            "brow_height_width_ratio": "landmarks",
+                            "brow_chin_ratio": "landmarks",
+                            "custom_action": "landmarks" }
+
+    # If faceBuckets is given, faces have already been accumulated there and
+    # relatedFiles only needs to supply any VaM looks. With an encodingStore,
+    # images and .encoding files in relatedFiles are looked up there first
+    def __init__(self, paramConfig, requiredAngles, relatedFiles, baseFace, faceBuckets = None, encodingStore = None ):
         self._config = paramConfig
         self._encodings = []
         self._vamFaces = []
         self._angles = requiredAngles
         self._angles.sort()
-        self._facebuckets = {}
         self._baseFace = baseFace
 
         self._generators = { "encoding": self._encodingParams,
@@ -27,14 +174,21 @@ class ParamGenerator:
                              "brow_chin_ratio": self._brow_chin_ratio_params,
                              "custom_action": self._custom_action  }
 
-        for angle in self._angles:
-            self._facebuckets[angle] = []
-
         # Read all encodings in from the file list
+        storeKeys = set()
         for file in relatedFiles:
             try:
                 if isinstance(file, EncodedFace):
                     newFace = file
+                elif encodingStore is not None and not file.endswith(".json") and encodingStore.contains(file):
+                    # An image and its .encoding file share one entry
+                    storeKey = encodingStore.getKey(file)
+                    if storeKey in storeKeys:
+                        continue
+                    storeKeys.add( storeKey )
+                    newFace = encodingStore.getFace(file)
+                    if newFace is None:
+                        continue
                 else:
                     newFace = EncodedFace.createFromFile(file)
                 self._encodings.append(newFace)
@@ -47,12 +201,11 @@ class ParamGenerator:
                     continue
 
         # Now put the encodings into the bucket with the closest angle
-        for encoding in self._encodings:
-            nearestBucket = abs(self._angles[0])
-            for angle in self._angles:
-                if abs( abs( encoding.getAngle() ) - abs( angle ) ) < abs( abs( encoding.getAngle() ) - abs(nearestBucket) ):
-                    nearestBucket = abs(angle)
-            self._facebuckets[nearestBucket].append(encoding)
+        if faceBuckets is None:
+            faceBuckets = FaceBuckets( self._angles )
+            for encoding in self._encodings:
+                faceBuckets.addFace( encoding )
+        self._faceBuckets = faceBuckets
 
 
     def getParams(self):
@@ -72,27 +225,8 @@ class ParamGenerator:
         return averages
 
     def _encodingParams(self, params):
-        angle = None
-        for param in params:
-            if "name" in param and param["name"] == "angle":
-                angle = float(param["value"])
-                break
-
-        encodings = []
-        for encoding in self._facebuckets[angle]:
-            encodings.append(encoding.getEncodings())
-
-        if len(encodings) == 0:
-            raise Exception( "No encodings found for angle {}".format(angle))
-        averages = [0]*len(encodings[0])
-
-        for encoding in encodings:
-            for idx,val in enumerate(encoding):
-                averages[idx] += val
-        for idx,val in enumerate(averages):
-            averages[idx] /= len(encodings)
-
-        return averages
+        angle = ParamGenerator._getAngleParam( params )
+        return self._faceBuckets.getEncodingAverage( angle )
 
 
 
@@ -203,18 +337,17 @@ class ParamGenerator:
         raise Exception( "Ill-formed action: {}".format(params))
 
     def _getAverages(self, params):
+        angle = ParamGenerator._getAngleParam( params )
+        return self._faceBuckets.getSizeAverages( angle )
+
+    @staticmethod
+    def _getAngleParam( params ):
         angle = None
         for param in params:
             if "name" in param and param["name"] == "angle":
                 angle = float(param["value"])
                 break
-
-        landmarks = []
-        for encoding in self._facebuckets[angle]:
-            landmarks.append(encoding.getLandmarks())
-
-        averages = ParamGenerator._calcAverageSizes( landmarks )
-        return averages
+        return angle
 
 
     @staticmethod
@@ -241,4 +374,19 @@ class ParamGenerator:
             width = math.hypot( rightmost[0] - leftmost[0], rightmost[1] - leftmost[1] )
             height = math.hypot( lowest[0] - highest[0], lowest[1] - highest[1] )
             sizes[key] = [ width, height ]
+        return sizes
+
+    # The same as _calcSizes, from a (68,2) landmark array rather than a dict of point lists
+    @staticmethod
+    def _calcArraySizes(landmarkArray):
+        sizes = {}
+        for key,indices in EncodedFace.LANDMARK_INDICES.items():
+            pts = landmarkArray[indices].astype( numpy.float64 )
+            leftmost = pts[numpy.argmin( pts[:, 0] )]
+            rightmost = pts[numpy.argmax( pts[:, 0] )]
+            highest = pts[numpy.argmin( pts[:, 1] )]
+            lowest = pts[numpy.argmax( pts[:, 1] )]
+            width = math.hypot( rightmost[0] - leftmost[0], rightmost[1] - leftmost[1] )
+            height = math.hypot( lowest[0] - highest[0], lowest[1] - highest[1] )
+            sizes[key] = [ width, height ]
         return sizes
\ No newline at end of file
@@ -0,0 +1,62 @@
+# Class to pick the best few photos of a person at each angle, so only those are encoded
+import collections
+import concurrent.futures
+import itertools
+import os
+import time
+
+
+# Configs average every face in each of their angle buckets, so past a few good photos
+# more add little. Photos are grouped into the buckets of every config which reads them,
+# and the best photosPerAngle in each bucket are kept, less faces already encoded there.
+# A photo kept for any config is kept
+class PhotoBudget:
+
+    def __init__(self, requirements, photosPerAngle):
+        self._requirements = requirements
+        self._photosPerAngle = photosPerAngle
+
+    # Indices of the photos to encode. scans are ( angle, score, passed ) for each photo,
+    # or None for ones without a usable face, and existingAngles are the angles of faces
+    # already encoded. Photos which passed the quality gate rank above ones which didn't,
+    # then by score. What was picked in each bucket is printed under name
+    def select(self, name, scans, existingAngles):
+        numExisting = collections.Counter( bucket for angle in existingAngles for bucket in self._requirements.getBuckets( angle ) )
+        candidates = {}
+        for idx, scan in enumerate(scans):
+            if scan is not None:
+                for bucket in self._requirements.getBuckets( scan[0] ):
+                    candidates.setdefault( bucket, [] ).append( idx )
+
+        selected = set()
+        rows = []
+        for bucket in sorted( set( candidates ) | set( numExisting ), key = lambda bucket: ( bucket[1], bucket[0] ) ):
+            indices = sorted( candidates.get( bucket, [] ), key = lambda idx: ( scans[idx][2], scans[idx][1] ), reverse = True )
+            picked = indices[:max( self._photosPerAngle - numExisting[bucket], 0 )]
+            selected.update( picked )
+            rows.append( ( bucket[1], len(indices), numExisting[bucket], len(picked), ",".join( str(angle) for angle in bucket[0] ) ) )
+
+        numUnusable = sum( 1 for scan in scans if scan is None )
+        print( "Selected {} of {} photos in {}, {} without a usable face".format( len(selected), len(scans), name, numUnusable ) )
+        print( "  {:>8}{:>10}{:>10}{:>10}  {}".format( "angle", "photos", "encoded", "selected", "of angles" ) )
+        for angle, numPhotos, encoded, numPicked, angles in rows:
+            print( "  {:>8}{:>10}{:>10}{:>10}  {}".format( angle, numPhotos, encoded, numPicked, angles ) )
+        return sorted( selected )
+
+    # Yield the work items worth encoding, from work items which start with their image file
+    # and come a directory, a person, at a time. Every photo in a directory is scanned first
+    # in numThreads threads, with scanImage returning its scan and the work item to pass on.
+    # existing holds the faces already encoded in each directory, keyed by their image file
+    def selectWorkItems(self, workItems, scanImage, existing, numThreads):
+        numPhotos = 0
+        numSelected = 0
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor( max_workers = numThreads, thread_name_prefix = "scan" ) as executor:
+            for root, items in itertools.groupby( workItems, key = lambda workItem: os.path.dirname( workItem[0] ) ):
+                scanned = list( executor.map( scanImage, items ) )
+                selected = self.select( root, [ scan for scan, _ in scanned ], [ encodedFace.getAngle() for encodedFace in existing.get( root, {} ).values() ] )
+                numPhotos += len(scanned)
+                numSelected += len(selected)
+                for idx in selected:
+                    yield scanned[idx][1]
+        print( "Selected {} of {} photos for encoding, scanned in {:.2f} seconds".format( numSelected, numPhotos, time.time() - start ) )
@@ -1,13 +1,33 @@
 # Quickly thrown together root script to run Tools
 import argparse
 import os
+import sys
 import glob
-import Tools.CreateTrainingEncodings as encodings
-import Tools.MakePrediction as predictor
-import Tools.MergeJson as mergeJson
-import json
+import time
+import importlib
 import multiprocessing
 
+# Tools which can be run as "foto2vam.py <tool> [tool arguments]". Each is only
+# imported when it is run, so one tool doesn't pay for another's dependencies
+TOOLS = {
+    "ConvertEncodings": ( "Tools.ConvertEncodings", "Move encodings between .encoding files and an encoding store" ),
+    "CreateTrainingEncodings": ( "Tools.CreateTrainingEncodings", "Encode faces in images" ),
+    "CreateTrainingCsv": ( "Tools.CreateTrainingCsv", "Generate training CSVs from encodings and looks" ),
+    "CreateTrainingImages": ( "Tools.CreateTrainingImages", "Capture VaM screenshots of looks" ),
+    "CreateTrainingVariations": ( "Tools.CreateTrainingVariations", "Generate random variations of looks" ),
+    "DistillModels": ( "Tools.DistillModels", "Distill models into one network with a head per model" ),
+    "ExportModel": ( "Tools.ExportModel", "Export models for NumPy-only prediction" ),
+    "MakePrediction": ( "Tools.MakePrediction", "Predict looks from encodings with one model" ),
+    "MergeCsv": ( "Tools.MergeCsv", "Merge training CSVs" ),
+    "MergeJson": ( "Tools.MergeJson", "Merge morphs from one look into others" ),
+    "NormalizeBenchmark": ( "Tools.NormalizeBenchmark", "Compare face normalization with and without coarse-to-fine detection" ),
+    "PoseBenchmark": ( "Tools.PoseBenchmark", "Compare batched head pose estimation with solvePnP" ),
+    "PredictionServer": ( "Tools.PredictionServer", "Serve predictions on localhost" ),
+    "StartupBenchmark": ( "Tools.StartupBenchmark", "Report startup time of each tool" ),
+    "Train": ( "Tools.Train", "Train a model from CSVs" ),
+    "TrainSelf": ( "Tools.TrainSelf", "Train a model against a running VaM" ),
+}
+
 ###############################
 # Run the program
 #
@@ -22,51 +42,178 @@ def main( args ):
     outputPath = args.outputPath
     defaultJsonPath = args.defaultJson
     mergedJsonPath = args.mergedOutputPath
+    saveIntermediate = args.saveIntermediate
+
+    # Delay heavy imports
+    import Tools.CreateTrainingEncodings as encodings
+    from Utils.Prediction.predictor import MultiModelPredictor
+    from Utils.Cache.result_cache import ResultCache
+    from Utils.Face.quality import QualityGate
 
     print( "Processing images from {}".format(inputPath))
 
+    params = argparse.Namespace(inputPath=inputPath, filter="*.png,*.jpg", normalizeSize=150, normalize=True, numJitters=10, jitterEpsilon=0.02, numThreads=4, pydev=False, recursive=True, debugPose = False, flipFirst = False, saveEncodings = saveIntermediate,
+                                cachePath = args.cachePath, cacheSizeMb = args.cacheSizeMb, cacheRun = ResultCache.newRunId(), photosPerAngle = args.photosPerAngle)
+    cache = ResultCache( args.cachePath, maxBytes = args.cacheSizeMb*1024*1024, runId = params.cacheRun ) if args.cachePath else None
+    # Photos go through the same quality gate as with CreateTrainingEncodings
+    for name in QualityGate.ARGUMENTS:
+        setattr( params, name, getattr(args, name) )
+
+    modelFiles = glob.glob( modelGlob )
+    # Faces are only encoded with what the models read
+    params.requirements = MultiModelPredictor.loadRequirements( modelFiles )
+    if args.watch:
+        print( "Loading {} models".format(len(modelFiles)))
+        multiPredictor = MultiModelPredictor( modelFiles, cache, useKeras = args.useKeras )
+        watch( args, params, multiPredictor )
+        return
+
     print( "First running CreateTrainingEncodings tool")
-    params = argparse.Namespace(inputPath=inputPath, filter="*.png,*.jpg", normalizeSize=150, normalize=True, numJitters=10, numThreads=4, pydev=False, recursive=True, debugPose = False, flipFirst = False)
-    encodings.main( params )
-
-    for modelFile in glob.glob( modelGlob ):
-        jsonPath = os.path.splitext(modelFile)[0] + ".json"
-        print( "Processing encodings from {} and using model/json {}/{}".format(inputPath, modelFile, jsonPath))
-        print( "Running MakePredictions tool")
-        print( "With model {}".format(modelFile))
-        params = argparse.Namespace(modelFile=modelFile, inputDir=inputPath, pydev=False, outputDir=outputPath, multiDir=False, skipChance=0.0, recursive=True )
-        predictor.main(params)
-    
-        print( "Running MergeJson tool" )
-        jsonData = json.loads( open(jsonPath).read() )
-        # Run MergeTool using the inverted baseJson (copy all attributes except the ones trained on)
-        templateJson = os.path.join(os.path.dirname(jsonPath), jsonData["baseJson"])
-    
-        params = None
-        filter = "*{}".format( os.path.basename( jsonPath ) )  # Don't have two models end with same text or later one will overwrite previous output merge!
-        params = argparse.Namespace(templateJson=templateJson, invertTemplate=True, toJsonDir=outputPath, filter=filter, recursive=True, fromJson=defaultJsonPath, outputJsonDir=mergedJsonPath, pydev=False)
-        mergeJson.main(params)
+    # Faces are handed straight to the predictor instead of being re-read from .encoding files
+    facesByDir = encodings.main( params, collectFaces = True )
+
+    print( "Loading {} models".format(len(modelFiles)))
+    multiPredictor = MultiModelPredictor( modelFiles, cache, useKeras = args.useKeras )
+
+    persons = MultiModelPredictor.personsFromFaces( inputPath, facesByDir )
+
+    print( "Predicting {} people with {} models".format(len(persons), len(modelFiles)))
+    multiPredictor.predict( persons )
+    if saveIntermediate:
+        multiPredictor.savePredictions( persons, outputPath )
+
+    print( "Merging predictions with {}".format(defaultJsonPath) )
+    # Merge using the inverted baseJson (copy all attributes except the ones trained on)
+    multiPredictor.saveMergedPredictions( persons, defaultJsonPath, mergedJsonPath )
+
+    if cache:
+        cache.printStats()
+        cache.close()
+
+
+###############################
+# Keep the models resident and only update people whose images changed
+#
+def watch( args, encodeParams, multiPredictor ):
+    import Tools.CreateTrainingEncodings as encodings
+    from Utils.Prediction.predictor import MultiModelPredictor
+    from Utils.Prediction.watcher import FolderWatcher
+
+    inputPath = args.inputPath
+    watcher = FolderWatcher( inputPath, encodeParams.filter.split(','), recursive = encodeParams.recursive )
+
+    # image path -> EncodedFace, and directory -> Person
+    facesByFile = {}
+    persons = {}
+
+    # The first poll reports every image already there. Those are taken from their encodings,
+    # with only what's new encoded, in worker processes and within the photo budget as
+    # without watching. Images changing meanwhile are picked up by the next poll
+    watcher.poll()
+    for root, faces in encodings.main( encodeParams, collectFaces = True, byFile = True ).items():
+        persons[root] = MultiModelPredictor.createPerson( inputPath, root, list( faces.values() ) )
+        facesByFile.update( faces )
+    if len(persons) > 0:
+        print( "Predicting {} people".format(len(persons)) )
+        multiPredictor.predict( list( persons.values() ) )
+        if args.saveIntermediate:
+            multiPredictor.savePredictions( list( persons.values() ), args.outputPath )
+        multiPredictor.saveMergedPredictions( list( persons.values() ), args.defaultJson, args.mergedOutputPath )
+
+    print( "Watching {} for new images every {} seconds. Press CTRL+C to exit".format(inputPath, args.watchInterval) )
+    while True:
+        changed, removed = watcher.poll()
+        dirtyPersons = {}
+
+        # Take out faces from images which are gone or about to be re-encoded
+        for file in removed + changed:
+            if file in facesByFile:
+                root = os.path.dirname(file)
+                persons[root].removeFace( facesByFile.pop(file) )
+                dirtyPersons[root] = persons[root]
+
+        # Changed images are encoded as the first poll's were. The faces still held for
+        # their people count against the photo budget
+        if len(changed) > 0:
+            roots = set( os.path.dirname(file) for file in changed )
+            existing = {}
+            for file, encodedFace in facesByFile.items():
+                if os.path.dirname(file) in roots:
+                    existing.setdefault( os.path.dirname(file), {} )[file] = encodedFace
+            for root, faces in encodings.main( encodeParams, collectFaces = True, byFile = True, inputFiles = changed, existing = existing ).items():
+                for file, encodedFace in faces.items():
+                    if file in facesByFile:
+                        continue
+                    if root not in persons:
+                        persons[root] = MultiModelPredictor.createPerson( inputPath, root, [] )
+                    persons[root].addFace( encodedFace )
+                    facesByFile[file] = encodedFace
+                    dirtyPersons[root] = persons[root]
+
+        # People without any images left are dropped, along with their looks
+        emptyPersons = [ root for root, person in dirtyPersons.items() if len(person.faces) == 0 ]
+        if len(emptyPersons) > 0:
+            print( "Removing {} people".format(len(emptyPersons)) )
+            multiPredictor.deletePredictions( [ dirtyPersons[root] for root in emptyPersons ], args.defaultJson, args.mergedOutputPath,
+                                              args.outputPath if args.saveIntermediate else None )
+            for root in emptyPersons:
+                del persons[root]
+                del dirtyPersons[root]
+
+        if len(dirtyPersons) > 0:
+            dirtyList = list(dirtyPersons.values())
+            print( "Updating {} people".format(len(dirtyList)) )
+            multiPredictor.predict( dirtyList )
+            if args.saveIntermediate:
+                multiPredictor.savePredictions( dirtyList, args.outputPath )
+            multiPredictor.saveMergedPredictions( dirtyList, args.defaultJson, args.mergedOutputPath )
+
+        time.sleep( args.watchInterval )
 
 
 ###############################
 # parse arguments
 #
 def parseArgs():
-    parser = argparse.ArgumentParser( description="Generate training data" )
+    toolHelp = "\n".join( "  {:<26}{}".format(name, tool[1]) for name, tool in sorted(TOOLS.items()) )
+    parser = argparse.ArgumentParser( description="Generate VaM looks from photos",
+                                      formatter_class=argparse.RawDescriptionHelpFormatter,
+                                      epilog="tools, run as: foto2vam.py <tool> --help\n{}".format(toolHelp) )
     parser.add_argument('--inputPath', help="Directory containing images", default="Input")
-    parser.add_argument('--modelPath', help="Path to model, can include wildcard", default=os.path.join("models", "*.model") )
+    parser.add_argument('--modelPath', help="Path to model, can include wildcard. A distilled .bundle from DistillModels replaces the models it was made from", default=os.path.join("models", "*.model") )
     parser.add_argument('--defaultJson', help="JSON file to copy base look from", default=os.path.join("mergeBase.json") )
-    parser.add_argument('--outputPath', help="Directory to store output", default="Output")
+    parser.add_argument('--outputPath', help="Directory to store unmerged predictions when --saveIntermediate is set", default="Output")
     parser.add_argument('--mergedOutputPath', help="Path to store output merged with defaultJson", default="Output_Merged")
+    parser.add_argument("--saveIntermediate", action='store_true', default=False, help="Also write .encoding files and unmerged predictions, for debugging")
+    parser.add_argument("--cachePath", help="Result cache file, so reruns only recompute what changed. Disabled by default", default=None)
+    parser.add_argument("--cacheSizeMb", type=int, help="Size limit of the result cache. Defaults to 1024", default=1024)
+    parser.add_argument("--useKeras", action='store_true', default=False, help="Predict with Keras even if models have been exported for NumPy")
+    parser.add_argument("--watch", action='store_true', default=False, help="Keep running and process images as they are added to inputPath")
+    parser.add_argument("--watchInterval", type=float, default=5.0, help="Seconds between checks for new images in --watch mode. Defaults to 5")
+    parser.add_argument("--photosPerAngle", type=int, default=0, help="Only encode the best this many photos of each person at each angle the models read. Disabled by default")
     parser.add_argument("--pydev", action='store_true', default=False, help="Enable pydevd debugging")
+    from Utils.Face.quality import QualityGate
+    QualityGate.addArguments( parser )
 
     return parser.parse_args()
 
 
+###############################
+# Run one of the Tools with the remaining arguments
+#
+def runTool( toolName, toolArgs ):
+    module = importlib.import_module( TOOLS[toolName][0] )
+    sys.argv = [ "{} {}".format(os.path.basename(sys.argv[0]), toolName) ] + toolArgs
+    module.main( module.parseArgs() )
+
+
 ###############################
 # program entry point
 #
 if __name__ == "__main__":
     multiprocessing.freeze_support()
-    args = parseArgs()
-    main( args )
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] in TOOLS:
+        runTool( sys.argv[1], sys.argv[2:] )
+    else:
+        args = parseArgs()
+        main( args )
\ No newline at end of file
@@ -0,0 +1,118 @@
+# Round trips through model bundles, and when a bundle is too old to use
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from Utils.Training.config import Config
+from Utils.Prediction.numpy_model import NumpyModel
+from Utils.Prediction.bundle import ModelBundle
+from Utils.Prediction.predictor import MultiModelPredictor
+
+SAMPLE_PATH = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ), "Sample" )
+ROWS = numpy.array( [ [ 1.0, 2.0, 3.0 ], [ -1.0, 0.5, 0.0 ] ], dtype=numpy.float32 )
+
+
+def createModel( outputCount ):
+    random = numpy.random.RandomState( 7 )
+    array = lambda *shape: random.uniform( -1.0, 1.0, shape ).astype( numpy.float32 )
+    return NumpyModel( [ ( { "type": "dense", "activation": "relu" }, { "kernel": array( 3, 4 ), "bias": array( 4 ) } ),
+                         ( { "type": "scale_shift" }, { "scale": array( 4 ), "shift": array( 4 ) } ),
+                         ( { "type": "dense", "activation": "linear" }, { "kernel": array( 4, outputCount ), "bias": array( outputCount ) } ) ] )
+
+
+class ModelBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    # Model file and the config beside it, with the base, min and max JSON from Sample
+    def createConfigFile(self, name, angle):
+        configJson = { "baseJson": os.path.join( SAMPLE_PATH, "body.json" ),
+                       "minJson": os.path.join( SAMPLE_PATH, "minimum.json" ),
+                       "maxJson": os.path.join( SAMPLE_PATH, "maximum.json" ),
+                       "inputs": [ { "name": "encoding", "params": [ { "name": "angle", "value": str(angle) } ] } ],
+                       "outputs": [ { "name": "json", "params": [] } ] }
+        modelFile = os.path.join( self.directory, name + ".model" )
+        with open( os.path.splitext(modelFile)[0] + ".json", 'w' ) as f:
+            json.dump( configJson, f )
+        with open( modelFile, 'wb' ) as f:
+            f.write( b"model" )
+        return modelFile
+
+    def testSaveAndLoad(self):
+        modelFile = self.createConfigFile( "face", 0 )
+        config = Config.createFromFile( os.path.splitext(modelFile)[0] + ".json" )
+        model = createModel( 2 )
+        bundleFile = ModelBundle.getBundlePath( modelFile )
+        ModelBundle.create( model, config ).save( bundleFile )
+
+        bundle = ModelBundle.load( bundleFile )
+        self.assertFalse( bundle.isDistilled() )
+        self.assertEqual( bundle.createHeads(), [] )
+        numpy.testing.assert_array_equal( bundle.getNumpyModel().predict( ROWS ), model.predict( ROWS ) )
+        loadedConfig = bundle.createConfig()
+        self.assertEqual( loadedConfig.getShape(), ( 3, 2 ) )
+        self.assertEqual( loadedConfig.getAngles(), [ 0.0 ] )
+        self.assertEqual( loadedConfig.getBundleData(), config.getBundleData() )
+
+    def testContentHash(self):
+        modelFile = self.createConfigFile( "face", 0 )
+        config = Config.createFromFile( os.path.splitext(modelFile)[0] + ".json" )
+        firstFile = os.path.join( self.directory, "first.bundle" )
+        ModelBundle.create( createModel( 2 ), config ).save( firstFile )
+        bundle = ModelBundle.load( firstFile )
+        contentHash = bundle.getContentHash()
+        self.assertIsNotNone( contentHash )
+
+        # Saving a loaded bundle again keeps its hash, while other weights change it
+        secondFile = os.path.join( self.directory, "second.bundle" )
+        bundle.save( secondFile )
+        self.assertEqual( ModelBundle.load( secondFile ).getContentHash(), contentHash )
+        otherFile = os.path.join( self.directory, "other.bundle" )
+        ModelBundle.create( createModel( 3 ), config ).save( otherFile )
+        self.assertNotEqual( ModelBundle.load( otherFile ).getContentHash(), contentHash )
+
+    def testDistilled(self):
+        configs = [ Config.createFromFile( os.path.splitext( self.createConfigFile( "face{}".format(angle), angle ) )[0] + ".json" ) for angle in ( 0, 45 ) ]
+        inputConfig = Config.createSharedInputConfig( configs )
+        bundleFile = os.path.join( self.directory, "distilled.bundle" )
+        ModelBundle.create( createModel( 5 ), inputConfig, [ ( "front", configs[0], 2 ), ( "side", configs[1], 3 ) ] ).save( bundleFile )
+
+        bundle = ModelBundle.load( bundleFile )
+        self.assertTrue( bundle.isDistilled() )
+        self.assertEqual( bundle.createConfig().getShape(), ( 3, 0 ) )
+        heads = bundle.createHeads()
+        self.assertEqual( [ ( name, outputRange ) for name, _, outputRange in heads ], [ ( "front", ( 0, 2 ) ), ( "side", ( 2, 5 ) ) ] )
+        self.assertEqual( heads[1][1].getAngles(), [ 45.0 ] )
+
+    def testHeadsMustCoverOutputs(self):
+        config = Config.createFromFile( os.path.splitext( self.createConfigFile( "face", 0 ) )[0] + ".json" )
+        with self.assertRaises( Exception ):
+            ModelBundle.create( createModel( 5 ), Config.createSharedInputConfig( [ config ] ), [ ( "face", config, 2 ) ] )
+
+    def testStaleBundle(self):
+        modelFile = self.createConfigFile( "face", 0 )
+        configFile = os.path.splitext(modelFile)[0] + ".json"
+        bundleFile = ModelBundle.getBundlePath( modelFile )
+        ModelBundle.create( createModel( 2 ), Config.createFromFile( configFile ) ).save( bundleFile )
+        bundleTime = os.path.getmtime( bundleFile )
+        os.utime( modelFile, ( bundleTime - 10, bundleTime - 10 ) )
+        os.utime( configFile, ( bundleTime - 10, bundleTime - 10 ) )
+        self.assertEqual( MultiModelPredictor._findBundle( modelFile, False ), bundleFile )
+        self.assertIsNone( MultiModelPredictor._findBundle( modelFile, True ) )
+        # A bundle passed as the model is always used
+        self.assertEqual( MultiModelPredictor._findBundle( bundleFile, False ), bundleFile )
+
+        # Either the model or its config changing after the bundle was made outdates it
+        for sourceFile in ( modelFile, configFile ):
+            os.utime( sourceFile, ( bundleTime + 10, bundleTime + 10 ) )
+            self.assertIsNone( MultiModelPredictor._findBundle( modelFile, False ) )
+            os.utime( sourceFile, ( bundleTime - 10, bundleTime - 10 ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
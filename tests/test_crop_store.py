@@ -0,0 +1,99 @@
+# Round trips through a crop store with each codec
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from Utils.Face.crop_store import CropStore
+from Utils.Face.normalize import FaceDetection
+
+
+def createCrop( seed ):
+    random = numpy.random.RandomState( seed )
+    npImg = random.randint( 0, 256, ( 150, 150, 3 ) ).astype(numpy.uint8)
+    points = random.randint( 0, 150, ( 68, 2 ) ).astype(numpy.int32)
+    return npImg, FaceDetection( ( 20, 130, 130, 20 ), points, float( random.uniform( 100, 400 ) ), 0.25 )
+
+
+class CropStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join( tempfile.mkdtemp(), "crops" )
+
+    def tearDown(self):
+        shutil.rmtree( os.path.dirname( self.path ) )
+
+    def assertSameCrop(self, crop, expected):
+        self.assertIsNotNone( crop )
+        npImg, detection = crop
+        expectedImg, expectedDetection = expected
+        numpy.testing.assert_array_equal( npImg, expectedImg )
+        self.assertEqual( tuple( detection.region ), tuple( expectedDetection.region ) )
+        numpy.testing.assert_array_equal( detection.points, expectedDetection.points )
+        self.assertAlmostEqual( detection.faceWidth, expectedDetection.faceWidth )
+        self.assertAlmostEqual( detection.landmarksOutside, expectedDetection.landmarksOutside )
+
+    def testRoundTrip(self):
+        for codec in CropStore.CODECS:
+            with self.subTest( codec = codec ):
+                path = os.path.join( self.path, codec )
+                store = CropStore( path, codec = codec )
+                store.add( "a", *createCrop(1) )
+                store.add( "b", *createCrop(2) )
+                # A key added again is replaced
+                store.add( "a", *createCrop(3) )
+                self.assertSameCrop( store.get("a"), createCrop(3) )
+                self.assertIsNone( store.get("c") )
+                store.close()
+
+                store = CropStore( path, readOnly = True )
+                self.assertEqual( len(store), 2 )
+                self.assertSameCrop( store.get("a"), createCrop(3) )
+                self.assertSameCrop( store.get("b"), createCrop(2) )
+                store.close()
+
+    def testDetectionWithoutPoints(self):
+        npImg, _ = createCrop(1)
+        store = CropStore( self.path )
+        store.add( "a", npImg, FaceDetection( ( 0, 150, 150, 0 ) ) )
+        crop = store.get("a")
+        store.close()
+        self.assertIsNone( crop[1].points )
+        self.assertIsNone( crop[1].faceWidth )
+
+    def testReaderFindsNewCrops(self):
+        writer = CropStore( self.path )
+        writer.add( "a", *createCrop(1) )
+        reader = CropStore( self.path, readOnly = True )
+        writer.add( "b", *createCrop(2) )
+        self.assertSameCrop( reader.get("b"), createCrop(2) )
+        reader.close()
+        writer.close()
+
+    def testPartlyWrittenRecordIsDropped(self):
+        store = CropStore( self.path, codec = "raw" )
+        store.add( "a", *createCrop(1) )
+        store.add( "b", *createCrop(2) )
+        store.close()
+        # As if writing b's pixels was cut short
+        dataFile = os.path.join( self.path, "crops.bin" )
+        with open( dataFile, 'r+b' ) as f:
+            f.truncate( os.path.getsize( dataFile ) - 100 )
+
+        store = CropStore( self.path, codec = "raw" )
+        self.assertFalse( store.contains("b") )
+        store.add( "c", *createCrop(3) )
+        store.close()
+
+        store = CropStore( self.path, readOnly = True )
+        self.assertEqual( len(store), 2 )
+        self.assertSameCrop( store.get("a"), createCrop(1) )
+        self.assertSameCrop( store.get("c"), createCrop(3) )
+        store.close()
+
+    def testUnknownCodec(self):
+        with self.assertRaises( Exception ):
+            CropStore( self.path, codec = "png" )
+
+
+if __name__ == "__main__":
+    unittest.main()
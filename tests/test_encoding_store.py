@@ -0,0 +1,102 @@
+# Round trips through an encoding store
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from Utils.Face.encoded import EncodedFace
+from Utils.Face.encoding_store import EncodingStore
+
+
+def createFace( seed, withEncoding = True ):
+    random = numpy.random.RandomState( seed )
+    encoding = random.uniform( -1, 1, EncodingStore.ENCODING_SIZE ).astype(numpy.float32) if withEncoding else None
+    landmarks = random.randint( 0, 150, ( EncodingStore.NUM_LANDMARKS, 2 ) ).astype(numpy.int16)
+    return EncodedFace.createFromArrays( encoding, landmarks, float( random.uniform( -60, 60 ) ) )
+
+
+class EncodingStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.path )
+
+    def imagePath(self, name):
+        return os.path.join( self.path, "person", name )
+
+    def assertSameFace(self, face, expected):
+        self.assertIsNotNone( face )
+        if expected.getEncodingArray() is None:
+            self.assertIsNone( face.getEncodingArray() )
+        else:
+            numpy.testing.assert_array_equal( face.getEncodingArray(), expected.getEncodingArray() )
+        numpy.testing.assert_array_equal( face.getLandmarkArray(), expected.getLandmarkArray() )
+        self.assertAlmostEqual( face.getAngle(), expected.getAngle(), places=4 )
+
+    def testAppendAndRead(self):
+        faces = { "a.png": createFace(1), "b.png": createFace(2, withEncoding = False) }
+        store = EncodingStore( self.path )
+        for name, face in faces.items():
+            store.addFace( self.imagePath(name), face )
+        store.addFailed( self.imagePath("c.png") )
+        # Readable before the store is closed
+        self.assertSameFace( store.getFace( self.imagePath("a.png") ), faces["a.png"] )
+        store.close()
+
+        store = EncodingStore( self.path, readOnly = True )
+        self.assertEqual( len(store), 3 )
+        for name, face in faces.items():
+            self.assertSameFace( store.getFace( self.imagePath(name) ), face )
+        # An image and its .encoding file find the same row
+        self.assertSameFace( store.getFace( self.imagePath("a.encoding") ), faces["a.png"] )
+        self.assertTrue( store.isFailed( self.imagePath("c.png") ) )
+        self.assertIsNone( store.getFace( self.imagePath("c.png") ) )
+        with self.assertRaises( KeyError ):
+            store.getFace( self.imagePath("d.png") )
+
+        facesByDir = store.getFacesByDirectory()
+        self.assertEqual( list( facesByDir.keys() ), [ os.path.join( self.path, "person" ) ] )
+        self.assertEqual( len( facesByDir[os.path.join( self.path, "person" )] ), 2 )
+        store.close()
+
+    def testPartlyWrittenRowIsDropped(self):
+        store = EncodingStore( self.path )
+        store.addFace( self.imagePath("a.png"), createFace(1) )
+        store.addFace( self.imagePath("b.png"), createFace(2) )
+        store.close()
+        # As if writing b's encoding was cut short
+        encodingsFile = os.path.join( self.path, "encodings.f32" )
+        with open( encodingsFile, 'r+b' ) as f:
+            f.truncate( os.path.getsize( encodingsFile ) - 10 )
+
+        store = EncodingStore( self.path )
+        self.assertEqual( len(store), 1 )
+        self.assertFalse( store.contains( self.imagePath("b.png") ) )
+        store.addFace( self.imagePath("c.png"), createFace(3) )
+        store.close()
+
+        store = EncodingStore( self.path, readOnly = True )
+        self.assertEqual( sorted( store.getKeys() ), [ "person/a", "person/c" ] )
+        self.assertSameFace( store.getFace( self.imagePath("c.png") ), createFace(3) )
+        store.close()
+
+    def testCompact(self):
+        store = EncodingStore( self.path )
+        for seed, name in enumerate( [ "a.png", "b.png", "a.png", "c.png", "b.png" ] ):
+            store.addFace( self.imagePath(name), createFace(seed) )
+        self.assertEqual( store.compact(), 2 )
+        self.assertEqual( os.path.getsize( os.path.join( self.path, "angles.f32" ) ), 3 * 4 )
+        # Still appendable once compacted
+        store.addFace( self.imagePath("d.png"), createFace(5) )
+        store.close()
+
+        store = EncodingStore( self.path, readOnly = True )
+        self.assertEqual( len(store), 4 )
+        for seed, name in [ ( 2, "a.png" ), ( 4, "b.png" ), ( 3, "c.png" ), ( 5, "d.png" ) ]:
+            self.assertSameFace( store.getFace( self.imagePath(name) ), createFace(seed) )
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
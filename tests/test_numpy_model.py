@@ -0,0 +1,87 @@
+# NumPy prediction against outputs worked out by hand for a small network
+import os
+import shutil
+import tempfile
+import types
+import unittest
+import numpy
+from Utils.Prediction.numpy_model import NumpyModel
+
+ROWS = [ [ 1.0, 2.0, 3.0 ], [ -1.0, 0.5, 0.0 ], [ 0.0, 0.0, 0.0 ] ]
+# tanh( dense( scale_shift( leaky_relu( dense(row) ) ) ) ), worked out in float64
+EXPECTED = [ [ -0.7235234536550119 ], [ -0.7205317527482022 ], [ -0.23076751278236435 ] ]
+
+KERNEL1 = [ [ 0.5, -1.0 ], [ 0.25, 0.75 ], [ -0.5, 0.2 ] ]
+BIAS1 = [ 0.1, -0.2 ]
+ALPHA = 0.3
+SCALE = [ 2.0, 0.5 ]
+SHIFT = [ 0.0, 1.0 ]
+KERNEL2 = [ [ 1.0 ], [ -0.5 ] ]
+BIAS2 = [ 0.05 ]
+
+
+def createLayers():
+    array = lambda values: numpy.array( values, dtype=numpy.float32 )
+    return [ ( { "type": "dense", "activation": "linear" }, { "kernel": array(KERNEL1), "bias": array(BIAS1) } ),
+             ( { "type": "leaky_relu", "alpha": ALPHA }, {} ),
+             ( { "type": "scale_shift" }, { "scale": array(SCALE), "shift": array(SHIFT) } ),
+             ( { "type": "dense", "activation": "tanh" }, { "kernel": array(KERNEL2), "bias": array(BIAS2) } ) ]
+
+
+# Stands in for a Keras layer, as NumpyModel.fromKeras reads one
+def createKerasLayer( layerType, config, weights = [], weightNames = [] ):
+    layer = type( layerType, (), {} )()
+    layer.name = layerType.lower()
+    layer.get_config = lambda: config
+    layer.get_weights = lambda: [ numpy.array( weight, dtype=numpy.float32 ) for weight in weights ]
+    layer.weights = [ types.SimpleNamespace( name = "{}/{}:0".format( layer.name, name ) ) for name in weightNames ]
+    return layer
+
+
+class NumpyModelTest(unittest.TestCase):
+    def testReferenceOutput(self):
+        outputs = NumpyModel( createLayers() ).predict( ROWS )
+        self.assertEqual( outputs.dtype, numpy.float32 )
+        numpy.testing.assert_allclose( outputs, EXPECTED, atol=1e-6 )
+
+    def testBatchesGiveTheSameOutput(self):
+        model = NumpyModel( createLayers() )
+        numpy.testing.assert_array_equal( model.predict( ROWS, batch_size = 1 ), model.predict( ROWS ) )
+
+    def testSaveAndLoad(self):
+        directory = tempfile.mkdtemp()
+        try:
+            exportFile = NumpyModel.getExportPath( os.path.join( directory, "face.model" ) )
+            self.assertEqual( exportFile, os.path.join( directory, "face.npz" ) )
+            NumpyModel( createLayers() ).save( exportFile )
+            model = NumpyModel.load( exportFile )
+        finally:
+            shutil.rmtree( directory )
+        self.assertEqual( ( model.getInputSize(), model.getOutputSize() ), ( 3, 1 ) )
+        numpy.testing.assert_allclose( model.predict( ROWS ), EXPECTED, atol=1e-6 )
+
+    def testFromKeras(self):
+        # Batch normalization which scales and shifts by SCALE and SHIFT
+        epsilon = 0.001
+        variance = [ 0.5, 2.0 ]
+        gamma = [ SCALE[idx] * numpy.sqrt( variance[idx] + epsilon ) for idx in range(2) ]
+        mean = [ 1.0, -1.0 ]
+        beta = [ SHIFT[idx] + mean[idx] * SCALE[idx] for idx in range(2) ]
+        kerasModel = types.SimpleNamespace( layers = [
+            createKerasLayer( "InputLayer", {} ),
+            createKerasLayer( "Dense", { "activation": "linear", "use_bias": True }, [ KERNEL1, BIAS1 ] ),
+            createKerasLayer( "LeakyReLU", { "alpha": ALPHA } ),
+            createKerasLayer( "Dropout", { "rate": 0.5 } ),
+            createKerasLayer( "BatchNormalization", { "epsilon": epsilon }, [ gamma, beta, mean, variance ], [ "gamma", "beta", "moving_mean", "moving_variance" ] ),
+            createKerasLayer( "Dense", { "activation": "tanh", "use_bias": True }, [ KERNEL2, BIAS2 ] ) ] )
+        model = NumpyModel.fromKeras( kerasModel )
+        self.assertEqual( [ spec["type"] for spec, _ in model.getLayers() ], [ "dense", "leaky_relu", "scale_shift", "dense" ] )
+        numpy.testing.assert_allclose( model.predict( ROWS ), EXPECTED, atol=1e-5 )
+
+    def testUnsupportedLayer(self):
+        with self.assertRaises( Exception ):
+            NumpyModel( [ ( { "type": "conv2d" }, {} ) ] )
+
+
+if __name__ == "__main__":
+    unittest.main()
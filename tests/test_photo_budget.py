@@ -0,0 +1,62 @@
+# Picking the best few photos of each person at each angle
+import contextlib
+import io
+import os
+import unittest
+from Utils.Face.encoded import EncodedFace
+from Utils.Training.param_generator import FaceRequirements
+from Utils.Training.photo_budget import PhotoBudget
+
+
+class PhotoBudgetTest(unittest.TestCase):
+    def setUp(self):
+        # One config reading encodings at 0 and 35 degrees
+        self.requirements = FaceRequirements( [ ( [ 0, 35 ], [ 0, 35 ], [] ) ] )
+
+    def select(self, budget, scans, existingAngles = []):
+        with contextlib.redirect_stdout( io.StringIO() ):
+            return budget.select( "person", scans, existingAngles )
+
+    def testKeepsBestAtEachAngle(self):
+        budget = PhotoBudget( self.requirements, 2 )
+        scans = [ ( 2.0, 10.0, True ),
+                  ( -3.0, 30.0, True ),
+                  ( 1.0, 20.0, True ),
+                  ( 33.0, 5.0, True ),
+                  None,
+                  ( -40.0, 1.0, True ) ]
+        self.assertEqual( self.select( budget, scans ), [ 1, 2, 3, 5 ] )
+
+    def testPassedRankAboveScore(self):
+        budget = PhotoBudget( self.requirements, 1 )
+        scans = [ ( 0.0, 100.0, False ), ( 0.0, 1.0, True ) ]
+        self.assertEqual( self.select( budget, scans ), [ 1 ] )
+
+    def testExistingFacesCountAgainstBudget(self):
+        budget = PhotoBudget( self.requirements, 2 )
+        scans = [ ( 0.0, 10.0, True ), ( 0.0, 20.0, True ), ( 35.0, 10.0, True ) ]
+        self.assertEqual( self.select( budget, scans, [ 1.0 ] ), [ 1, 2 ] )
+        self.assertEqual( self.select( budget, scans, [ 1.0, -2.0, 30.0, 36.0 ] ), [] )
+
+    def testPhotoKeptForAnyConfig(self):
+        # A second config reads faces at 5 and 20 degrees. The first photo is only the
+        # best at an angle for it, the second for both
+        requirements = FaceRequirements.merge( [ self.requirements, FaceRequirements( [ ( [ 5, 20 ], [ 5, 20 ], [] ) ] ) ] )
+        budget = PhotoBudget( requirements, 1 )
+        scans = [ ( 15.0, 10.0, True ), ( 5.0, 20.0, True ) ]
+        self.assertEqual( self.select( budget, scans ), [ 0, 1 ] )
+        self.assertEqual( self.select( PhotoBudget( self.requirements, 1 ), scans ), [ 1 ] )
+
+    def testSelectWorkItemsByDirectory(self):
+        budget = PhotoBudget( self.requirements, 1 )
+        scores = { "a.png": 1.0, "b.png": 3.0, "c.png": 2.0, "d.png": 1.0 }
+        workItems = [ ( os.path.join( person, name ), None ) for person, names in ( ( "p0", [ "a.png", "b.png" ] ), ( "p1", [ "c.png", "d.png" ] ) ) for name in names ]
+        scanImage = lambda workItem: ( ( 0.0, scores[os.path.basename( workItem[0] )], True ), workItem + ( "scanned", ) )
+        existing = { "p1": { os.path.join( "p1", "e.png" ): EncodedFace.createFromArrays( None, [ [ 0, 0 ] ] * 68, 2.0 ) } }
+        with contextlib.redirect_stdout( io.StringIO() ):
+            selected = list( budget.selectWorkItems( iter( workItems ), scanImage, existing, 2 ) )
+        self.assertEqual( selected, [ ( os.path.join( "p0", "b.png" ), None, "scanned" ) ] )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+# Batched head pose estimation against faces posed at known angles
+import unittest
+import numpy
+from Utils.Face.pose import HeadPose
+
+IMAGE_SIZE = ( 480, 640 )
+
+
+# Image points of HeadPose.MODEL_POINTS seen by the camera EncodedFace assumes, with the
+# face turned by turns degrees and tilted and rolled a little, and the rotations used
+def createFaces( turns, noise = 0.0 ):
+    random = numpy.random.RandomState( 11 )
+    numFaces = len(turns)
+    angles = numpy.radians( numpy.stack( ( random.uniform( -15, 15, numFaces ), turns, random.uniform( -20, 20, numFaces ) ), axis=1 ) )
+    # Facing the camera flips the model's y and z
+    rotations = numpy.matmul( HeadPose.rodrigues( angles ), numpy.diag( [ 1.0, -1.0, -1.0 ] ) )
+    translations = numpy.stack( ( random.uniform( -50, 50, numFaces ), random.uniform( -50, 50, numFaces ), random.uniform( 800, 1600, numFaces ) ), axis=1 )
+
+    camera = numpy.einsum( 'nij,pj->npi', rotations, HeadPose.MODEL_POINTS ) + translations[:, None, :]
+    height, width = IMAGE_SIZE
+    imagePoints = camera[..., :2] / camera[..., 2:] * width + ( width / 2, height / 2 )
+    return imagePoints + random.normal( 0, noise, imagePoints.shape ), rotations
+
+
+class HeadPoseTest(unittest.TestCase):
+    def testExactFaces(self):
+        imagePoints, rotations = createFaces( numpy.linspace( -60, 60, 25 ) )
+        solved, _, converged = HeadPose.solve( imagePoints, IMAGE_SIZE )
+        self.assertTrue( numpy.all( converged ) )
+        numpy.testing.assert_allclose( HeadPose.rotationsToAngles( solved )[1], HeadPose.rotationsToAngles( rotations )[1], atol=1e-3 )
+
+    def testNoisyFaces(self):
+        imagePoints, rotations = createFaces( numpy.linspace( -60, 60, 25 ), noise = 0.5 )
+        turns = HeadPose.estimate( imagePoints, IMAGE_SIZE, fallback = False )[1]
+        numpy.testing.assert_allclose( turns, HeadPose.rotationsToAngles( rotations )[1], atol=3.0 )
+
+    def testImageSizePerFace(self):
+        imagePoints, _ = createFaces( [ -30, 0, 30 ] )
+        together = HeadPose.estimate( imagePoints, IMAGE_SIZE, fallback = False )
+        each = HeadPose.estimate( imagePoints, [ IMAGE_SIZE ] * 3, fallback = False )
+        for togetherAngles, eachAngles in zip( together, each ):
+            numpy.testing.assert_allclose( togetherAngles, eachAngles )
+
+    def testNoFaces(self):
+        rotations, translations, converged = HeadPose.solve( numpy.zeros( ( 0, 6, 2 ) ), IMAGE_SIZE )
+        self.assertEqual( ( rotations.shape, translations.shape, converged.shape ), ( ( 0, 3, 3 ), ( 0, 3 ), ( 0, ) ) )
+
+    def testRodrigues(self):
+        rotations = HeadPose.rodrigues( numpy.array( [ [ 0.0, 0.0, 0.0 ], [ 0.0, 0.0, numpy.pi / 2 ], [ 0.3, -0.2, 0.1 ] ] ) )
+        numpy.testing.assert_allclose( rotations[0], numpy.eye(3), atol=1e-12 )
+        numpy.testing.assert_allclose( rotations[1], [ [ 0.0, -1.0, 0.0 ], [ 1.0, 0.0, 0.0 ], [ 0.0, 0.0, 1.0 ] ], atol=1e-12 )
+        numpy.testing.assert_allclose( numpy.matmul( rotations, rotations.transpose( 0, 2, 1 ) ), numpy.broadcast_to( numpy.eye(3), ( 3, 3, 3 ) ), atol=1e-12 )
+
+
+if __name__ == "__main__":
+    unittest.main()
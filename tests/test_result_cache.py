@@ -0,0 +1,87 @@
+# Round trips through the result cache, its eviction and its statistics
+import os
+import shutil
+import tempfile
+import unittest
+from Utils.Cache.result_cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join( self.directory, "results.cache" )
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    def testPutAndGet(self):
+        cache = ResultCache( self.path )
+        cache.put( ResultCache.ENCODING, "a", { "angle": 12.5 } )
+        # None is a result too, apart from a missing entry
+        cache.put( ResultCache.SCAN, "b", None )
+        cache.close()
+
+        cache = ResultCache( self.path )
+        self.assertEqual( cache.get( ResultCache.ENCODING, "a" ), { "angle": 12.5 } )
+        self.assertIsNone( cache.get( ResultCache.SCAN, "b" ) )
+        self.assertIs( cache.get( ResultCache.SCAN, "a" ), ResultCache.MISSING )
+        cache.close()
+
+    def testEvictsLeastRecentlyUsed(self):
+        value = "x" * 100
+        cache = ResultCache( self.path, maxBytes = 1000 )
+        for idx in range(8):
+            cache.put( ResultCache.ROW, str(idx), value )
+        # Read the oldest, so it's kept over the ones after it
+        self.assertEqual( cache.get( ResultCache.ROW, "0" ), value )
+        for idx in range(8, 12):
+            cache.put( ResultCache.ROW, str(idx), value )
+        self.assertGreater( cache.evict(), 0 )
+
+        kept = [ str(idx) for idx in range(12) if cache.get( ResultCache.ROW, str(idx) ) is not ResultCache.MISSING ]
+        self.assertIn( "0", kept )
+        self.assertNotIn( "1", kept )
+        self.assertIn( "11", kept )
+        self.assertLessEqual( sum( stats["bytes"] for stats in cache.getStats().values() ), 900 )
+        cache.close()
+
+    def testStatsAddUpAcrossProcesses(self):
+        runId = "run"
+        first = ResultCache( self.path, runId = runId )
+        second = ResultCache( self.path, runId = runId )
+        first.put( ResultCache.PREDICTION, "a", [ 1, 2 ] )
+        first.get( ResultCache.PREDICTION, "a" )
+        second.get( ResultCache.PREDICTION, "a" )
+        second.get( ResultCache.PREDICTION, "b" )
+        second.close()
+
+        stats = first.getStats()[ResultCache.PREDICTION]
+        self.assertEqual( ( stats["hits"], stats["misses"], stats["entries"] ), ( 2, 1, 1 ) )
+        first.close()
+
+        # Another run starts its counts again
+        other = ResultCache( self.path, runId = "other" )
+        self.assertEqual( other.getStats()[ResultCache.PREDICTION]["hits"], 0 )
+        other.close()
+
+    def testOldRunStatsArePruned(self):
+        for idx in range( ResultCache.STATS_RUNS + 5 ):
+            cache = ResultCache( self.path, runId = "run{}".format(idx) )
+            cache.get( ResultCache.ENCODING, "a" )
+            cache.close()
+        cache = ResultCache( self.path )
+        numRuns = cache._db.execute( "SELECT COUNT(DISTINCT run) FROM stats" ).fetchone()[0]
+        cache.close()
+        self.assertEqual( numRuns, ResultCache.STATS_RUNS )
+
+    def testHashes(self):
+        fileName = os.path.join( self.directory, "image.png" )
+        with open( fileName, 'wb' ) as f:
+            f.write( b"pixels" * 1000 )
+        self.assertEqual( ResultCache.hashFile( fileName ), ResultCache.hashFile( fileName ) )
+        self.assertNotEqual( ResultCache.hashBytes( "ab", "c" ), ResultCache.hashBytes( "a", "bc" ) )
+        self.assertEqual( ResultCache.hashJson( { "a": 1, "b": 2 } ), ResultCache.hashJson( { "b": 2, "a": 1 } ) )
+
+
+if __name__ == "__main__":
+    unittest.main()